@@ -0,0 +1,105 @@
+#
+# Copyright (C) 2015 Prevas A/S
+#
+# This file is part of dctrl, an embedded device control framework
+#
+# dctrl is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# dctrl is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+
+"""Pattern matching benchmark on multi-MB outputs.
+
+Streams a long command output (dmesg like lines) followed by a prompt
+through a pipe, and waits for the prompt with pexpect's own searcher
+(searcher_re, rescanning the whole buffer for every chunk read) and with
+dctrl.expect.matcher.searcher_stream, as BaseCLI.expect does.  Prints
+the time taken for each set of patterns:
+
+    python bench/pattern_matching.py [megabytes]
+"""
+
+import os
+import sys
+import time
+import threading
+import pexpect
+import pexpect.fdpexpect
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from dctrl.expect import matcher
+
+PROMPT = 'root@device:~# '
+
+# the patterns of expectprompt and of a runcommand with a pattern
+PATTERN_SETS = [
+    ['# '],
+    ['root@.*# '],
+    ['link is up', pexpect.TIMEOUT, 'root@.*# '],
+    [r'error \d+', pexpect.TIMEOUT, 'root@.*# '],
+]
+
+
+def command_output(size):
+    lines = []
+    length = 0
+    n = 0
+    while length < size:
+        line = '[%12.6f] usb 1-1.%d: device descriptor read, status %d\r\n'%(
+            n * 0.001, n % 8, n % 71)
+        lines.append(line)
+        length += len(line)
+        n += 1
+    return ''.join(lines)
+
+
+def write_all(fd, data):
+    while data:
+        n = os.write(fd, data[:65536])
+        data = data[n:]
+    os.close(fd)
+
+
+def run(output, patterns, stream):
+    r, w = os.pipe()
+    con = pexpect.fdpexpect.fdspawn(r, timeout=60, maxread=2000)
+    writer = threading.Thread(target=write_all, args=(w, output + PROMPT))
+    start = time.time()
+    writer.start()
+    if stream:
+        index = con.expect_loop(matcher.searcher_stream(patterns), 60)
+    else:
+        index = con.expect(patterns)
+    seconds = time.time() - start
+    writer.join()
+    os.close(r)
+    # the prompt, at the end of the output, must be what matched
+    assert index == len(patterns) - 1 and not con.buffer
+    return seconds
+
+
+def main():
+    megabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    output = command_output(int(megabytes * 1024 * 1024))
+    print '%.1f MB of output, then the prompt %r'%(megabytes, PROMPT)
+    for patterns in PATTERN_SETS:
+        old = run(output, patterns, False)
+        new = run(output, patterns, True)
+        print '%-50s searcher_re %6.2f s, searcher_stream %6.2f s'%(
+            ', '.join(p if isinstance(p, str) else p.__name__
+                      for p in patterns), old, new)
+
+
+if __name__ == '__main__':
+    main()
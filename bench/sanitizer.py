@@ -0,0 +1,147 @@
+#
+# Copyright (C) 2015 Prevas A/S
+#
+# This file is part of dctrl, an embedded device control framework
+#
+# dctrl is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# dctrl is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+
+
+"""Output sanitizer benchmark.
+
+Sanitizes a console dump (CRLF line ends, colour escape sequences and
+the odd control character) with Sanitizer.sanitize and with feed() in
+chunks as read from a console (4 KB, and 64 bytes as from a slow serial
+line), comparing the current Sanitizer with the old one (calling
+fixup_crlf, fixup_ansiesc and fixup_asciictrl, which imported re and
+curses on every call).  Prints the best time of a few runs of each:
+
+    python bench/sanitizer.py [megabytes]
+"""
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from dctrl.expect.cliexpect import Sanitizer
+
+
+def old_fixup_crlf(b):
+    import re
+    b = re.sub(r"\r*\n\r*", "\n", b)
+    b = re.sub(r"\r+", "\n", b)
+    return b
+
+def old_fixup_ansiesc(b):
+    import re
+    b = re.sub("\x1b\[(.*?[@-~])", "", b)
+    b = re.sub("\x1b([@-_])", "", b)
+    return b
+
+def old_fixup_asciictrl(b):
+    import re
+    import curses.ascii
+    def unctrl(matchobj):
+        return curses.ascii.unctrl(matchobj.group(0))
+    b = re.sub("[\x00-\x08]|[\x0b-\x1f]|\x7f", unctrl, b)
+    return b
+
+
+class OldSanitizer(object):
+    """The Sanitizer of dctrl before the precompiled substitutions."""
+
+    maxhold = 256
+
+    _incomplete_esc = re.compile("\x1b(\\[[^\n@-~]*)?\\Z")
+
+    def __init__(self):
+        self.pending = ''
+
+    def feed(self, s):
+        s = self.pending + s
+        cut = len(s.rstrip('\r\n'))
+        esc = self._incomplete_esc.search(s, max(0, len(s) - self.maxhold))
+        if esc and esc.start() < cut:
+            cut = esc.start()
+        self.pending = s[cut:]
+        return self.sanitize(s[:cut])
+
+    def finish(self):
+        s = self.pending
+        self.pending = ''
+        return self.sanitize(s)
+
+    def sanitize(self, b):
+        if not b:
+            return b
+        b = old_fixup_crlf(b)
+        b = old_fixup_ansiesc(b)
+        b = old_fixup_asciictrl(b)
+        return b
+
+
+def console_dump(size, escapes=True):
+    lines = []
+    for i in range(100):
+        line = 'line %d: ' % i + 'abcdefghijklmnopqrstuvwxyz' * 2
+        if escapes and i % 10 == 0:
+            line = '\x1b[1;31m' + line + '\x1b[0m'
+        if escapes and i % 50 == 0:
+            line += '\x07'
+        lines.append(line + '\r\n')
+    text = ''.join(lines)
+    return (text * (size / len(text) + 1))[:size]
+
+
+def best(f, runs=5):
+    seconds = None
+    for i in range(runs):
+        start = time.time()
+        f()
+        t = time.time() - start
+        if seconds is None or t < seconds:
+            seconds = t
+    return seconds
+
+
+def feed_all(sanitizer, dump, chunk=4096):
+    out = []
+    for i in xrange(0, len(dump), chunk):
+        out.append(sanitizer.feed(dump[i:i + chunk]))
+    out.append(sanitizer.finish())
+    return ''.join(out)
+
+
+def main():
+    megabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 1.5
+    size = int(megabytes * 1024 * 1024)
+    for name, dump in [('plain', console_dump(size, False)),
+                       ('escapes', console_dump(size))]:
+        assert OldSanitizer().sanitize(dump) == Sanitizer().sanitize(dump)
+        assert feed_all(OldSanitizer(), dump) == feed_all(Sanitizer(), dump)
+        for cls in (OldSanitizer, Sanitizer):
+            whole = best(lambda: cls().sanitize(dump))
+            fed = best(lambda: feed_all(cls(), dump))
+            small = best(lambda: feed_all(cls(), dump, 64))
+            print '%-7s %-12s sanitize %.3f s, feed %.3f s, ' \
+                'feed 64 bytes at a time %.3f s'%(
+                name, cls.__name__, whole, fed, small)
+
+
+if __name__ == '__main__':
+    main()
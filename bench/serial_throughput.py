@@ -0,0 +1,102 @@
+#
+# Copyright (C) 2015 Prevas A/S
+#
+# This file is part of dctrl, an embedded device control framework
+#
+# dctrl is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# dctrl is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+
+"""Serial console throughput benchmark.
+
+Streams a console dump through a pty (standing in for a UART) and reads
+it with serspawn.read_nonblocking, as pexpect does, comparing the
+current read path with the old one (a fixed readTimeout read of size
+bytes).  Prints the time, throughput and number of reads of each, and
+the mean time to read a short reply (a prompt) when it arrives:
+
+    python bench/serial_throughput.py [megabytes]
+"""
+
+import os
+import sys
+import time
+import threading
+import serial
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from dctrl.expect.serpexpect import serspawn
+
+
+class old_serspawn(serspawn):
+    """serspawn with the read_nonblocking of dctrl before the bulk reads."""
+
+    def read_nonblocking (self, size=1, timeout=-1):
+        self.timeout = self.readTimeout
+        b = serial.Serial.read(self, size)
+        self.timeout = self.default_timeout
+        return str(b)
+
+
+def console_dump(size):
+    line = ''.join(chr(ord('a') + i % 26) for i in range(79)) + '\n'
+    return (line * (size / len(line) + 1))[:size]
+
+
+def write_all(fd, data):
+    while data:
+        n = os.write(fd, data[:4096])
+        data = data[n:]
+
+
+def run(cls, dump, replies=20):
+    master, slave = os.openpty()
+    con = cls(os.ttyname(slave))
+    writer = threading.Thread(target=write_all, args=(master, dump))
+    start = time.time()
+    writer.start()
+    received = 0
+    reads = 0
+    while received < len(dump):
+        received += len(con.read_nonblocking(con.maxread, 5))
+        reads += 1
+    seconds = time.time() - start
+    writer.join()
+
+    latency = 0.0
+    for i in range(replies):
+        start = time.time()
+        os.write(master, '# ')
+        con.read_nonblocking(con.maxread, 5)
+        latency += time.time() - start
+
+    con.close()
+    os.close(master)
+    os.close(slave)
+    return seconds, reads, latency / replies
+
+
+def main():
+    megabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 4
+    dump = console_dump(int(megabytes * 1024 * 1024))
+    for name, cls in [('old', old_serspawn), ('new', serspawn)]:
+        seconds, reads, latency = run(cls, dump)
+        print '%s: %.1f MB in %.2f s (%.1f MB/s), %d reads, reply %.2f ms'%(
+            name, megabytes, seconds, megabytes / seconds, reads,
+            latency * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+#
+# Copyright (C) 2015 Prevas A/S
+#
+# This file is part of dctrl, an embedded device control framework
+#
+# dctrl is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# dctrl is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+
+"""ssh shell round trip benchmark.
+
+Runs commands with SshCLI.runcommand against a local paramiko server,
+whose shell echoes the command line and answers it at once, so that
+the time measured is that of the ssh transport and the read path.
+Compares the current read path with the old one (toggling
+setblocking/settimeout on the channel for every read and send), and
+prints the mean and median round trip of each:
+
+    python bench/ssh_latency.py [commands]
+
+delaybeforesend is set to 0, as its sleep would hide the difference.
+"""
+
+import os
+import sys
+import time
+import socket
+import logging
+import tempfile
+import threading
+import paramiko
+import pexpect
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from dctrl.expect.sshcli import SshCLI
+
+
+class Server(paramiko.ServerInterface):
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        thread = threading.Thread(target=shell, args=(channel,))
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+def shell(channel):
+    """Echo input, and answer 'echo <text>' lines with text."""
+
+    channel.sendall('# ')
+    buf = ''
+    while True:
+        data = channel.recv(1024)
+        if not data:
+            break
+        channel.sendall(data)
+        buf += data
+        while '\n' in buf:
+            line, buf = buf.split('\n', 1)
+            line = line.strip('\r')
+            if line.startswith('echo '):
+                channel.sendall('\r\n%s\r\n# '%(line[5:]))
+            else:
+                channel.sendall('\r\n# ')
+
+
+def start_server():
+    """Start the server, and return its port."""
+
+    host_key = paramiko.RSAKey.generate(2048)
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(5)
+    def accept():
+        while True:
+            client, address = sock.accept()
+            # as sshd does for interactive sessions
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            transport = paramiko.Transport(client)
+            transport.add_server_key(host_key)
+            transport.start_server(server=Server())
+    thread = threading.Thread(target=accept)
+    thread.daemon = True
+    thread.start()
+    return sock.getsockname()[1]
+
+
+class OldSshCLI(SshCLI):
+    """SshCLI with the channel handling of dctrl before the select based
+    reads."""
+
+    def send(self, s, noSendLog=None):
+        time.sleep(self.delaybeforesend)
+        self.sshch.setblocking(1)
+        return self.sshch.send(s)
+
+    def read_nonblocking (self, size=1, timeout=-1):
+        if timeout == -1:
+            timeout = self.timeout
+        if timeout:
+            self.sshch.setblocking(0)
+        self.sshch.settimeout(timeout)
+        try:
+            buf = self.sshch.recv(size)
+        except socket.timeout, e:
+            raise pexpect.TIMEOUT("Timeout in sshpexpect.read_nonblocking")
+        if self.logfile_read is not None:
+            self.logfile_read.write(buf)
+            self.logfile_read.flush()
+        return buf
+
+
+def run(cls, port, logfile, commands):
+    con = cls('127.0.0.1', 'user', 'password', port, logfile=logfile)
+    con.delaybeforesend = 0
+    times = []
+    for i in range(commands):
+        start = time.time()
+        if not con.runcommand('echo %d'%(i), timeout=5):
+            raise Exception("command %d failed"%(i))
+        times.append(time.time() - start)
+    con.close()
+    times.sort()
+    return sum(times) / len(times), times[len(times) / 2]
+
+
+def main():
+    commands = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    # the server side of closed connections is not of interest
+    logging.getLogger('paramiko').addHandler(logging.NullHandler())
+    port = start_server()
+    fd, logfile = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        for name, cls in [('old', OldSshCLI), ('new', SshCLI)]:
+            mean, median = run(cls, port, logfile, commands)
+            print '%s: %d commands, round trip mean %.2f ms, median %.2f ms'%(
+                name, commands, mean * 1000, median * 1000)
+    finally:
+        os.unlink(logfile)
+
+
+if __name__ == '__main__':
+    main()
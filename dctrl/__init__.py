@@ -24,11 +24,18 @@ version = '0.0.0'
 class HookError(Exception):
     pass
 
-from .load import load_commands
+def get_cache_dir():
+    """Return the directory for dctrl cache files."""
+    import os
+    cache = os.environ.get('XDG_CACHE_HOME',
+                           os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache, 'dctrl')
+
+from .load import load_commands, load_command
 
 def get_command(grp, cmd):
-    if not '_commands' in globals():
-        load_commands()
+    if not cmd in globals().get('_commands', {}).get(grp, {}):
+        load_command(grp, cmd)
     try:
         return _commands[grp][cmd]
     except KeyError:
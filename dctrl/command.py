@@ -20,10 +20,14 @@
 
 import dctrl
 import dctrl.connection
+import dctrl.context
 import re
 import traceback
+import argparse
 
 class NoopArgumentParser(object):
+    """Stand-in for an argparse parser, only recording the default value
+    of each argument added (in defaults)."""
 
     def __init__(self):
         self.defaults = {}
@@ -31,7 +35,7 @@ class NoopArgumentParser(object):
     def add_argument(self, *args, **kwargs):
         assert len(args) > 0
         if 'dest' in kwargs:
-            name = kwargs[dest]
+            name = kwargs['dest']
         elif not args[0].startswith('-'):
             name = args[0]
         else:
@@ -44,30 +48,134 @@ class NoopArgumentParser(object):
                 assert args[0][0] == '-'
                 name = args[0][1:]
             name = name.replace('-', '_')
-        value = kwargs.get('default', None)
+        action = kwargs.get('action', 'store')
+        if 'default' in kwargs:
+            value = kwargs['default']
+        elif action == 'store_true':
+            value = False
+        elif action == 'store_false':
+            value = True
+        else:
+            value = None
+        if value is argparse.SUPPRESS:
+            return
+        # like argparse, string defaults are converted by type
+        if isinstance(value, basestring) and 'type' in kwargs:
+            value = kwargs['type'](value)
         self.defaults[name] = value
 
     def set_defaults(self, **kwargs):
         self.defaults.update(kwargs)
 
+class DeferredArgumentParser(NoopArgumentParser):
+    """Records the arguments added, so that the argparse parser is only
+    built (by build) for the command actually run."""
+
+    def __init__(self):
+        super(DeferredArgumentParser, self).__init__()
+        self.calls = []
+
+    def add_argument(self, *args, **kwargs):
+        super(DeferredArgumentParser, self).add_argument(*args, **kwargs)
+        self.calls.append(('add_argument', args, kwargs))
+
+    def set_defaults(self, **kwargs):
+        super(DeferredArgumentParser, self).set_defaults(**kwargs)
+        self.calls.append(('set_defaults', (), kwargs))
+
+    def build(self, parser):
+        """Add the recorded arguments to argparse parser."""
+        for method, args, kwargs in self.calls:
+            getattr(parser, method)(*args, **kwargs)
+        return parser
+
 class NoopSubparsersAction(object):
     def __init__(self):
         pass
     def add_parser(self, *args, **kwargs):
         return NoopArgumentParser()
+    def add_command(self, cmd):
+        pass
 
-def run(cmd):
-    from dctrl.config import config
-    logger = dctrl.logger
-    if config['command']['connection']:
-        connection_type = config['command']['connection']['type']
-        try:
-            con = dctrl.connection.connect(connection_type)
-        except Exception:
-            logger.debug("connect failed", exc_info=True)
-            raise
-    else:
-        con = None
+class CommandSubparsersAction(argparse._SubParsersAction):
+    """Subparsers action of a command group, building the parser of a
+    command when it is selected."""
+
+    def __init__(self, *args, **kwargs):
+        super(CommandSubparsersAction, self).__init__(*args, **kwargs)
+        self.commands = {}
+
+    def add_command(self, cmd):
+        self.commands[cmd.name] = cmd
+        # the choices are the keys of the parser map
+        self._name_parser_map[cmd.name] = None
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        name = values[0]
+        if self._name_parser_map.get(name) is None and name in self.commands:
+            self.commands[name].build_parser(self)
+        super(CommandSubparsersAction, self).__call__(
+            parser, namespace, values, option_string)
+
+def parse_args(parser, argv=None, global_options=()):
+    """Parse dctrl command line argv (default: sys.argv[1:]) with parser,
+    and load the configuration of the command.  Returns the command and
+    its configuration, with the command parameters in config['params'].
+    global_options are the names (dest) of the options of parser that are
+    not command parameters.  Raises dctrl.config.ConfigError if the
+    configuration is invalid."""
+    import dctrl.config
+    args = parser.parse_args(argv)
+    config = dctrl.config.load(args.config_file, args.run)
+    for name in global_options:
+        if hasattr(args, name):
+            delattr(args, name)
+    if not args.log:
+        args.logfile = None
+    del args.log
+    config['params'] = vars(args)
+    return args.run, config
+
+def run(cmd, con=None, pool=None, context=None):
+    """Run cmd, on connection con if given, or else on a connection leased
+    from pool (a dctrl.connection.ConnectionPool) or a new connection (if
+    the command group has one).  context (a dctrl.context.Context) is the
+    configuration and logger of the run (default: the current context,
+    or the configuration last loaded)."""
+    context = dctrl.context.get(context)
+    with context:
+        return _connect_and_run(cmd, con, pool, context)
+
+
+def _connect_and_run(cmd, con, pool, context):
+    config = context.config
+    logger = context.logger
+    if con is not None or not config['command']['connection']:
+        return _run(cmd, con, context)
+    try:
+        if pool is not None:
+            con = pool.lease(context)
+        else:
+            connection_type = config['command']['connection']['type']
+            con = dctrl.connection.connect(connection_type, context)
+    except Exception:
+        logger.debug("connect failed", exc_info=True)
+        raise
+    if pool is None:
+        return _run(cmd, con, context)
+    ret = None
+    try:
+        ret = _run(cmd, con, context)
+    finally:
+        # after an error the connection may be left in any state
+        pool.release(con, broken=(ret is None or ret[0] == 2))
+    return ret
+
+
+def _run(cmd, con, context):
+    config = context.config
+    logger = context.logger
+    context.con = con
     try:
         cmd.setup(con, config)
     except Exception as e:
@@ -123,7 +231,8 @@ class DctrlCommandGroup(object):
         self.name = name
         if hasattr(dctrl, 'subparsers'):
             self.parser = dctrl.subparsers.add_parser(name, help=cls.__doc__)
-            self.subparsers = self.parser.add_subparsers()
+            self.subparsers = self.parser.add_subparsers(
+                action=CommandSubparsersAction)
         else:
             self.parser = NoopArgumentParser()
             self.subparsers = NoopSubparsersAction()
@@ -147,9 +256,17 @@ class DctrlCommand(object):
             self.name = name
         elif not hasattr(self, 'name'):
             self.name = self.__class__.__name__.replace('_', '-')
-        self.parser = self._group.subparsers.add_parser(
-            self.name, description=self.__doc__, epilog=self.epilog)
+        # arguments are recorded, the argparse parser is built when the
+        # command is selected
+        self.parser = DeferredArgumentParser()
         self.parser.set_defaults(run=self)
+        self._group.subparsers.add_command(self)
+
+    def build_parser(self, subparsers):
+        """Add the argparse parser of the command to subparsers."""
+        parser = subparsers.add_parser(
+            self.name, description=self.__doc__, epilog=self.epilog)
+        return self.parser.build(parser)
 
     def setup(self, con, config):
         for hook in self.setup_hooks:
@@ -169,8 +286,9 @@ class DctrlCommand(object):
                     self.get_group_name()))
 
     def __call__(self, con):
-        dctrl.logger.debug("running command: %s"%(self.get_name()))
-        from dctrl.config import config
+        context = dctrl.context.get()
+        context.logger.debug("running command: %s"%(self.get_name()))
+        config = context.config
         return self.run(con, config, config['params']) # 0=success, 1=failed, 2=dctrl error
 
     def add_argument(self, *args, **kwargs):
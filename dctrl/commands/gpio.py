@@ -73,15 +73,13 @@ class gpio_read(LinuxCommand):
 
     def run(self, con, config, args):
 
-        command = "echo in > /sys/class/gpio/gpio%s/direction"%(args['gpio'])
-        if not con.runcommand(command):
-            return (1, con.output.rstrip())
-
-        command = "cat /sys/class/gpio/gpio%s/value"%(args['gpio'])
-        if not con.runcommand(command):
+        commands = [
+            "echo in > /sys/class/gpio/gpio%s/direction"%(args['gpio']),
+            "cat /sys/class/gpio/gpio%s/value"%(args['gpio'])]
+        if not con.runcommands(commands):
             return (1, con.output.rstrip())
 
-        output = con.output.rstrip()
+        output = con.outputs[1].rstrip()
         if not args['expected'] is None:
             if not args['expected'] == output:
                 return (1, "Unexpected value (read %s, expected %s)"%(output, args['expected']))
@@ -101,12 +99,10 @@ class gpio_write(LinuxCommand):
               help="The value to set")
 
     def run(self, con, config, args):
-        command = "echo out > /sys/class/gpio/gpio%s/direction"%(args['gpio'])
-        if not con.runcommand(command):
-            return (1, con.output.rstrip())
-
-        command = "echo %s > /sys/class/gpio/gpio%s/value"%(args['value'],args['gpio'])
-        if not con.runcommand(command):
+        commands = [
+            "echo out > /sys/class/gpio/gpio%s/direction"%(args['gpio']),
+            "echo %s > /sys/class/gpio/gpio%s/value"%(args['value'],args['gpio'])]
+        if not con.runcommands(commands):
             return (1, con.output.rstrip())
 
         return True
@@ -28,6 +28,7 @@ import string
 
 import dctrl
 import dctrl.command
+import dctrl.context
 import dctrl.expect.cliexpect as cliexpect
 import logging
 
@@ -43,10 +44,48 @@ class LinuxCommand(dctrl.command.DctrlCommand):
         super(LinuxCommand, self).__init__(LinuxCommand, "linux")
         self.setup_hooks.append(self.setup_prompt)
         self.setup_hooks.append(self.setup_consume_command_echo)
+        self.setup_hooks.append(self.setup_check_exitcode)
+        self.setup_hooks.append(self.setup_max_batch_length)
+        self.teardown_hooks.append(self.teardown_check_exitcode)
         self.waitForPrompt = True
 
+    def setup_check_exitcode(self, con, config):
+        # capture exit codes in-band, saving an 'echo $?' round trip
+        if config['params'].get('allowed_exitcodes', None):
+            con.set_check_exitcode(True)
+
+    def teardown_check_exitcode(self, con, config):
+        # the connection may be reused by commands of other groups
+        con.set_check_exitcode(False)
+
+    def setup_max_batch_length(self, con, config):
+        length = config['command'].get('max-batch-length', None)
+        if length is not None:
+            try:
+                con.set_max_batch_length(int(length))
+            except ValueError:
+                raise dctrl.command.CommandConfigError(
+                    "invalid max-batch-length value: %s"%(length))
+
+    def get_exitcode(self, con, cmdOutputFile=None):
+        """Return the exit code of the last command run on con, or None if
+        it could not be found.  Falls back to asking the shell with
+        'echo $?' when the last command was not run with in-band exit code
+        capture."""
+        if con.exitcode_checked:
+            return con.exitcode
+        cret = con.runcommand('echo $?',
+                              pattern='^[1-2]?[0-9]{1,2}%s'%(con.linesep),
+                              timeout=1, cmdOutputFile=cmdOutputFile,
+                              checkExitcode=False)
+        if not cret:
+            return None
+        try:
+            return int(con.pmatch)
+        except ValueError:
+            return None
+
     def __call__(self, con):
-        from dctrl.config import config
         ret = super(LinuxCommand, self).__call__(con)
         # we do not only return integers anymore, also bool and tuple
         # convert to tuple to simplify check
@@ -73,17 +112,12 @@ class LinuxCommand(dctrl.command.DctrlCommand):
         if not type(ret[0]) == int:
             raise TypeValError("ret[0] must be an int here - I do not know how to handle this!!!")
 
-        allowed_exitcodes = config['params'].get('allowed_exitcodes', None)
+        params = dctrl.context.get().params
+        allowed_exitcodes = params.get('allowed_exitcodes', None)
         if ret[0] == 0 and allowed_exitcodes and self.waitForPrompt:
-            cret = con.runcommand('echo $?',
-                                 pattern='^[1-2]?[0-9]{1,2}%s'%(con.linesep),
-                                 timeout=1)
-            if not cret:
+            exitcode = self.get_exitcode(con)
+            if exitcode is None:
                 return (1, "exitcode not found")
-            try:
-                exitcode = int(con.pmatch)
-            except ValueError:
-                return (1, "invalid exitcode: %s"%(cret))
             if not exitcode in allowed_exitcodes:
                 return (1, "bad exitcode: %s (allowed: %s)"%(
                         exitcode, ','.join(map(str, allowed_exitcodes))))
@@ -132,21 +166,16 @@ class LinuxCommand(dctrl.command.DctrlCommand):
             connection.error("allowed_exitcodes must be a list! Current content: %s\n"%(allowed_exitcodes))
             return False
 
-        # Call connections run command with waitForPrompt set to True
-        ret = connection.runcommand(command, pattern, prompt, True,timeout, returnbool, expectNoOutput, cmdOutputFile)
+        # Call connections run command with waitForPrompt set to True,
+        # capturing the exit code in the same round trip
+        ret = connection.runcommand(command, pattern, prompt, True,timeout, returnbool, expectNoOutput, cmdOutputFile,
+                                    checkExitcode=True)
 
         if ret == True:
             # Check the return code if the first command went well
-            cret = connection.runcommand('echo $?',
-                               pattern='^[1-2]?[0-9]{1,2}%s'%(connection.linesep),
-                                   timeout=1, cmdOutputFile=cmdOutputFile)
-            if not cret:
-                connection.error("Could not get the exitcode from echo $?")
-                return False
-            try:
-                exitcode = int(connection.pmatch)
-            except ValueError:
-                connection.error("invalid exitcode: %s\n"%(cret))
+            exitcode = self.get_exitcode(connection, cmdOutputFile)
+            if exitcode is None:
+                connection.error("Could not get the exitcode of the command")
                 return False
             if not exitcode in allowed_exitcodes:
                 connection.error("bad exitcode: %s (allowed: %s)\n"%(
@@ -155,9 +184,13 @@ class LinuxCommand(dctrl.command.DctrlCommand):
 
         return ret
 
-def get_to_prompt(con, config, args, target='prompt'):
+def get_to_prompt(con, config, args, target='prompt', timeout=None):
     username = config.get('username', 'root')
 
+    # timeout is an upper bound for the whole prompt acquisition, the
+    # individual waits below are limited to what is left of it
+    con.set_deadline(timeout)
+
     prompts = {}
 
     if 'enter-prompt' in config:
@@ -192,24 +225,26 @@ def get_to_prompt(con, config, args, target='prompt'):
             return None
         con.sendline('su')
         try:
-            con.expect('Password: ', timeout=1)
+            con.expect('Password: ', timeout=con.remaining_timeout(1))
         except pexpect.TIMEOUT, e:
             print >>sys.stderr, "error: timeout waiting for su password prompt"
             con.send('\x03')
-            con.expect(config['prompt'], timeout=1)
+            con.expect(config['prompt'], timeout=con.remaining_timeout(1))
             raise e
         con.sendline(config['root-password'])
         try:
-            con.expect(config['root-prompt'], timeout=1)
+            con.expect(config['root-prompt'],
+                       timeout=con.remaining_timeout(1))
         except pexpect.TIMEOUT, e:
             print >>sys.stderr, "error: timeout waiting for root prompt"
             con.send('\x03')
             try:
-                con.expect(config['prompt'], timeout=1)
+                con.expect(config['prompt'], timeout=con.remaining_timeout(1))
             except pexpect.TIMEOUT, e:
                 con.send('\x04')
                 try:
-                    con.expect(config['prompt'], timeout=1)
+                    con.expect(config['prompt'],
+                               timeout=con.remaining_timeout(1))
                 except pexpect.TIMEOUT, e:
                     print >>sys.stderr, "error: root prompt mess!"
                     raise e
@@ -222,7 +257,8 @@ def get_to_prompt(con, config, args, target='prompt'):
     for breakchar in '\x03\x04': # Ctrl-C Ctrl-D
         con.send(breakchar)
         match = con.expect(
-            prompts.values() + [pexpect.TIMEOUT], timeout=2)
+            prompts.values() + [pexpect.TIMEOUT],
+            timeout=con.remaining_timeout(2))
         if match < len(prompts.keys()):
             prompt_func = eval(prompts.keys()[match])
             _console_state = prompt_func() or prompt_func.__name__
@@ -236,7 +272,8 @@ def get_to_prompt(con, config, args, target='prompt'):
     while _console_state != target and attempts:
         attempts -= 1
         try:
-            match = con.expect(prompts.values(), timeout=2)
+            match = con.expect(prompts.values(),
+                               timeout=con.remaining_timeout(2))
         except pexpect.TIMEOUT, e:
             print >>sys.stderr, "timeout in state %s"%(_console_state)
             _console_state = None
@@ -253,19 +290,22 @@ class su_prompt(LinuxCommand):
     def __init__(self):
         super(su_prompt, self).__init__()
         self.add_root_password_argument()
+        self.add_timeout_argument(default=30)
         self.add_argument('--init-command', metavar='STRING',
                           help="shell command string to initialize the shell")
 
     def run(self, con, config, args):
+        # one timeout budget for getting the prompt and initializing it
         prompt = get_to_prompt(con, config['command'], args,
-                               target='root_prompt')
+                               target='root_prompt', timeout=args['timeout'])
         dctrl.logger.debug('got prompt: %s', prompt)
 
         init_command = args.get('init_command', None)
         if init_command is None:
             init_command = config.get('init-command',
                                       'stty cols 1000;dmesg -n 1')
-        if not con.runcommand(init_command, expectNoOutput=True):
+        if not con.runcommand(init_command, expectNoOutput=True,
+                              timeout=con.remaining_timeout(con.timeout)):
             return (1, "initialization command failed")
         return 0
 
@@ -275,18 +315,22 @@ class user_prompt(LinuxCommand):
 
     def __init__(self):
         super(user_prompt, self).__init__()
+        self.add_timeout_argument(default=30)
         self.add_argument('--init-command', metavar='STRING',
                           help="shell command string to initialize the shell")
 
     def run(self, con, config, args):
-        prompt = get_to_prompt(con, config['command'], args)
+        # one timeout budget for getting the prompt and initializing it
+        prompt = get_to_prompt(con, config['command'], args,
+                               timeout=args['timeout'])
         dctrl.logger.debug('got prompt: %s', prompt)
 
         init_command = args.get('init_command', None)
         if init_command is None:
             init_command = config.get('init-command',
                                       'stty cols 1000;dmesg -n 1')
-        if not con.runcommand(init_command, expectNoOutput=True):
+        if not con.runcommand(init_command, expectNoOutput=True,
+                              timeout=con.remaining_timeout(con.timeout)):
             return (1, "initialization command failed")
         return 0
 
@@ -327,17 +371,12 @@ class linux_info(LinuxCommand):
 
     def run(self, con, config, args):
         result = {}
-        if not con.runcommand("uname -r", timeout=10):
-            return False
-        result['osrelease'] = con.output.rstrip()
-
-        if not con.runcommand("uname -m", timeout=10):
-            return False
-        result['machine'] = con.output.rstrip()
-
-        if not con.runcommand("uname -v", timeout=10):
+        if not con.runparallel(["uname -r", "uname -m", "uname -v"],
+                               timeout=10):
             return False
-        result['version'] = con.output.rstrip()
+        result['osrelease'] = con.outputs[0].rstrip()
+        result['machine'] = con.outputs[1].rstrip()
+        result['version'] = con.outputs[2].rstrip()
 
         return True, result
 
@@ -47,25 +47,25 @@ class prompt(UBootCommand):
                           help="disable keypress if enabled")
 
     def run(self, con, config, args):
-        timeout=args['timeout']
         c = config['command']['prompt']
         dctrl.logger.info('Looking for: %s', c)
 
-        while (timeout > 0):
+        # timeout is a hard upper bound for the whole command
+        con.set_deadline(args['timeout'])
+        while (con.remaining_timeout() > 0):
             s = 0
-            while(s < 1):
+            while(s < 1 and con.remaining_timeout() > 0):
                 if not args['nokeypress']:
                     con.send('\x03')
-                time.sleep(0.1)
+                time.sleep(con.remaining_timeout(0.1))
                 s+=0.1
             try:
-                match = con.expect(c,1)
+                match = con.expect(c, con.remaining_timeout(1))
                 if (match == 0):
                     dctrl.logger.debug('got prompt: %s', prompt)
                     return 0
             except pexpect.TIMEOUT:
                 pass
-            timeout=timeout-1
         return (1, "timeout waiting for prompt")
 
 
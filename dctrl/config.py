@@ -19,8 +19,10 @@
 #
 
 import os
-import yaml
 import logging
+import hashlib
+import cPickle
+import UserDict
 
 import dctrl
 
@@ -30,16 +32,173 @@ class ConfigError(Exception):
     pass
 
 
-config = None
+class ConfigShim(UserDict.DictMixin):
+    """The configuration of the current context (see dctrl.context), or
+    else the configuration last loaded.  This is what the config global
+    is, for code not given the configuration of the run."""
+
+    def _get(self):
+        import dctrl.context
+        context = dctrl.context.current()
+        if context is not None:
+            return context.config
+        if _loaded is None:
+            raise ConfigError("dctrl configuration not loaded")
+        return _loaded
+
+    def __getitem__(self, key):
+        return self._get()[key]
+
+    def __setitem__(self, key, value):
+        self._get()[key] = value
+
+    def __delitem__(self, key):
+        del self._get()[key]
+
+    def keys(self):
+        return self._get().keys()
+
+    def __contains__(self, key):
+        return key in self._get()
+
+    def __iter__(self):
+        return iter(self._get())
+
+    def __repr__(self):
+        return repr(self._get())
+
+
+config = ConfigShim()
+
+# configuration last loaded
+_loaded = None
+
+# compiled configurations, by file name
+_cache = {}
+
+# bump when the format of compiled configurations changes
+CACHE_VERSION = 1
+
+
+def get_loaded():
+    """Return the configuration last loaded by load."""
+    if _loaded is None:
+        raise ConfigError("dctrl configuration not loaded")
+    return _loaded
 
 
 def load(filename, cmd):
-    import dctrl.connection
+    """Load the configuration of the command group of cmd from filename,
+    and return it.  It is also the configuration referred to by config
+    outside of command runs.
 
-    config = get(filename)
-    config = env_override(config)
+    The configuration of each command group is compiled once, and cached
+    (in memory and in the dctrl cache directory) until the file, the
+    environment variables it refers to (env-<name> entries) or the dctrl
+    version change."""
 
     cmd_group = cmd.get_group_name()
+    filename = os.path.normpath(filename)
+    if not os.path.exists(filename):
+        raise ConfigError("dctrl configuration file not found",
+                          str(filename))
+    path = os.path.abspath(filename)
+    entry = get_cached(path)
+    if entry is not None and cmd_group in entry['groups']:
+        config = cPickle.loads(entry['groups'][cmd_group])
+        # the type may have been provided by a package since removed
+        check_connection_type(config['command']['connection'])
+        globals()['_loaded'] = config
+        return config
+
+    stat = os.stat(path)
+    config = get(filename)
+    env = dict((name, os.environ.get(name)) for name in env_names(config))
+    config = resolve(env_override(config, {}), cmd_group)
+
+    if entry is None:
+        entry = {'version': (CACHE_VERSION, dctrl.version),
+                 'mtime': stat.st_mtime, 'size': stat.st_size, 'env': env,
+                 'groups': {}}
+    entry['groups'][cmd_group] = cPickle.dumps(config, 2)
+    _cache[path] = entry
+    write_cache(path, entry)
+    globals()['_loaded'] = config
+    return config
+
+
+def cache_filename(filename):
+    key = hashlib.md5(filename).hexdigest()[:16]
+    return os.path.join(dctrl.get_cache_dir(), 'config-%s.pickle'%(key))
+
+
+def get_cached(filename):
+    """Return the cache entry of (absolute) filename, if up to date."""
+
+    entry = _cache.get(filename)
+    if entry is None:
+        try:
+            with open(cache_filename(filename), 'rb') as f:
+                entry = cPickle.load(f)
+        except Exception:
+            return None
+        if entry.get('version') != (CACHE_VERSION, dctrl.version):
+            return None
+        _cache[filename] = entry
+    stat = os.stat(filename)
+    if (entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size):
+        del _cache[filename]
+        return None
+    for name, value in entry['env'].iteritems():
+        if os.environ.get(name) != value:
+            del _cache[filename]
+            return None
+    return entry
+
+
+def write_cache(filename, entry):
+    cache = cache_filename(filename)
+    try:
+        if not os.path.isdir(os.path.dirname(cache)):
+            os.makedirs(os.path.dirname(cache))
+        tmp = '%s.%d'%(cache, os.getpid())
+        with open(tmp, 'wb') as f:
+            cPickle.dump(entry, f, 2)
+        os.rename(tmp, cache)
+    except (IOError, OSError), e:
+        logger.debug("failed to write configuration cache: %s", e)
+
+
+def env_names(config):
+    """Return the names of the environment variables referred to by
+    env-<name> entries in config."""
+
+    names = set()
+    for key, val in config.items():
+        if key.startswith("env") and isinstance(val, basestring):
+            names.add(val)
+        if isinstance(val, dict):
+            names.update(env_names(val))
+    return names
+
+
+def check_connection_type(connection_config):
+    """Raise ConfigError if the connection type of connection_config is
+    not supported."""
+
+    connection_type = connection_config.get('type')
+    if connection_type is None:
+        return
+    import dctrl.connection
+    if not dctrl.connection.is_valid_type(connection_type):
+        raise ConfigError(
+            "invalid dctrl configuration",
+            "%s connection type not supported"%(connection_type))
+
+
+def resolve(config, cmd_group):
+    """Return the configuration of cmd_group from (the full) config."""
+
     if not cmd_group in config['commands']:
         raise ConfigError("invalid dctrl configuration",
                           "no %s commands definition"%(cmd_group))
@@ -54,11 +213,7 @@ def load(filename, cmd):
         if not 'type' in connection_config:
             raise ConfigError("invalid dctrl configuration",
                               "%s connection type not defined"%(cmd_group))
-        connection_type = connection_config['type']
-        if not dctrl.connection.is_valid_type(connection_type):
-            raise ConfigError(
-                "invalid dctrl configuration",
-                "%s connection type not supported"%(connection_type))
+        check_connection_type(connection_config)
 
     def getcattr(name, default=None, unescape=False, required=False):
         assert isinstance(name, basestring)
@@ -82,13 +237,14 @@ def load(filename, cmd):
         'linesep', default='\r\n', unescape=True)
     command_config['sendlinesep'] = getcattr(
         'sendlinesep', default=command_config['linesep'], unescape=True)
+    command_config['max-batch-length'] = getcattr(
+        'max-batch-length')
 
     assert not 'command' in config
     config['command'] = command_config
     del config['commands']
     del config['connections']
-    globals()['config'] = config
-    return
+    return config
 
 
 def get(filename):
@@ -97,8 +253,12 @@ def get(filename):
     if not os.path.exists(filename):
         raise ConfigError("dctrl configuration file not found",
                           str(filename))
+    # not imported by the module, cached configurations do not need it
+    import yaml
+    # the C loader of libyaml is much faster, when available
+    loader = getattr(yaml, 'CLoader', yaml.Loader)
     with open(filename, 'r') as config_file:
-        config = yaml.load(config_file)
+        config = yaml.load(config_file, Loader=loader)
     if not 'commands' in config:
         raise ConfigError("invalid dctrl configuration",
                           "no commands defined")
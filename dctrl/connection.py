@@ -20,19 +20,118 @@
 
 import sys
 import os
+import time
+import errno
+import socket
+import random
 import logging
+import threading
+import pexpect
 
-import dctrl.expect.cliexpect as cliexpect
+import dctrl
 
 
+# time.monotonic is not available in python2
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+# entry point group of connection types provided by other packages
+ENTRY_POINT_GROUP = 'dctrl.connections'
+
 def is_valid_type(connection_type):
+    if not connection_type in _connection_types:
+        load_entry_points()
     return connection_type in _connection_types
 
-def connect(connection_type):
-    return _connection_types[connection_type]()
+def register_type(connection_type, connect, retries=0, lock=None):
+    """Register connection_type, opened by connect(context), which is
+    given the dctrl.context.Context of the command run, and returns a
+    BaseCLI.  connect may also be given by name ('module:function'), to
+    only import the module when a connection of the type is opened.
+    retries is the number of retries, and lock the device lock mode (see
+    lock_device), if not configured."""
+    _connection_types[connection_type] = connect
+    _default_retries[connection_type] = retries
+    if lock is not None:
+        _default_locks[connection_type] = lock
+
+def load_entry_points():
+    """Register the connection types of the dctrl.connections entry
+    points of installed packages, which are not already registered."""
+    global _entry_points_loaded
+    if _entry_points_loaded:
+        return
+    _entry_points_loaded = True
+    try:
+        import pkg_resources
+    except ImportError:
+        return
+    for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP):
+        if not entry_point.name in _connection_types:
+            register_type(entry_point.name, '%s:%s'%(
+                    entry_point.module_name, '.'.join(entry_point.attrs)))
+
+def get_connect(connection_type):
+    """Return the function opening connections of connection_type."""
+    if not is_valid_type(connection_type):
+        raise ConnectionConfigError(
+            "connection type not supported: %s"%(connection_type))
+    connect = _connection_types[connection_type]
+    if isinstance(connect, basestring):
+        module_name, name = connect.split(':', 1)
+        connect = __import__(module_name, fromlist=[name])
+        for attr in name.split('.'):
+            connect = getattr(connect, attr)
+        _connection_types[connection_type] = connect
+    return connect
+
+def connect(connection_type, context=None):
+    """Open a connection of connection_type for context (default: the
+    current context), retrying as configured (see RetryPolicy)."""
+    import dctrl.context
+    context = dctrl.context.get(context)
+    c = context.config['command']['connection']
+    policy = RetryPolicy.from_config(c, connection_type)
+    connect = get_connect(connection_type)
+    lease = lock_device(c, connection_type, context.logger)
+    try:
+        con = policy.run(lambda: connect(context), context.logger)
+    except BaseException:
+        if lease is not None:
+            lease.release()
+        raise
+    # released by disconnect, or when the process exits
+    con.device_lease = lease
+    return con
 
 def disconnect(connection):
     connection.close()
+    lease = getattr(connection, 'device_lease', None)
+    if lease is not None:
+        lease.release()
+
+def lock_device(c, connection_type=None, logger=None):
+    """Lease the device of connection configuration c, as configured by
+    the entries lock (exclusive, shared or none) and lock-timeout
+    (seconds, default 300, null for no limit).  Returns the
+    dctrl.lock.Lease, or None if the device is not locked.  The lease
+    is held as long as the connection is open, also while it is idle in
+    a ConnectionPool."""
+    mode = c.get('lock', _default_locks.get(connection_type, 'none'))
+    if mode in (None, False, 'none'):
+        return None
+    import dctrl.lock
+    if mode not in dctrl.lock.MODES:
+        raise ConnectionConfigError("invalid lock value: %s"%(mode))
+    timeout = c.get('lock-timeout', 300)
+    if timeout is not None:
+        try:
+            timeout = float(timeout)
+        except (TypeError, ValueError):
+            raise ConnectionConfigError(
+                "invalid lock-timeout value: %s"%(timeout))
+    return dctrl.lock.get_manager().acquire(
+        connection_key(c), mode, timeout, logger)
 
 #    cli = connect(cmd_module, parser, cmd, cmd_name,
 #                  options, subcmd_args, config, run, cleanup)
@@ -41,14 +140,383 @@ def disconnect(connection):
 
 
 class ConnectionError(Exception):
-    pass
+    # the exception causing the connection to fail
+    cause = None
 class ConnectionConfigError(ConnectionError):
     pass
 
 
-def connect_serial():
-    import dctrl.config
-    config = dctrl.config.config
+def connection_error(message, cause):
+    e = ConnectionError(message)
+    e.cause = cause
+    return e
+
+
+def error_class(e):
+    """Return the class of connection error e: 'config', 'auth',
+    'refused', 'timeout', 'unreachable', 'reset', 'unavailable' (ie. a
+    missing or busy serial port) or 'other'."""
+
+    if isinstance(e, ConnectionConfigError):
+        return 'config'
+    if isinstance(e, ConnectionError) and e.cause is not None:
+        e = e.cause
+    # transport modules are not imported unless used
+    paramiko = sys.modules.get('paramiko')
+    if paramiko is not None:
+        if isinstance(e, paramiko.AuthenticationException):
+            return 'auth'
+        if isinstance(e, paramiko.SSHException):
+            return 'reset'
+    if isinstance(e, socket.timeout):
+        return 'timeout'
+    if isinstance(e, EOFError):
+        return 'reset'
+    code = getattr(e, 'errno', None)
+    if code is None and isinstance(e, EnvironmentError) and e.args:
+        code = e.args[0]
+    if code == errno.ECONNREFUSED:
+        return 'refused'
+    if code == errno.ETIMEDOUT:
+        return 'timeout'
+    if code in (errno.EHOSTUNREACH, errno.ENETUNREACH, errno.EHOSTDOWN):
+        return 'unreachable'
+    if code in (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE):
+        return 'reset'
+    if code in (errno.ENOENT, errno.ENODEV, errno.EBUSY, errno.EACCES):
+        return 'unavailable'
+    serial = sys.modules.get('serial')
+    if serial is not None and isinstance(e, serial.SerialException):
+        return 'unavailable'
+    return 'other'
+
+
+class RetryPolicy(object):
+    """How to retry opening a connection.
+
+    A failed attempt is retried if the class of the error (see
+    error_class) is in retry_on, up to retries times, and as long as
+    the next attempt can start before the deadline (seconds from the
+    first attempt, None means no deadline).  retries None means retrying
+    until the deadline.  The delay before retry n (from 0) is
+    delay * backoff**n, at most max_delay, reduced by a random part of
+    up to jitter (0-1) of it, so that devices coming up at the same
+    time are not polled in lockstep.
+
+    The policy is configured by connection configuration entries:
+    retries, retry (the first delay), retry-backoff, retry-max-delay,
+    retry-jitter, retry-on (list of error classes) and connect-deadline.
+    """
+
+    retry_on = ('refused', 'timeout', 'unreachable', 'reset', 'unavailable')
+
+    def __init__(self, retries=0, delay=0, backoff=1, max_delay=60,
+                 jitter=0, deadline=None, retry_on=None):
+        self.retries = retries
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.deadline = deadline
+        if retry_on is not None:
+            self.retry_on = tuple(retry_on)
+
+
+    @classmethod
+    def from_config(cls, c, connection_type=None):
+        def get(name, convert, default):
+            if not name in c:
+                return default
+            try:
+                return convert(c[name])
+            except (TypeError, ValueError):
+                raise ConnectionConfigError(
+                    "invalid %s value: %s"%(name, c[name]))
+        deadline = get('connect-deadline', float, None)
+        # telnet has always been retried once
+        default_retries = _default_retries.get(connection_type, 0)
+        if deadline is not None and not 'retries' in c:
+            default_retries = None
+        retry_on = c.get('retry-on', None)
+        if isinstance(retry_on, basestring):
+            retry_on = retry_on.replace(',', ' ').split()
+        return cls(retries=get('retries', int, default_retries),
+                   delay=get('retry', float, 0),
+                   backoff=get('retry-backoff', float, 1),
+                   max_delay=get('retry-max-delay', float, 60),
+                   jitter=get('retry-jitter', float, 0),
+                   deadline=deadline,
+                   retry_on=retry_on)
+
+
+    def delays(self):
+        """Generate the delays before each retry."""
+
+        n = 0
+        while self.retries is None or n < self.retries:
+            delay = min(self.delay * self.backoff ** n, self.max_delay)
+            yield delay * (1 - self.jitter * random.random())
+            n += 1
+
+
+    def run(self, connect, logger=None):
+        """Return connect(), retrying failed attempts."""
+
+        if logger is None:
+            logger = dctrl.logger
+        start = monotonic()
+        delays = self.delays()
+        attempt = 1
+        while True:
+            try:
+                return connect()
+            except Exception, e:
+                exc_info = sys.exc_info()
+                error = error_class(e)
+                if not error in self.retry_on:
+                    raise
+                try:
+                    delay = delays.next()
+                except StopIteration:
+                    # out of retries, fail with the connection error
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if self.deadline is not None:
+                    remaining = start + self.deadline - monotonic()
+                    if remaining <= delay:
+                        logger.info("connect deadline of %s s reached",
+                                    self.deadline)
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                logger.info("connect attempt %d failed (%s): %s, "
+                            "retrying in %.1f s", attempt, error, e, delay)
+            time.sleep(delay)
+            attempt += 1
+
+
+def connection_key(connection_config):
+    """Return the identity of the device connection of connection_config:
+    (type, address, port, username)."""
+    c = connection_config
+    return (c.get('type'), c.get('address'), c.get('port'), c.get('username'))
+
+
+class ConnectionPool(object):
+    """Pool of open connections, keyed by connection_key.
+
+    lease() hands out an idle connection of the command group of the
+    current configuration if there is one (a hit), and otherwise opens a
+    new one (a miss).  Before an idle connection is handed out, it is
+    probed with a prompt round trip (pending output is dropped, and an
+    empty line must be answered by the prompt within probe_timeout
+    seconds), and replaced by a new connection if it is dead or busy.  A
+    connection that keeps writing output (more than probe_drain_limit
+    bytes, or for more than probe_timeout seconds) is taken for busy.
+    Probing is skipped if probe_timeout is None.  With probe_all_prompts,
+    any prompt configured for the command group (eg. root-prompt) is
+    accepted, so that a shell left at another prompt (eg. by linux
+    su-prompt) is not taken for dead.  A connection logs to the logfile
+    of the command it is leased to, and that log is closed when the
+    connection is released.  release() returns the connection to the
+    pool, or closes it if it is broken, ie. left in an unknown state (as
+    it is when a command on it timed out).  Connections idle for more
+    than max_idle seconds are closed by evict_idle().
+
+    The counters hits, misses, reconnects and evictions are returned by
+    stats(), together with the number of idle and leased connections."""
+
+    # most pending output dropped before probing a connection
+    probe_drain_limit = 65536
+
+    def __init__(self, max_idle=300, probe_timeout=1,
+                 probe_all_prompts=False):
+        self.max_idle = max_idle
+        self.probe_timeout = probe_timeout
+        self.probe_all_prompts = probe_all_prompts
+        self.idle = {}
+        self.leased = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+        self.evictions = 0
+
+
+    def lease(self, context=None):
+        """Return a connection for the command group of the configuration
+        of context (default: the current context)."""
+
+        import dctrl.context
+        context = dctrl.context.get(context)
+        c = context.config['command']
+        key = connection_key(c['connection'])
+        with self.lock:
+            idle = self.idle.get(key)
+            con = idle and idle.pop()[0]
+            if con is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if con is not None:
+            # possibly left with the settings of another command group
+            con.set_prompt(c['prompt'])
+            con.linesep = c['linesep']
+            con.sendlinesep = c['sendlinesep']
+            prompts = None
+            if self.probe_all_prompts:
+                prompts = [v for k, v in c.items()
+                           if k.endswith('prompt') and
+                           isinstance(v, basestring)]
+            if (self.probe_timeout is not None and
+                not self.probe(con, prompts)):
+                context.logger.info("reconnecting dead connection")
+                self.disconnect(con)
+                con = None
+                with self.lock:
+                    self.reconnects += 1
+            elif hasattr(con, 'set_logfile'):
+                args = context.config['params']
+                con.set_logfile(args.get('logfile', None),
+                                get_logfile_options(args))
+        if con is None:
+            con = connect(c['connection']['type'], context)
+        with self.lock:
+            self.leased[id(con)] = key
+        return con
+
+
+    def release(self, con, broken=False):
+        """Return con to the pool, or close it if broken."""
+
+        if getattr(con, 'timedout', False):
+            # the command may still be running
+            broken = True
+        if not broken and hasattr(con, 'set_logfile'):
+            # completes the log of the command
+            con.set_logfile(None)
+        with self.lock:
+            key = self.leased.pop(id(con))
+            if not broken:
+                self.idle.setdefault(key, []).append((con, monotonic()))
+        if broken:
+            self.disconnect(con)
+
+
+    def probe(self, con, prompts=None):
+        """Return True if con answers an empty line with the prompt, or
+        one of prompts if given (or passes its own probe)."""
+
+        if hasattr(con, 'probe'):
+            return con.probe(self.probe_timeout)
+        if not con.isalive():
+            return False
+        delaybeforesend = getattr(con, 'delaybeforesend', None)
+        try:
+            # no need to wait for the device before an empty line
+            if delaybeforesend:
+                con.delaybeforesend = 0
+            # drop pending output, so that a stale prompt is not taken
+            # for the answer
+            if not self.drain(con):
+                dctrl.logger.debug("connection probe: output does not stop")
+                return False
+            con.sendline('')
+            if prompts is None:
+                prompts = [con.prompt]
+            index = con.expect([pexpect.TIMEOUT] + prompts,
+                               timeout=self.probe_timeout)
+        except Exception:
+            dctrl.logger.debug("connection probe failed", exc_info=True)
+            return False
+        finally:
+            if delaybeforesend:
+                con.delaybeforesend = delaybeforesend
+        if index == 0:
+            return False
+        # only the echo of the empty line, and the start of the prompt
+        # line (when the prompt pattern matches its end), may come before
+        # the prompt
+        echo, sep, line = con.before.rpartition('\n')
+        return not echo.strip()
+
+
+    def drain(self, con):
+        """Drop the output pending on con.  Returns False if con keeps
+        writing output."""
+
+        con.buffer = ''
+        if hasattr(con, '_before'):
+            # pexpect 4.x takes the buffer from there on the next expect
+            con._before = con.buffer_type()
+        deadline = monotonic() + (self.probe_timeout or 0)
+        drained = 0
+        try:
+            while (drained <= self.probe_drain_limit and
+                   monotonic() < deadline):
+                drained += len(con.read_nonblocking(con.maxread, timeout=0))
+        except pexpect.TIMEOUT:
+            return True
+        return False
+
+
+    def evict_idle(self, max_idle=None):
+        """Close connections idle for more than max_idle (default:
+        self.max_idle) seconds."""
+
+        if max_idle is None:
+            max_idle = self.max_idle
+        now = monotonic()
+        evicted = []
+        with self.lock:
+            for key, idle in self.idle.items():
+                keep = [(con, t) for con, t in idle if now - t <= max_idle]
+                evicted += [con for con, t in idle if now - t > max_idle]
+                if keep:
+                    self.idle[key] = keep
+                else:
+                    del self.idle[key]
+            self.evictions += len(evicted)
+        for con in evicted:
+            self.disconnect(con)
+
+
+    def close(self):
+        """Close all idle connections."""
+
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for con, t in connections:
+                self.disconnect(con)
+
+
+    def disconnect(self, con):
+        try:
+            disconnect(con)
+        except Exception:
+            dctrl.logger.debug("disconnect failed", exc_info=True)
+
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'reconnects': self.reconnects,
+                    'evictions': self.evictions,
+                    'idle': sum(len(idle) for idle in self.idle.values()),
+                    'leased': len(self.leased)}
+
+
+def get_logfile_options(args):
+    options = {}
+    if args.get('logfile_max_size', None):
+        options['max_size'] = args['logfile_max_size']
+    if args.get('logfile_backups', None) is not None:
+        options['backups'] = args['logfile_backups']
+    if args.get('logfile_thread', None):
+        options['thread'] = True
+    return options
+
+
+def connect_serial(context):
+    config = context.config
     args = config['params']
     c = config['command']['connection']
     try:
@@ -64,25 +532,25 @@ def connect_serial():
             "invalid baudrate value: %s"%(c['baudrate']))
 
     try:
-        cli = cliexpect.SerialCLI(
+        from dctrl.expect.serialcli import SerialCLI
+        cli = SerialCLI(
             port=port, baudrate=baudrate,
             prompt=config['command']['prompt'],
             linesep=config['command']['linesep'],
             sendlinesep=config['command']['sendlinesep'],
-            verbose=((50 - dctrl.logger.getEffectiveLevel()) / 20),
+            verbose=((50 - context.logger.getEffectiveLevel()) / 20),
             verbose_prefix=args['run'].get_group_name(upper=True) + "> ",
-            logfile=args.get('logfile', None))
+            logfile=args.get('logfile', None),
+            logfile_options=get_logfile_options(args))
     except Exception, e:
-        raise ConnectionError("serial connection to %s failed: %s"%(port, e))
+        raise connection_error(
+            "serial connection to %s failed: %s"%(port, e), e)
     cli.log("dctrl: opened serial port %s connection"%(port))
     return cli
 
 
-def connect_telnet():
-    import socket, time
-
-    import dctrl.config
-    config = dctrl.config.config
+def connect_telnet(context):
+    config = context.config
     args = config['params']
     c = config['command']['connection']
     try:
@@ -97,47 +565,24 @@ def connect_telnet():
         raise ConnectionConfigError(
             "invalid port value: %s"%(c['port']))
     try:
-        retry = float(c['retry'])
-    except KeyError:
-        retry = 0
-    except ValueError:
-        raise ConnectionConfigError(
-            "invalid retry value: %s"%(c['retry']))
-    try:
-        retries = int(c['retries'])
-    except KeyError:
-        retries = 1
-    except ValueError:
-        raise ConnectionConfigError(
-            "invalid retries value: %s"%(c['retries']))
-
-    cli = None
-    for i in range(retries, -1, -1):
-        try:
-            cli = cliexpect.TelnetCLI(
-                address, port,
-                prompt=config['command']['prompt'],
-                linesep=config['command']['linesep'],
-                sendlinesep=config['command']['sendlinesep'],
-                verbose=((50 - dctrl.logger.getEffectiveLevel()) / 20),
-                verbose_prefix=args['run'].get_group_name(upper=True) + "> ",
-                logfile=args.get('logfile', None))
-            break
-        except socket.error, e:
-            if i > 0:
-                time.sleep(retry)
-                continue
-            raise ConnectionError(
-                "telnet connection to %s:%d failed: %s"%(address, port, e))
+        from dctrl.expect.telnetcli import TelnetCLI
+        cli = TelnetCLI(
+            address, port,
+            prompt=config['command']['prompt'],
+            linesep=config['command']['linesep'],
+            sendlinesep=config['command']['sendlinesep'],
+            verbose=((50 - context.logger.getEffectiveLevel()) / 20),
+            verbose_prefix=args['run'].get_group_name(upper=True) + "> ",
+            logfile=args.get('logfile', None),
+            logfile_options=get_logfile_options(args))
+    except Exception, e:
+        raise connection_error(
+            "telnet connection to %s:%d failed: %s"%(address, port, e), e)
     cli.log("dctrl: opened telnet connection to %s:%d"%(address, port))
     return cli
 
 
-def connect_ssh():
-    import dctrl.config
-    config = dctrl.config.config
-    args = config['params']
-    c = config['command']['connection']
+def get_ssh_config(c):
     try:
         address = c['address']
     except KeyError:
@@ -158,27 +603,64 @@ def connect_ssh():
     except ValueError:
         raise ConnectionConfigError(
             "invalid port value: %s"%(c['port']))
+    return (address, username, password, port)
+
+
+def connect_ssh(context):
+    config = context.config
+    args = config['params']
+    c = config['command']['connection']
+    address, username, password, port = get_ssh_config(c)
     try:
-        cli = cliexpect.SshCLI(
+        from dctrl.expect.sshcli import SshCLI
+        cli = SshCLI(
             address, username, password, port, prompt=config['command']['prompt'],
             linesep=config['command']['linesep'],
             sendlinesep=config['command']['sendlinesep'],
-            verbose=((50 - dctrl.logger.getEffectiveLevel()) / 20),
+            verbose=((50 - context.logger.getEffectiveLevel()) / 20),
             verbose_prefix=args['run'].get_group_name(upper=True) + "> ",
-            logfile=args.get('logfile', None))
+            logfile=args.get('logfile', None),
+            logfile_options=get_logfile_options(args))
     except Exception, e:
-        print >> sys.stderr, "dctrl: ssh connection to %s@%s:%d failed: %s"%(
-            username, address, port, e)
-        return None
+        raise connection_error("ssh connection to %s@%s:%d failed: %s"%(
+                username, address, port, e), e)
 
     cli.log("dctrl: opened ssh connection to %s@%s:%d"%(
             username, address, port))
     return cli
 
-def connect_telnet_microcom():
-    import dctrl.config
-    config = dctrl.config.config
-    cli = connect_telnet()
+
+def connect_ssh_exec(context):
+    config = context.config
+    args = config['params']
+    c = config['command']['connection']
+    address, username, password, port = get_ssh_config(c)
+    try:
+        max_channels = int(c.get('max-channels', 8))
+    except ValueError:
+        raise ConnectionConfigError(
+            "invalid max-channels value: %s"%(c['max-channels']))
+    try:
+        from dctrl.expect.sshcli import SshExecCLI
+        cli = SshExecCLI(
+            address, username, password, port, prompt=config['command']['prompt'],
+            verbose=((50 - context.logger.getEffectiveLevel()) / 20),
+            verbose_prefix=args['run'].get_group_name(upper=True) + "> ",
+            logfile=args.get('logfile', None),
+            logfile_options=get_logfile_options(args),
+            max_channels=max_channels)
+    except Exception, e:
+        raise connection_error(
+            "ssh exec connection to %s@%s:%d failed: %s"%(
+                username, address, port, e), e)
+
+    cli.log("dctrl: opened ssh exec connection to %s@%s:%d"%(
+            username, address, port))
+    return cli
+
+def connect_telnet_microcom(context):
+    config = context.config
+    cli = connect_telnet(context)
     try:
         cmd = config['command']['connection']['microcom']
     except:
@@ -198,10 +680,9 @@ def connect_telnet_microcom():
     cli.flush()
     return cli
 
-def connect_ssh_microcom():
-    import dctrl.config
-    config = dctrl.config.config
-    cli = connect_ssh()
+def connect_ssh_microcom(context):
+    config = context.config
+    cli = connect_ssh(context)
     try:
         cmd = config['command']['connection']['microcom']
     except:
@@ -214,9 +695,22 @@ _connection_types = {
     'serial' : connect_serial,
     'telnet' : connect_telnet,
     'ssh'    : connect_ssh,
+    'ssh-exec' : connect_ssh_exec,
     'telnet-microcom' : connect_telnet_microcom,
     'ssh-microcom' : connect_ssh_microcom,
 }
 
+# number of retries when not configured
+_default_retries = {
+    'telnet' : 1,
+    'telnet-microcom' : 1,
+}
 
+# device lock mode when not configured, consoles allow a single user only
+_default_locks = {
+    'serial' : 'exclusive',
+    'telnet-microcom' : 'exclusive',
+    'ssh-microcom' : 'exclusive',
+}
 
+_entry_points_loaded = False
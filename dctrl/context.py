@@ -0,0 +1,85 @@
+#
+# Copyright (C) 2015  Prevas A/S
+#
+# This file is part of dctrl, an embedded device control framework
+#
+# dctrl is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# dctrl is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+"""Execution context of a command run.
+
+A Context holds what a command run needs: the configuration (config,
+with the command line parameters in config['params']), the logger and
+the connection.  dctrl.command.run passes it on to the connect function
+of the connection type, and makes it the current context of the thread
+while the command runs, so that commands can be run by several threads
+at the same time, each with its own configuration.
+
+The dctrl.config.config global refers to the configuration of the
+current context, and to the configuration last loaded by
+dctrl.config.load outside of a command run.
+"""
+
+import threading
+
+import dctrl
+
+
+_local = threading.local()
+
+
+class Context(object):
+
+    def __init__(self, config, logger=None, con=None):
+        self.config = config
+        if logger is None:
+            logger = dctrl.logger
+        self.logger = logger
+        self.con = con
+
+    @property
+    def params(self):
+        return self.config['params']
+
+    def __enter__(self):
+        if not hasattr(_local, 'stack'):
+            _local.stack = []
+        _local.stack.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.stack.pop()
+
+
+def current():
+    """Return the current context of the thread, or None."""
+
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        return stack[-1]
+    return None
+
+
+def get(context=None):
+    """Return context if given, or else the current context, or else a
+    context for the configuration last loaded."""
+
+    if context is not None:
+        return context
+    context = current()
+    if context is not None:
+        return context
+    import dctrl.config
+    return Context(dctrl.config.get_loaded())
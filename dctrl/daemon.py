@@ -0,0 +1,295 @@
+#
+# Copyright (C) 2015  Prevas A/S
+#
+# This file is part of dctrl, an embedded device control framework
+#
+# dctrl is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# dctrl is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+"""dctrl daemon, keeping device connections open between commands.
+
+The daemon (dctrl --daemon) listens on a unix socket for commands from
+dctrl clients (dctrl --client ...).  Commands are run one at a time, on
+connections kept open by the daemon, so only the first command on a
+device pays for opening the connection and logging in.  The connections
+are kept in a dctrl.connection.ConnectionPool, which probes them before
+reuse, reopens dead ones, and closes connections idle for more than
+max_idle seconds.
+
+A request is a line with a JSON object holding the command line
+(argv), working directory (cwd) and environment (env) of the client, and
+the reply is a line with a JSON object holding the exit code, the result
+message and the output of the command.  The command is run in the
+environment of the client, so that env-<name> configuration entries
+refer to it, but the commands (DCTRLPATH) are loaded by the daemon when
+it starts.  The request {"stats": true} returns the connection pool
+statistics as output, and {"stop": true} stops the daemon.
+"""
+
+import os
+import sys
+import socket
+import logging
+import json
+import StringIO
+
+import dctrl
+
+
+class DaemonError(Exception):
+    pass
+
+
+def format_result(ret):
+    """Return the exit code and result line of command result ret."""
+
+    exitcode = ret[0]
+    if exitcode == 0:
+        result = 'PASS'
+    elif exitcode == 1:
+        result = 'FAIL'
+    else:
+        result = 'ERROR'
+    if ret[1]:
+        return exitcode, '%s: %s'%(result, ret[1])
+    return exitcode, result
+
+
+class Daemon(object):
+
+    def __init__(self, parser, socket_path, max_idle=300,
+                 global_options=()):
+        # not imported by the module, to keep the client light
+        import dctrl.config, dctrl.connection, dctrl.command, dctrl.context
+        self.parser = parser
+        self.global_options = global_options
+        # commands are run in the working directory of the client
+        self.socket_path = os.path.abspath(socket_path)
+        self.pool = dctrl.connection.ConnectionPool(max_idle=max_idle)
+        self.sock = None
+
+
+    def serve(self):
+        """Serve requests until stopped."""
+
+        self.listen()
+        logger = dctrl.logger
+        logger.info("dctrl daemon listening on %s", self.socket_path)
+        # wake up now and then to close idle connections
+        self.sock.settimeout(min(self.pool.max_idle, 60))
+        try:
+            while True:
+                try:
+                    client, address = self.sock.accept()
+                except socket.timeout:
+                    self.pool.evict_idle()
+                    continue
+                client.settimeout(None)
+                try:
+                    if not self.handle(client):
+                        break
+                except Exception:
+                    logger.debug("request failed", exc_info=True)
+                finally:
+                    client.close()
+                self.pool.evict_idle()
+        finally:
+            self.close()
+
+
+    def listen(self):
+        if os.path.exists(self.socket_path):
+            # remove socket left behind by a dead daemon
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except socket.error:
+                os.unlink(self.socket_path)
+            else:
+                raise DaemonError("dctrl daemon already running",
+                                  self.socket_path)
+            finally:
+                probe.close()
+        directory = os.path.dirname(self.socket_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.socket_path)
+        os.chmod(self.socket_path, 0600)
+        self.sock.listen(16)
+
+
+    def close(self):
+        self.pool.close()
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+
+    def handle(self, client):
+        """Handle a request from client.  Returns False if the daemon
+        should stop."""
+
+        f = client.makefile('r+b')
+        try:
+            request = json.loads(f.readline())
+            if request.get('stop'):
+                reply = {'exitcode': 0, 'message': 'PASS', 'output': ''}
+                ret = False
+            elif request.get('stats'):
+                reply = {'exitcode': 0, 'message': 'PASS',
+                         'output': json.dumps(self.pool.stats()) + '\n'}
+                ret = True
+            else:
+                # json gives unicode strings, commands expect str
+                argv = [arg.encode('utf-8') for arg in request['argv']]
+                cwd = request['cwd'].encode('utf-8')
+                env = request.get('env')
+                if env is not None:
+                    env = dict((name.encode('utf-8'), value.encode('utf-8'))
+                               for name, value in env.items())
+                try:
+                    reply = self.run(argv, cwd, env)
+                except Exception as e:
+                    dctrl.logger.debug("request failed", exc_info=True)
+                    reply = {'exitcode': 2, 'output': '',
+                             'message': 'ERROR: daemon: %s'%(e)}
+                ret = True
+            f.write(json.dumps(reply) + '\n')
+            f.flush()
+        finally:
+            f.close()
+        return ret
+
+
+    def run(self, argv, cwd, env=None):
+        """Run the command line argv in directory cwd, and environment env
+        (default: the environment of the daemon), capturing its output.
+        Returns the reply."""
+
+        logger = dctrl.logger
+        output = StringIO.StringIO()
+        handler = logging.StreamHandler(output)
+        handler.setLevel(dctrl.logger_console.level)
+        handler.setFormatter(dctrl.logger_console.formatter)
+        logger.addHandler(handler)
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = output
+        environ = dict(os.environ)
+        directory = os.getcwd()
+        try:
+            if env is not None:
+                os.environ.clear()
+                os.environ.update(env)
+            os.chdir(cwd)
+            try:
+                exitcode, message = self.run_command(argv)
+            except SystemExit, e:
+                # argparse error, or --help
+                exitcode = e.code or 0
+                message = None
+        finally:
+            # not keeping the directory of the client busy
+            os.chdir(directory)
+            if env is not None:
+                os.environ.clear()
+                os.environ.update(environ)
+            sys.stdout, sys.stderr = stdout, stderr
+            logger.removeHandler(handler)
+        return {'exitcode': exitcode, 'message': message,
+                'output': output.getvalue()}
+
+
+    def run_command(self, argv):
+        logger = dctrl.logger
+        try:
+            cmd, config = dctrl.command.parse_args(self.parser, argv,
+                                                   self.global_options)
+        except dctrl.config.ConfigError as e:
+            logger.error(': '.join(e.args))
+            return 2, None
+        context = dctrl.context.Context(config, logger)
+
+        try:
+            ret = dctrl.command.run(cmd, pool=self.pool, context=context)
+        except Exception as e:
+            logger.debug("Exception in %s"%(cmd.get_name()), exc_info=True)
+            ret = (2, "%s: Exception: %s"%(cmd.get_name(), e))
+        logger.debug("connection pool: %s", self.pool.stats())
+        return format_result(ret)
+
+
+def request(socket_path, request):
+    """Send request to the daemon listening on socket_path, and return
+    the reply."""
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error, e:
+        sock.close()
+        raise DaemonError("dctrl daemon not running",
+                          "%s: %s"%(socket_path, e))
+    f = sock.makefile('r+b')
+    try:
+        f.write(json.dumps(request) + '\n')
+        f.flush()
+        reply = f.readline()
+    finally:
+        f.close()
+        sock.close()
+    if not reply:
+        raise DaemonError("dctrl daemon closed the connection")
+    return json.loads(reply)
+
+
+def client_environ():
+    """Return the environment of the client, without the variables that
+    cannot be sent (not UTF-8)."""
+
+    env = {}
+    for name, value in os.environ.items():
+        try:
+            name.decode('utf-8')
+            value.decode('utf-8')
+        except UnicodeDecodeError:
+            continue
+        env[name] = value
+    return env
+
+
+def client(socket_path, argv, stop=False, stats=False):
+    """Run command line argv by the daemon listening on socket_path,
+    printing its output and result.  Returns the exit code."""
+
+    if stop:
+        req = {'stop': True}
+    elif stats:
+        req = {'stats': True}
+    else:
+        req = {'argv': argv, 'cwd': os.getcwd(), 'env': client_environ()}
+    try:
+        reply = request(socket_path, req)
+    except DaemonError as e:
+        print >>sys.stderr, '%s: %s'%(dctrl.prog, ': '.join(e.args))
+        return 2
+    sys.stdout.write(reply['output'])
+    if reply['message'] and not (stop or stats):
+        print reply['message']
+    return reply['exitcode']
@@ -0,0 +1,333 @@
+#
+# Copyright (C) 2015 Prevas A/S
+#
+# This file is part of dctrl, an embedded device control framework
+#
+# dctrl is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# dctrl is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+"""Run dtest suites in parallel on a pool of identical devices.
+
+The devices of the DctrlConfigs of the test setup are taken as
+interchangeable, and a DevicePoolSuite runs each DctrlWrapper test on
+whichever device is free, by a worker process per device:
+
+    suite = dctrl.devicepool.DevicePoolSuite(tests)
+    suite.run(result)
+
+Tests are started in the order of the suite, except that a test waiting
+for a busy device does not hold up the tests after it.  A test declares
+what it needs by its test arguments:
+
+    cfg_idx: <n>       run on device n (index in DctrlConfigs) only
+    exclusive: true    run alone, with all other devices idle
+
+Tests that are not DctrlWrapper tests are run by the calling process,
+alone as exclusive tests.  The results are reported to the result of
+the calling process, followed by the number of tests and the time each
+device has been busy (see print_report).
+"""
+
+import sys
+import time
+import Queue
+import multiprocessing
+import traceback
+
+import dctrl
+import dctrl.unittest
+import dtest.testsetup
+
+unittest = __import__('unittest', level=0)
+
+# time.monotonic is not available in python2
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+class DevicePoolError(Exception):
+    pass
+
+
+class RemoteTraceback(Exception):
+    """Failure or error of a test run by a worker process, holding the
+    formatted traceback."""
+
+    def __str__(self):
+        return '\n' + self.args[0]
+
+
+def iter_tests(suite):
+    """Return the tests of suite and the suites in it, in order."""
+
+    if isinstance(suite, unittest.TestSuite):
+        for test in suite:
+            for t in iter_tests(test):
+                yield t
+    else:
+        yield suite
+
+
+def required_device(test):
+    """Return the device test must run on, or None for any device."""
+
+    return getattr(test, 'testargs', {}).get('cfg_idx', None)
+
+
+def is_exclusive(test):
+    """Return True if test must run alone."""
+
+    if not isinstance(test, dctrl.unittest.DctrlWrapper):
+        return True
+    return bool(test.testargs.get('exclusive', False))
+
+
+def outcome(result):
+    """Return the outcome of the test run with result, as a list of
+    (kind, text) that can be passed to another process."""
+
+    ret = []
+    for test, text in result.failures:
+        ret.append(('failure', text))
+    for test, text in result.errors:
+        ret.append(('error', text))
+    for test, reason in result.skipped:
+        ret.append(('skip', reason))
+    for test, text in result.expectedFailures:
+        ret.append(('expected failure', text))
+    for test in result.unexpectedSuccesses:
+        ret.append(('unexpected success', None))
+    if not ret:
+        ret.append(('success', None))
+    return ret
+
+
+def worker(tests, device, tasks, results):
+    """Run the tests (by index) received on tasks on device, and put
+    (index, device, outcome, output, seconds) on results."""
+
+    # connections are not shared with the parent process
+    dctrl.unittest._pool = None
+    try:
+        while True:
+            index = tasks.get()
+            if index is None:
+                break
+            test = tests[index]
+            test.device = device
+            start = monotonic()
+            result = unittest.TestResult()
+            try:
+                test(result)
+            except Exception:
+                result.errors.append((test, traceback.format_exc()))
+            results.put((index, device, outcome(result),
+                         getattr(test, 'output', None),
+                         monotonic() - start))
+    finally:
+        if dctrl.unittest._pool is not None:
+            dctrl.unittest._pool.close()
+
+
+class DevicePoolSuite(unittest.TestSuite):
+    """Suite running its tests on the devices (indexes in DctrlConfigs,
+    default all of them) by a worker process per device."""
+
+    # seconds between checks that the workers are alive
+    poll_interval = 1
+
+    def __init__(self, tests=(), devices=None, out=sys.stdout):
+        unittest.TestSuite.__init__(self, tests)
+        self.configs = getattr(dtest.testsetup.testsetup(), 'DctrlConfigs',
+                               ['conf/dctrl.cfg'])
+        if devices is None:
+            devices = range(len(self.configs))
+        self.devices = list(devices)
+        self.out = out
+        self.busy = {}
+        self.count = {}
+        self.seconds = 0.0
+
+
+    def run(self, result):
+        tests = list(iter_tests(self))
+        self.busy = dict((device, 0.0) for device in self.devices)
+        self.count = dict((device, 0) for device in self.devices)
+        start = monotonic()
+
+        results = multiprocessing.Queue()
+        workers = {}
+        for device in self.devices:
+            tasks = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=worker, args=(tests, device, tasks, results))
+            process.daemon = True
+            process.start()
+            workers[device] = (process, tasks)
+
+        pending = range(len(tests))
+        idle = set(self.devices)
+        running = {}
+        exclusive = False
+        try:
+            while pending or running:
+                if result.shouldStop:
+                    pending = []
+                if not running:
+                    exclusive = False
+                if not exclusive:
+                    exclusive = self.dispatch(tests, pending, idle, running,
+                                              workers, result)
+                if not running:
+                    continue
+                try:
+                    index, device, ret, output, seconds = results.get(
+                        timeout=self.poll_interval)
+                except Queue.Empty:
+                    self.check_workers(tests, idle, running, workers,
+                                       result)
+                    continue
+                del running[device]
+                idle.add(device)
+                exclusive = False
+                self.busy[device] += seconds
+                self.count[device] += 1
+                test = tests[index]
+                if output is not None:
+                    test.output = output
+                self.report(test, ret, result)
+        finally:
+            for process, tasks in workers.values():
+                if process.is_alive():
+                    tasks.put(None)
+            for process, tasks in workers.values():
+                process.join(self.poll_interval)
+                if process.is_alive():
+                    process.terminate()
+            self.seconds = monotonic() - start
+        self.print_report()
+        return result
+
+
+    def dispatch(self, tests, pending, idle, running, workers, result):
+        """Start the pending tests that can run now.  Returns True if an
+        exclusive test was started."""
+
+        for index in list(pending):
+            if result.shouldStop:
+                break
+            test = tests[index]
+            device = required_device(test)
+            if not workers or device is not None and device not in workers:
+                pending.remove(index)
+                self.report_error(test, result, DevicePoolError(
+                        "device %s not in the device pool"%(device)))
+                continue
+            if is_exclusive(test):
+                # tests after an exclusive test wait for it
+                if running:
+                    break
+                pending.remove(index)
+                if not isinstance(test, dctrl.unittest.DctrlWrapper):
+                    test(result)
+                    continue
+                if device is None:
+                    device = min(idle)
+                self.start(index, device, idle, running, workers)
+                return True
+            if device is None:
+                if not idle:
+                    break
+                device = min(idle)
+            elif device not in idle:
+                continue
+            pending.remove(index)
+            self.start(index, device, idle, running, workers)
+        return False
+
+
+    def start(self, index, device, idle, running, workers):
+        idle.remove(device)
+        running[device] = index
+        workers[device][1].put(index)
+
+
+    def check_workers(self, tests, idle, running, workers, result):
+        """Report the tests of dead workers as errors.  The device of a
+        dead worker is not used again."""
+
+        for device, index in running.items():
+            process = workers[device][0]
+            if process.is_alive():
+                continue
+            del running[device]
+            del workers[device]
+            self.report_error(tests[index], result, DevicePoolError(
+                    "worker of device %d died with exit code %s"%(
+                        device, process.exitcode)))
+
+
+    def report(self, test, ret, result):
+        """Report outcome ret of test to result."""
+
+        result.startTest(test)
+        for kind, text in ret:
+            if kind == 'success':
+                result.addSuccess(test)
+            elif kind == 'failure':
+                result.addFailure(test, (RemoteTraceback,
+                                         RemoteTraceback(text), None))
+            elif kind == 'error':
+                result.addError(test, (RemoteTraceback,
+                                       RemoteTraceback(text), None))
+            elif kind == 'skip':
+                result.addSkip(test, text)
+            elif kind == 'expected failure':
+                result.addExpectedFailure(test, (RemoteTraceback,
+                                                 RemoteTraceback(text), None))
+            elif kind == 'unexpected success':
+                result.addUnexpectedSuccess(test)
+        result.stopTest(test)
+
+
+    def report_error(self, test, result, e):
+        result.startTest(test)
+        result.addError(test, (type(e), e, None))
+        result.stopTest(test)
+
+
+    def utilization(self):
+        """Return the fraction of the time of the last run each device
+        has been busy."""
+
+        if not self.seconds:
+            return dict((device, 0.0) for device in self.busy)
+        return dict((device, busy / self.seconds)
+                    for device, busy in self.busy.items())
+
+
+    def print_report(self):
+        utilization = self.utilization()
+        for device in self.devices:
+            print >>self.out, 'device %d (%s): %d tests, busy %.2f s (%d%%)'%(
+                device, self.configs[device], self.count[device],
+                self.busy[device], round(utilization[device] * 100))
+        if utilization:
+            total = sum(utilization.values()) / len(utilization)
+        else:
+            total = 0.0
+        print >>self.out, '%d devices, %d tests in %.2f s, utilization %d%%'%(
+            len(self.devices), sum(self.count.values()), self.seconds,
+            round(total * 100))
+        self.out.flush()
@@ -18,54 +18,156 @@
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 #
 
-import serpexpect, telnetpexpect, sshpexpect, pexpect
-import sys, re
+import pexpect
+import matcher, dispatch
+import sys, os, re, time, random
+import threading, Queue, types
+
+# time.monotonic is not available in python2
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+class Sanitizer(object):
+    """Output sanitizer.
+
+    Folds \\r/\\n runs into a single \\n (crlf), drops ANSI escape
+    sequences (ansiesc) and renders other ASCII control characters as ^X
+    (asciictrl).  The steps use precompiled substitutions, and are
+    skipped when there is nothing for them to do.
+
+    sanitize() translates a complete string.  feed() takes a chunk of a
+    stream and returns it sanitized, holding back input that may be
+    completed by the next chunk (a run of \\r/\\n or an unfinished ANSI
+    escape sequence) until then, or until finish().  The output is the
+    same as sanitize() of the whole stream, unless an escape sequence is
+    longer than maxhold."""
+
+    # longest unfinished escape sequence held back
+    maxhold = 256
+
+    # escape sequences as sanitize() sees them (after crlf), and the
+    # unfinished one at the end of the input
+    _esc_scan = re.compile("(?P<open>\x1b(\\[[^\n@-~]*)?\\Z)|"
+                           "\x1b\\[[^\r\n]*?[@-~]|\x1b[@-_]")
+
+    _crlf = re.compile("\r*\n\r*|\r+")
+    # CSI sequences, else two character (Fe) sequences, in one pass so
+    # that removing a sequence does not make a new one
+    _ansiesc = re.compile("\x1b\\[.*?[@-~]|\x1b[@-_]")
+    _asciictrl = re.compile("[\x00-\x08\x0b-\x1f\x7f]")
+
+    _unctrl = dict((chr(c), '^' + chr(c + 0x40)) for c in range(0x20))
+    _unctrl['\x7f'] = '^?'
+
+    def __init__(self, crlf=True, ansiesc=True, asciictrl=True):
+        self.crlf = crlf
+        self.ansiesc = ansiesc
+        self.asciictrl = asciictrl
+        self.pending = ''
+
+    @classmethod
+    def _replace_asciictrl(cls, match):
+        return cls._unctrl[match.group()]
+
+    def sanitize(self, b):
+        if not b:
+            return b
+        if self.crlf and '\r' in b:
+            b = self._crlf.sub('\n', b)
+        if self.ansiesc and '\x1b' in b:
+            b = self._ansiesc.sub('', b)
+        if self.asciictrl and self._asciictrl.search(b):
+            b = self._asciictrl.sub(self._replace_asciictrl, b)
+        return b
+
+    def feed(self, s):
+        s = self.pending + s
+        cut = len(s.rstrip('\r\n'))
+        # scanned in order, so that the start of a sequence is not taken
+        # for an unfinished one inside a complete sequence
+        esc = None
+        for esc in self._esc_scan.finditer(s, max(0, len(s) - self.maxhold)):
+            pass
+        if esc and esc.group('open') and esc.start() < cut:
+            cut = esc.start()
+        self.pending = s[cut:]
+        return self.sanitize(s[:cut])
+
+    def finish(self):
+        s = self.pending
+        self.pending = ''
+        return self.sanitize(s)
+
 
+_crlf_sanitizer = Sanitizer(ansiesc=False, asciictrl=False)
+_ansiesc_sanitizer = Sanitizer(crlf=False, asciictrl=False)
+_asciictrl_sanitizer = Sanitizer(crlf=False, ansiesc=False)
 
 def fixup_crlf(b):
-    import re
     # sanitize \r\n mess a bit
-    b = re.sub(r"\r*\n\r*", "\n", b)
-    b = re.sub(r"\r+", "\n", b)
-    return b
+    return _crlf_sanitizer.sanitize(b)
 
 def fixup_ansiesc(b):
-    import re
     # drop of ANSI escape code sequences
-    b = re.sub("\x1b\[(.*?[@-~])", "", b)
-    b = re.sub("\x1b([@-_])", "", b)
-    return b
+    return _ansiesc_sanitizer.sanitize(b)
 
 def fixup_asciictrl(b):
-    import re
     # fixup ASCII control characters
-    try:
-        import curses.ascii
-        def unctrl(matchobj):
-            return curses.ascii.unctrl(matchobj.group(0))
-    except ImportError:
-        ctrlcharstr = ("^@", "^A", "^B", "^C", "^D", "^E", "^F", "^G", "^H",
-                       "^I", "^J", "^K", "^L", "^M", "^N", "^O", "^P", "^Q",
-                       "^R", "^S", "^T", "^U", "^V", "^W", "^X", "^Y", "^Z",
-                       "^[", "^\\", "^]", "^^", "^_")
-        def unctrl(matchobj):
-            char = ord(matchobj.group(0))
-            def _unctrl(char):
-                if char < len(ctrlchars):
-                    return ctrlcharstr[char]
-                if char == '\x7f':
-                    return "^?"
-                if char >= 0x80:
-                    return _unctrl(char - 0x80)
-    b = re.sub("[\x00-\x08]|[\x0b-\x1f]|\x7f", unctrl, b)
-    return b
+    return _asciictrl_sanitizer.sanitize(b)
+
+def strip_shell_command(command):
+    """Return shell command line command without a trailing comment,
+    terminating ';' and whitespace, so that more commands can be appended
+    to it.  Quotes and backslash escapes are respected."""
+    quote = None
+    escaped = False
+    separated = True
+    end = len(command)
+    for i, c in enumerate(command):
+        if escaped:
+            escaped = False
+            separated = False
+            continue
+        if c == '\\' and quote != "'":
+            escaped = True
+        elif quote:
+            if c == quote:
+                quote = None
+        elif c in '\'"':
+            quote = c
+        elif c == '#' and separated:
+            end = i
+            break
+        separated = quote is None and c in ' \t;&|()<>'
+    command = command[:end].rstrip()
+    if (command.endswith(';') and not command.endswith(';;') and
+        not command.endswith('\\;')):
+        command = command[:-1].rstrip()
+    return command
 
 class CLILogFile:
+    """Session log, sanitized and written out while the session runs.
+
+    Output is written in chunks of buffer_size, optionally from a
+    background thread.  An error of the background thread (eg. a full
+    disk) is raised by the following write() or close(), and the output
+    after it is dropped.  When max_size is set, the log file is rotated
+    when it grows beyond that, keeping backups old files (FILE.1 ...)."""
 
     closed = True
-    buffer = ""
 
-    def __init__(self, filename, port):
+    # exc_info of the failed write of the background thread
+    error = None
+
+    # sanitized output is written out in chunks of this size
+    buffer_size = 65536
+
+    # chunks queued for the background writer thread
+    queue_size = 16
+
+    def __init__(self, filename, port, max_size=None, backups=1,
+                 thread=False):
+        self.filename = filename
         if filename == "stdout":
             self.file = sys.stdout
         elif filename == "stderr":
@@ -73,6 +175,18 @@ class CLILogFile:
         else:
             self.file = open(filename, "a")
         self.port = port
+        self.max_size = max_size
+        self.backups = backups
+        self.sanitizer = Sanitizer()
+        self.buffer = []
+        self.buffer_len = 0
+        self.started = False
+        self.queue = None
+        if thread:
+            self.queue = Queue.Queue(self.queue_size)
+            self.thread = threading.Thread(target=self._writer)
+            self.thread.daemon = True
+            self.thread.start()
         self.closed = False
         return
 
@@ -82,48 +196,139 @@ class CLILogFile:
         return
 
     def close(self):
-        if self.file in (sys.stdout, sys.stderr):
-            self.file.write(("-- logfile (%s) "%self.port).ljust(79, '-') + "\n")
-        # sanitize \r\n mess a bit
-        b = fixup_crlf(self.buffer)
-        # drop terminating whitespace
-        b = b.rstrip()
-        # drop of ANSI escape code sequences
-        b = fixup_ansiesc(b)
-        # fixup ASCII control characters
-        b = fixup_asciictrl(b)
-        self.file.write(b)
-        if self.file in (sys.stdout, sys.stderr):
-            self.file.write("\n".ljust(80, '-') + "\n")
-        else:
-            self.file.write("\n\n")
-            self.file.close()
-        self.file = None
-        self.buffer = ""
-        self.closed = True
+        if self.closed:
+            return
+        try:
+            self.write_buffer(self.sanitizer.finish(), final=True)
+        finally:
+            if self.queue is not None:
+                self.thread.join()
+            if self.file not in (sys.stdout, sys.stderr):
+                # not closed by a failed final write
+                self.file.close()
+            self.file = None
+            self.buffer = []
+            self.buffer_len = 0
+            self.closed = True
+        self.raise_error()
         return
 
     def write(self, s):
-        self.buffer += s
+        self.write_buffer(self.sanitizer.feed(s))
         return
 
     def flush(self):
         return
 
+    def write_buffer(self, s, final=False):
+        if s:
+            self.buffer.append(s)
+            self.buffer_len += len(s)
+        if not final and self.buffer_len < self.buffer_size:
+            return
+        b = ''.join(self.buffer)
+        # drop terminating whitespace, holding back whitespace that might
+        # be the end of the log
+        stripped = b.rstrip()
+        if final or len(b) - len(stripped) >= self.buffer_size:
+            tail = ''
+        else:
+            tail = b[len(stripped):]
+        if final:
+            b = stripped
+        else:
+            b = b[:len(b) - len(tail)]
+        self.buffer = [tail]
+        self.buffer_len = len(tail)
+        if self.queue is not None:
+            self.queue.put((b, final))
+            if not final:
+                self.raise_error()
+        else:
+            self._write(b, final)
+        return
+
+    def raise_error(self):
+        """Raise the error of the background thread, if it failed."""
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return
+
+    def _writer(self):
+        final = False
+        while not final:
+            b, final = self.queue.get()
+            if self.error is not None:
+                # keep taking chunks, so that write() does not block
+                continue
+            try:
+                self._write(b, final)
+            except Exception:
+                self.error = sys.exc_info()
+        return
+
+    def _write(self, b, final=False):
+        stdio = self.file in (sys.stdout, sys.stderr)
+        if not self.started:
+            if stdio:
+                self.file.write(("-- logfile (%s) "%self.port).ljust(79, '-') + "\n")
+            self.started = True
+        self.file.write(b)
+        if final:
+            if stdio:
+                self.file.write("\n".ljust(80, '-') + "\n")
+            else:
+                self.file.write("\n\n")
+                self.file.close()
+            return
+        self.file.flush()
+        if self.max_size and not stdio and self.file.tell() >= self.max_size:
+            self.rotate()
+        return
+
+    def rotate(self):
+        self.file.close()
+        if self.backups > 0:
+            for i in range(self.backups - 1, 0, -1):
+                name = "%s.%d"%(self.filename, i)
+                if os.path.exists(name):
+                    os.rename(name, "%s.%d"%(self.filename, i + 1))
+            os.rename(self.filename, self.filename + ".1")
+            self.file = open(self.filename, "a")
+        else:
+            self.file = open(self.filename, "w")
+        return
+
 class BaseCLI:
 
     output = None
+    outputs = None
+    exitcode = None
+    exitcodes = None
+    exitcode_checked = False
+    deadline = None
+
+    # longest command line runcommands will send in one go, 0 to send one
+    # command at a time
+    max_batch_length = 1024
+
+    # length of the end of the command line that is matched when the echo
+    # is not matched exactly
+    echo_tail_length = 16
 
     def __init__ (self, prompt='# ', linesep='\n', sendlinesep='\n',
-                  verbose=False, logfile=None, port=''):
+                  verbose=False, logfile=None, port='', logfile_options={}):
 
         self.prompt = prompt
         self.linesep = linesep
         self.sendlinesep = sendlinesep
         self.consume_command_echo = 0
+        self.check_exitcode = False
+        # set when a command timed out, and may still be running
+        self.timedout = False
         self.verbose = verbose > 1
         if logfile:
-            self.logfile = CLILogFile(logfile, port)
+            self.logfile = CLILogFile(logfile, port, **logfile_options)
             self.info("opened logfile %s"%logfile)
         return
 
@@ -137,11 +342,109 @@ class BaseCLI:
         return
 
 
+    def set_logfile(self, logfile, logfile_options={}):
+        """Log to logfile (None for no logging) from now on, closing the
+        current logfile, eg. when the connection is reused by a command
+        logging elsewhere."""
+        current = getattr(self, 'logfile', None)
+        port = ''
+        if isinstance(current, CLILogFile):
+            if current.filename == logfile:
+                return
+            port = current.port
+            current.close()
+        self.logfile = None
+        if logfile:
+            self.logfile = CLILogFile(logfile, port, **logfile_options)
+            self.info("opened logfile %s"%logfile)
+        return
+
+
     def set_consume_command_echo(self, timeout):
         self.consume_command_echo = timeout
         return
 
 
+    def set_check_exitcode(self, enable):
+        """Make runcommand capture the exit code of commands in-band by
+        default (see runcommand checkExitcode argument)."""
+        self.check_exitcode = enable
+        return
+
+
+    def set_max_batch_length(self, length):
+        """Limit the length of command lines sent by runcommands.  Use a
+        small value (or 0 for one command at a time) for devices with
+        small input buffers."""
+        self.max_batch_length = length
+        return
+
+
+    def echo_tail_pattern(self, command):
+        """Return a regular expression matching the echo of the last
+        echo_tail_length characters of command, also when the tty breaks
+        the line or moves the cursor between any two of them."""
+        wrap = r'(?:[ \r\n]|\x1b\[[0-9;?]*[A-Za-z])*'
+        return wrap.join(re.escape(c)
+                         for c in command[-self.echo_tail_length:])
+
+
+    def exitcode_sentinel(self, command):
+        """Wrap command so that its exit code is printed behind a unique
+        marker when it completes.  Returns the wrapped command and a regex
+        matching the marker line, with the exit code as first group.  The
+        marker is quoted in two halves, so that the echoed command line
+        does not match."""
+        marker = "DCTRL%08x"%(random.getrandbits(32))
+        # a trailing comment would hide the marker, and a trailing ';'
+        # make ';;'
+        command = strip_shell_command(command)
+        if not command:
+            # empty (or comment) line, ';' would be a syntax error
+            separator = ''
+        elif command.endswith('&'):
+            # background job, ';' would be a syntax error
+            separator = ' '
+        else:
+            separator = '; '
+        command = '%s%secho "%s""%s:$?"'%(
+            command, separator, marker[:5], marker[5:])
+        return command, re.compile(r"%s:(\d+)[\r\n]*"%(marker))
+
+
+    def parse_exitcode(self, s, sentinel):
+        """Set self.exitcode from the exit code marker in s, and return s
+        with the marker line removed."""
+        match = sentinel.search(s)
+        if match is None:
+            return s
+        self.exitcode = int(match.group(1))
+        return s[:match.start()] + s[match.end():]
+
+
+    def set_deadline(self, timeout=-1):
+        """Start a new timeout budget of timeout seconds (-1 means the
+        default timeout, None means no limit)."""
+        if timeout == -1:
+            timeout = self.timeout
+        if timeout is None:
+            self.deadline = None
+        else:
+            self.deadline = monotonic() + timeout
+        return
+
+
+    def remaining_timeout(self, timeout=None):
+        """Return the time left of the current timeout budget, limited to
+        timeout if given.  Returns timeout if no budget is running."""
+        if self.deadline is None:
+            return timeout
+        remaining = max(self.deadline - monotonic(), 0)
+        if timeout is not None and timeout >= 0 and timeout < remaining:
+            return timeout
+        return remaining
+
+
     def log(self, s, append="\n"):
         if self.logfile:
             self.logfile.write(s + append)
@@ -157,6 +460,29 @@ class BaseCLI:
         print >> sys.stderr, "dctrl: error: " + s + append,
 
 
+    def expect(self, pattern, timeout=-1, searchwindowsize=-1):
+        """Like pexpect expect, but matching all patterns in one pass and
+        only rescanning as much of the already received output as a match
+        can span (see matcher.searcher_stream), so that matching cost
+        stays linear in the output size.  The compiled patterns are cached
+        between calls."""
+        if timeout == -1:
+            timeout = self.timeout
+        pattern_set = matcher.compile_pattern_set(pattern)
+        return self.expect_loop(matcher.searcher_stream(pattern_set),
+                                timeout, searchwindowsize)
+
+
+    def expect_exact(self, pattern, timeout=-1, searchwindowsize=-1):
+        """Like pexpect expect_exact, but matching all strings in one pass
+        (see expect)."""
+        if timeout == -1:
+            timeout = self.timeout
+        pattern_set = matcher.compile_pattern_set(pattern, exact=True)
+        return self.expect_loop(matcher.searcher_stream(pattern_set),
+                                timeout, searchwindowsize)
+
+
     def expectprompt(self, prompt=None, timeout=-1):
 
         if prompt == None:
@@ -183,8 +509,32 @@ class BaseCLI:
 
 
     def runcommand(self, command, pattern=[], prompt=None, waitForPrompt=True,
-                   timeout=-1, returnbool=True, expectNoOutput=False, cmdOutputFile=None):
-        """Run a command, wait for it to ....  PRECONDITION: target is at prompt, ie. ready to accept commands.  Returns (command_completed, pattern_found, output)"""
+                   timeout=-1, returnbool=True, expectNoOutput=False, cmdOutputFile=None,
+                   checkExitcode=None, exactEcho=None):
+        """Run a command, wait for it to ....  PRECONDITION: target is at prompt, ie. ready to accept commands.  Returns (command_completed, pattern_found, output)
+
+        With checkExitcode (default: see set_check_exitcode) the exit code
+        of the command is printed in the same round trip and stored in
+        self.exitcode (None if it was not seen), and self.exitcode_checked
+        is set.
+
+        When consuming the command echo (see set_consume_command_echo),
+        exactEcho requires the echo to be the command line as sent.
+        Otherwise only the end of the echo must match (see
+        echo_tail_pattern), which allows for lines wrapped or scrolled by
+        the tty.  The default is exact unless the exit code is checked, as
+        the exit code marker makes the line longer."""
+        return dispatch.run(self, self.runcommand_steps(
+                command, pattern, prompt, waitForPrompt, timeout, returnbool,
+                expectNoOutput, cmdOutputFile, checkExitcode, exactEcho))
+
+
+    def runcommand_steps(self, command, pattern=[], prompt=None,
+                         waitForPrompt=True, timeout=-1, returnbool=True,
+                         expectNoOutput=False, cmdOutputFile=None,
+                         checkExitcode=None, exactEcho=None):
+        """runcommand as a coroutine (see dispatch), for running commands
+        on many connections at once with a dispatch.Dispatcher."""
         if self.verbose > 1:
             print self.verbose_prefix + command
 
@@ -193,10 +543,23 @@ class BaseCLI:
             self.info("opened cmd output file %s"%cmdOutputFile)
 
         self.output = None
+        self.exitcode = None
 
         if prompt == None:
             prompt = self.prompt
 
+        if checkExitcode is None:
+            checkExitcode = self.check_exitcode
+        sentinel = None
+        if checkExitcode and waitForPrompt:
+            command, sentinel = self.exitcode_sentinel(command)
+        self.exitcode_checked = sentinel is not None
+        if exactEcho is None:
+            exactEcho = sentinel is None
+
+        # all phases below share a single timeout budget
+        self.set_deadline(timeout)
+
         if not isinstance(pattern, list):
             if pattern:
                 pattern = [pattern]
@@ -209,21 +572,35 @@ class BaseCLI:
         if self.consume_command_echo:
             self.logfile.write("cliexpect.py: consuming command echo. self.before: '%s' self.after: %s"%(self.before,self.after))
             try:
-                self.expect_exact(command, self.consume_command_echo)
+                if exactEcho:
+                    echo = dispatch.Expect(
+                        command,
+                        self.remaining_timeout(self.consume_command_echo),
+                        exact=True)
+                else:
+                    echo = dispatch.Expect(
+                        self.echo_tail_pattern(command),
+                        self.remaining_timeout(self.consume_command_echo))
+                yield echo
             except pexpect.TIMEOUT, e:
                 print >>sys.stderr, "error: timeout 1 waiting for command echo"
-                return False
+                self.timedout = True
+                raise dispatch.Return(False)
             try:
-                self.expect_exact(self.linesep, self.consume_command_echo)
+                yield dispatch.Expect(
+                    self.linesep,
+                    self.remaining_timeout(self.consume_command_echo),
+                    exact=True)
             except pexpect.TIMEOUT, e:
                 print >>sys.stderr, "error: timeout 2 waiting for command echo"
-                return False
-            if not self.before == "\r" * len(self.before):
+                self.timedout = True
+                raise dispatch.Return(False)
+            if exactEcho and not self.before == "\r" * len(self.before):
                 print >>sys.stderr, "error: bad command echo, expected '\r' got: '"+self.before+"'"
 
 
         if not waitForPrompt and not pattern:
-            return True
+            raise dispatch.Return(True)
 
         self.logfile.write("cliexpect.py: self.output before pattern match: %s\n"%(self.output))
         # look for pattern, prompt (if waitForPrompt) or timeout
@@ -231,15 +608,18 @@ class BaseCLI:
         _pattern.append(pexpect.TIMEOUT)
         if waitForPrompt:
             _pattern.append(prompt)
-        index = self.expect(_pattern, timeout)
+        index = yield dispatch.Expect(_pattern, self.remaining_timeout())
         self.pmatch = None
         self.output = self.before
+        if sentinel and index == (len(pattern) + 1):
+            self.output = self.parse_exitcode(self.output, sentinel)
         self.logfile.write("cliexpect.py: self.output after pattern match: %s\n"%(self.output))
 
         # timeout
         if index == len(pattern):
             self.logfile.write("cliexpect.py: Timeout in matching prompt '%s' or pattern '%s'. Timeout is %s\n"%(prompt,pattern[:], timeout))
-            return None
+            self.timedout = True
+            raise dispatch.Return(None)
 
         # matched prompt
         if index == (len(pattern) + 1):
@@ -247,24 +627,22 @@ class BaseCLI:
             # command completed, without a pattern match
             if pattern:
                 self.logfile.write("cliexpect.py: Failed to match pattern '%s' prior to getting the prompt '%s'\n"%(pattern[:],prompt))
-                return False
+                raise dispatch.Return(False)
 
             # command completed with no pattern to look for, so all is good
             else:
                 def strip(s):
-                    import re
                     # drop of ANSI escape code sequences
-                    s = re.sub("\x1b\[(.*?[@-~])", "", s)
-                    s = re.sub("\x1b([@-_])", "", s)
+                    s = fixup_ansiesc(s)
                     # drop terminating whitespace
                     s = s.strip()
                     # hrmpf, we even have to remove all linefeeds
                     s = s.translate(None, "\r\n")
                     return s
-                if expectNoOutput and strip(self.before):
-                    self.logfile.write("cliexpect.py: Expected NoOutput but got '%s'\n"%(strip(self.before)))
-                    return False
-                return True
+                if expectNoOutput and strip(self.output):
+                    self.logfile.write("cliexpect.py: Expected NoOutput but got '%s'\n"%(strip(self.output)))
+                    raise dispatch.Return(False)
+                raise dispatch.Return(True)
 
         # a pattern matched
         self.pmatch = self.after
@@ -272,84 +650,133 @@ class BaseCLI:
 
         # don't wait for command to complete...
         if not waitForPrompt:
-            return returnbool or index
-
-        # FIXME: adjust timeout, subtracting time already spent waiting
+            raise dispatch.Return(returnbool or index)
 
         # wait for command to complete or timeout
-        index2 = self.expect([pexpect.TIMEOUT, prompt], timeout)
+        index2 = yield dispatch.Expect([pexpect.TIMEOUT, prompt],
+                                       self.remaining_timeout())
         self.output += self.before
+        if sentinel and index2 == 1:
+            self.output = self.parse_exitcode(self.output, sentinel)
 
         # timeout
         if index2 == 0:
             self.logfile.write("Error (cliexpect.py): Timeout in getting a prompt after running the command (timeout is %s\n"%(timeout))
-            return None
+            self.timedout = True
+            raise dispatch.Return(None)
 
         # command completed
-        return returnbool or index
-
-
-class SerialCLI(BaseCLI, serpexpect.serspawn):
-
-
-    def __init__ (self, port='/dev/ttyS0', baudrate=115200,
-                  prompt='# ', linesep="\r\n", sendlinesep="\r\n",
-                  verbose=False, verbose_prefix="SER> ",
-                  logfile=None):
-
-        serpexpect.serspawn.__init__(self, port, baudrate)
-        self.verbose_prefix = verbose_prefix
-        BaseCLI.__init__(self, prompt, linesep=linesep, sendlinesep=sendlinesep,
-                         verbose=verbose, logfile=logfile, port=port)
-        return
-
-
-    def flushinput(self):
-
-        self.flushInput()
-        return
-
-
-class TelnetCLI(BaseCLI, telnetpexpect.telnetspawn):
-
-
-    def __init__ (self, host, port=23,
-                  prompt="# ", linesep="\r\n", sendlinesep="\r\n",
-                  verbose=False, verbose_prefix="Telnet> ", logfile=None):
-
-        telnetpexpect.telnetspawn.__init__(self, host, port,
-                                           sendlinesep=sendlinesep)
-        self.verbose_prefix = verbose_prefix
-        BaseCLI.__init__(self, prompt, linesep=linesep, sendlinesep=sendlinesep,
-                         verbose=verbose, logfile=logfile,
-                         port="%s:%s"%(host, port))
-        return
-
-
-    def flushinput(self):
-
-        self.flush()
-        return
-
-
-class SshCLI(BaseCLI, sshpexpect.sshspawn):
-
-
-    def __init__ (self, host, username, password, port=23,
-                  prompt="# ", linesep="\r\n", sendlinesep="\r\n",
-                  verbose=False, verbose_prefix="SSH> ", logfile=None):
-
-        sshpexpect.sshspawn.__init__(self, host, username, password, port)
-        self.verbose_prefix = verbose_prefix
-        BaseCLI.__init__(self, prompt, linesep=linesep, sendlinesep=sendlinesep,
-                         verbose=verbose, logfile=logfile,
-                         port="%s@%s:%s"%(username, host, port))
-
-        class PromptError(Exception):
-            pass
-
-        # Expect the prompt => ignoring the initial text send by the ssh connection
-        if not BaseCLI.expectprompt(self, timeout=5):
-            raise PromptError ("Failed to get a prompt '%s' within 5 s."%(self.prompt))
-
-        return
+        raise dispatch.Return(returnbool or index)
+
+
+    def runparallel(self, commands, prompt=None, timeout=-1):
+        """Run a list of independent commands, like runcommands.  A shell
+        runs them one after the other, but connections that can run
+        commands at the same time (SshExecCLI) do so."""
+        return self.runcommands(commands, prompt, timeout)
+
+
+    def runcommands(self, commands, prompt=None, timeout=-1):
+        """Run a list of commands, sending as many of them as
+        max_batch_length allows on a single command line, separated by
+        exit code markers, so that they complete in one prompt round trip.
+        The output and exit code of each command is stored in self.outputs
+        and self.exitcodes (None for commands that did not complete).
+        timeout applies to the whole list.  Returns True if all commands
+        completed, None on timeout and False otherwise."""
+        return dispatch.run(self, self.runcommands_steps(commands, prompt,
+                                                         timeout))
+
+
+    def runcommands_steps(self, commands, prompt=None, timeout=-1):
+        """runcommands as a coroutine (see dispatch)."""
+
+        if timeout == -1:
+            timeout = self.timeout
+        if timeout is not None:
+            deadline = monotonic() + timeout
+
+        # split commands into batches fitting into max_batch_length
+        batches = []
+        for command in commands:
+            command, sentinel = self.exitcode_sentinel(command)
+            if (batches and
+                len(batches[-1][0]) + 2 + len(command) <= self.max_batch_length):
+                batches[-1][0] += '; ' + command
+                batches[-1][1].append(sentinel)
+            else:
+                batches.append([command, [sentinel]])
+
+        self.outputs = []
+        self.exitcodes = []
+        ret = True
+        for line, sentinels in batches:
+            if not ret:
+                self.outputs += [''] * len(sentinels)
+                self.exitcodes += [None] * len(sentinels)
+                continue
+            if timeout is not None:
+                timeout = max(deadline - monotonic(), 0)
+            # the output is delimited by the exit code markers, so the
+            # echo of the (long) line need not be matched exactly
+            ret = yield self.runcommand_steps(line, prompt=prompt,
+                                              timeout=timeout,
+                                              checkExitcode=False,
+                                              exactEcho=False)
+            # demultiplex output and exit codes of the batch
+            output = self.output or ''
+            for sentinel in sentinels:
+                match = sentinel.search(output)
+                if match is None:
+                    self.outputs.append(output)
+                    self.exitcodes.append(None)
+                    output = ''
+                    continue
+                self.outputs.append(output[:match.start()])
+                self.exitcodes.append(int(match.group(1)))
+                output = output[match.end():]
+
+        self.output = ''.join(self.outputs)
+        if self.exitcodes:
+            self.exitcode = self.exitcodes[-1]
+            self.exitcode_checked = True
+        if ret and None in self.exitcodes:
+            raise dispatch.Return(False)
+        raise dispatch.Return(ret)
+
+
+# The transport CLIs have moved to modules of their own, so that importing
+# cliexpect does not import pyserial and paramiko.  Their names are still
+# resolved here, on first use.
+_moved = {'SerialCLI': 'serialcli', 'TelnetCLI': 'telnetcli',
+          'SshCLI': 'sshcli', 'SshExecCLI': 'sshcli'}
+
+class _CompatModule(types.ModuleType):
+    """The cliexpect module, importing the moved transport CLIs when they
+    are looked up (python2 has no module __getattr__)."""
+
+    def __init__(self, module):
+        types.ModuleType.__init__(self, module.__name__, module.__doc__)
+        self.__dict__.update(module.__dict__)
+        # the functions of the module use the globals of the original
+        self.__dict__['_module'] = module
+
+    def __getattr__(self, name):
+        if name not in _moved:
+            raise AttributeError("'module' object has no attribute '%s'"%(
+                    name))
+        module = __import__('dctrl.expect.' + _moved[name],
+                            fromlist=[name])
+        value = getattr(module, name)
+        setattr(self, name, value)
+        return value
+
+    def __setattr__(self, name, value):
+        types.ModuleType.__setattr__(self, name, value)
+        setattr(self._module, name, value)
+
+    def __delattr__(self, name):
+        types.ModuleType.__delattr__(self, name)
+        delattr(self._module, name)
+
+sys.modules[__name__] = _CompatModule(sys.modules[__name__])
@@ -0,0 +1,439 @@
+#
+# Copyright (C) 2015 Prevas A/S
+#
+# This file is part of dctrl, an embedded device control framework
+#
+# dctrl is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# dctrl is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+"""Event driven execution of CLI operations on many connections.
+
+The BaseCLI operations that wait for output (runcommand, runcommands,
+...) are written as generator based coroutines.  A coroutine yields an
+Expect request whenever it has to wait for output, and gets the index of
+the matching pattern sent back (or the pexpect exception thrown in).  A
+coroutine may also yield another coroutine, which is then run to
+completion, and its result sent back.  Results are returned by raising
+Return.
+
+The blocking BaseCLI methods simply run the coroutine with run(), which
+waits for each request with the normal pexpect expect.  A Dispatcher
+runs coroutines on any number of connections from a single thread,
+waiting for all of them with one poll() call, so that hundreds of
+consoles can be driven at once without a thread per console.
+
+    dispatcher = Dispatcher()
+    for con in connections:
+        dispatcher.add(con, con.runcommand_steps('uname -a'))
+    dispatcher.run()
+"""
+
+import pexpect
+import matcher
+import types
+import time
+import select
+import errno
+
+# time.monotonic is not available in python2
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+class SpawnExpecter(object):
+    """The part of the pexpect 4.x Expecter used by Dispatcher, for
+    pexpect 3.x which does all of it in spawn.expect_loop."""
+
+    def __init__(self, spawn, searcher, searchwindowsize=-1):
+        self.spawn = spawn
+        self.searcher = searcher
+        if searchwindowsize == -1:
+            searchwindowsize = spawn.searchwindowsize
+        self.searchwindowsize = searchwindowsize
+
+    def existing_data(self):
+        return self._search(len(self.spawn.buffer))
+
+    def new_data(self, data):
+        self.spawn.buffer += data
+        return self._search(len(data))
+
+    def _search(self, freshlen):
+        spawn = self.spawn
+        incoming = spawn.buffer
+        index = self.searcher.search(incoming, freshlen,
+                                     self.searchwindowsize)
+        if index < 0:
+            return None
+        spawn.buffer = incoming[self.searcher.end:]
+        spawn.before = incoming[:self.searcher.start]
+        spawn.after = incoming[self.searcher.start:self.searcher.end]
+        spawn.match = self.searcher.match
+        spawn.match_index = index
+        return index
+
+    def eof(self, err=None):
+        spawn = self.spawn
+        spawn.before = spawn.buffer
+        spawn.buffer = ''
+        spawn.after = pexpect.EOF
+        return self._outcome(pexpect.EOF, self.searcher.eof_index, err)
+
+    def timeout(self, err=None):
+        spawn = self.spawn
+        spawn.before = spawn.buffer
+        spawn.after = pexpect.TIMEOUT
+        return self._outcome(pexpect.TIMEOUT, self.searcher.timeout_index,
+                             err)
+
+    def _outcome(self, exc, index, err):
+        spawn = self.spawn
+        if index >= 0:
+            spawn.match = exc
+            spawn.match_index = index
+            return index
+        spawn.match = None
+        spawn.match_index = None
+        msg = str(spawn) + '\nsearcher: %s'%(self.searcher)
+        if err is not None:
+            msg = str(err) + '\n' + msg
+        raise exc(msg)
+
+    def errored(self):
+        spawn = self.spawn
+        spawn.before = spawn.buffer
+        spawn.after = None
+        spawn.match = None
+        spawn.match_index = None
+
+
+try:
+    from pexpect.expect import Expecter
+except ImportError:
+    # pexpect 3.x
+    Expecter = SpawnExpecter
+
+
+class Return(Exception):
+    """Raised by a coroutine to return a value."""
+
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+class Expect(object):
+    """Request to wait for one of pattern (like BaseCLI.expect, or
+    expect_exact if exact is set) for at most timeout seconds (-1 means
+    the default timeout of the connection, None means no limit)."""
+
+    def __init__(self, pattern, timeout=-1, exact=False):
+        self.pattern = pattern
+        self.timeout = timeout
+        self.exact = exact
+
+    def __repr__(self):
+        return 'Expect(%r, %r, exact=%r)'%(self.pattern, self.timeout,
+                                           self.exact)
+
+
+class Task(object):
+    """A coroutine, and the coroutines it is currently waiting for.
+
+    step() advances the coroutine to the next Expect request.  When the
+    coroutine has finished, done is set, and value holds its result (or
+    error the exception it raised)."""
+
+    def __init__(self, steps, con=None, callback=None):
+        self.stack = [steps]
+        self.con = con
+        self.callback = callback
+        self.request = None
+        self.done = False
+        self.value = None
+        self.error = None
+
+    def step(self, value=None, error=None):
+        """Send value (or throw error) into the coroutine, and return the
+        next Expect request, or None when the coroutine has finished."""
+
+        while self.stack:
+            steps = self.stack[-1]
+            try:
+                if error is not None:
+                    # cleared first, as the coroutine may handle the
+                    # error and finish
+                    error, e = None, error
+                    request = steps.throw(e)
+                else:
+                    request = steps.send(value)
+            except Return, r:
+                self.stack.pop()
+                value = r.value
+                continue
+            except StopIteration:
+                self.stack.pop()
+                value = None
+                continue
+            except Exception, e:
+                self.stack.pop()
+                if not self.stack:
+                    self.done = True
+                    self.error = e
+                    raise
+                error = e
+                continue
+            if isinstance(request, types.GeneratorType):
+                self.stack.append(request)
+                value = None
+                continue
+            self.request = request
+            return request
+
+        self.request = None
+        self.done = True
+        self.value = value
+        return None
+
+
+def run(con, steps):
+    """Run coroutine steps on con, blocking in con.expect (or
+    con.expect_exact) for each request, and return its result."""
+
+    task = Task(steps, con)
+    request = task.step()
+    while request is not None:
+        try:
+            if request.exact:
+                index = con.expect_exact(request.pattern, request.timeout)
+            else:
+                index = con.expect(request.pattern, request.timeout)
+        except pexpect.ExceptionPexpect, e:
+            request = task.step(error=e)
+            continue
+        request = task.step(index)
+    return task.value
+
+
+class Dispatcher(object):
+    """Run coroutines on many connections at once.
+
+    Each connection must only have one coroutine added at a time.  Input
+    is read with read_nonblocking when poll() reports the file descriptor
+    of the connection (con.fileno()) readable, and matched with the same
+    pexpect Expecter as the blocking expect.  Connections without a file
+    descriptor are polled every poll_interval seconds.
+
+    The connections delaybeforesend is replaced by delaybeforesend of
+    the dispatcher (default 0) while a coroutine runs, as a sleep holds
+    up all the other connections."""
+
+    poll_interval = 0.1
+    delaybeforesend = 0
+
+    def __init__(self):
+        self.tasks = []
+        self.waiting = {}
+        self.fresh = []
+        self.finished = []
+
+
+    def add(self, con, steps, callback=None):
+        """Add coroutine steps to be run on con.  callback (if given) is
+        called with the Task when it has finished.  Returns the Task."""
+
+        task = Task(steps, con, callback)
+        self.tasks.append(task)
+        return task
+
+
+    def run(self, timeout=None):
+        """Run all added coroutines until they have finished, or until
+        timeout seconds have passed.  Returns the list of tasks finished,
+        in the order they finished.  Unfinished tasks are continued by the
+        next call."""
+
+        if timeout is not None:
+            deadline = monotonic() + timeout
+        self.finished = []
+        tasks, self.tasks = self.tasks, []
+        for task in tasks:
+            self._advance(task)
+
+        poller = select.poll()
+        registered = set()
+        while self.waiting:
+
+            # input may be buffered by the connection already
+            while self.fresh:
+                task = self.fresh.pop()
+                if task in self.waiting:
+                    self._read(task)
+
+            # finish requests that have timed out
+            now = monotonic()
+            wait = None
+            for task, (expecter, end_time) in self.waiting.items():
+                if end_time is None:
+                    continue
+                if end_time <= now:
+                    del self.waiting[task]
+                    self._finish(task, expecter.timeout)
+                elif wait is None or end_time - now < wait:
+                    wait = end_time - now
+            if self.fresh:
+                continue
+            if not self.waiting:
+                break
+            if timeout is not None:
+                if now >= deadline:
+                    break
+                if wait is None or wait > deadline - now:
+                    wait = deadline - now
+
+            # wait for any of the connections to become readable
+            fds = {}
+            nofd = []
+            for task in self.waiting:
+                fd = self._fileno(task.con)
+                if fd is None:
+                    nofd.append(task)
+                else:
+                    fds[fd] = task
+            for fd in registered - set(fds):
+                poller.unregister(fd)
+                registered.remove(fd)
+            for fd in set(fds) - registered:
+                poller.register(fd, select.POLLIN | select.POLLPRI)
+                registered.add(fd)
+            if nofd and (wait is None or wait > self.poll_interval):
+                wait = self.poll_interval
+            if wait is not None:
+                # poll() takes milliseconds, round up to not spin
+                wait = int(wait * 1000) + 1
+            try:
+                events = poller.poll(wait)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for task in [fds[fd] for fd, event in events] + nofd:
+                if task in self.waiting:
+                    self._read(task)
+
+        return self.finished
+
+
+    def _fileno(self, con):
+        try:
+            fd = con.fileno()
+        except (AttributeError, NotImplementedError, ValueError):
+            return None
+        if fd is None or fd < 0:
+            return None
+        return fd
+
+
+    def _advance(self, task, value=None, error=None):
+        """Resume task with value (or error) until it waits for input that
+        has not been received yet, or finishes."""
+
+        con = task.con
+        while True:
+            delaybeforesend = con.delaybeforesend
+            con.delaybeforesend = self.delaybeforesend
+            try:
+                request = task.step(value, error)
+            except Exception:
+                # stored in task.error
+                request = None
+            finally:
+                con.delaybeforesend = delaybeforesend
+            if request is None:
+                self.finished.append(task)
+                if task.callback:
+                    task.callback(task)
+                return
+            value, error = self._wait(task, request)
+            if value is None and error is None:
+                return
+
+
+    def _wait(self, task, request):
+        """Start waiting for request.  Returns (index, None) or
+        (None, error) if the request is already completed by the
+        input buffered by pexpect, and (None, None) otherwise."""
+
+        con = task.con
+        if request.exact:
+            pattern_set = matcher.compile_pattern_set(request.pattern,
+                                                      exact=True)
+        else:
+            pattern_set = matcher.compile_pattern_set(request.pattern)
+        expecter = Expecter(con, matcher.searcher_stream(pattern_set),
+                            -1)
+        try:
+            index = expecter.existing_data()
+        except pexpect.ExceptionPexpect, e:
+            return (None, e)
+        if index is not None:
+            return (index, None)
+
+        timeout = request.timeout
+        if timeout == -1:
+            timeout = con.timeout
+        if timeout is None:
+            end_time = None
+        else:
+            end_time = monotonic() + timeout
+        self.waiting[task] = (expecter, end_time)
+        self.fresh.append(task)
+        return (None, None)
+
+
+    def _read(self, task):
+        """Read the input available on the connection of task, and resume
+        the task if that completes its request."""
+
+        expecter = self.waiting[task][0]
+        con = task.con
+        try:
+            data = con.read_nonblocking(con.maxread, 0)
+        except pexpect.TIMEOUT:
+            return
+        except pexpect.EOF, e:
+            del self.waiting[task]
+            self._finish(task, expecter.eof, e)
+            return
+        except Exception, e:
+            expecter.errored()
+            del self.waiting[task]
+            self._advance(task, error=e)
+            return
+        index = expecter.new_data(data)
+        if index is not None:
+            del self.waiting[task]
+            self._advance(task, index)
+
+
+    def _finish(self, task, func, *args):
+        """Resume task with the outcome of expecter timeout or eof."""
+
+        try:
+            index = func(*args)
+        except pexpect.ExceptionPexpect, e:
+            self._advance(task, error=e)
+        else:
+            self._advance(task, index)
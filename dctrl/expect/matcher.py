@@ -0,0 +1,414 @@
+#
+# Copyright (C) 2015 Prevas A/S
+#
+# This file is part of dctrl, an embedded device control framework
+#
+# dctrl is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# dctrl is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+"""Streaming pattern search for pexpect.
+
+pexpect normally rescans the whole buffer with every regular expression
+each time new data arrives, which makes matching cost quadratic in the
+length of the output.  searcher_stream keeps track of what has already
+been scanned, and only rescans as much of the old data as a match ending
+in the new data can possibly start in.  Patterns that can match any
+length of text across lines (eg. 'root@.*# ', as pexpect compiles
+strings with re.DOTALL) are searched from the first occurrence of their
+literal prefix (root@), if they have one, and otherwise from the start
+of the buffer like pexpect does.
+
+The patterns of an expect call are compiled into a PatternSet, which
+matches the alternatives with a bounded search window in one pass with a
+single combined regular expression.  Pattern sets are cached, keyed by
+the pattern tuple, so repeated expect calls with the same patterns only
+pay for the search.
+"""
+
+import re
+import sre_parse
+import sre_constants as sre
+import pexpect
+
+# repeat counts at or above this are treated as unbounded
+MAXWIDTH = 65535
+
+# maximum number of cached pattern sets
+MAXCACHE = 100
+
+# global inline flags, which cannot be used inside a combined expression
+_inline_flags = re.compile(r"\(\?[aiLmsux]+\)")
+
+NEWLINE = ord('\n')
+
+# whether a character category contains '\n'
+_category_newline = {
+    sre.CATEGORY_DIGIT: False,
+    sre.CATEGORY_NOT_DIGIT: True,
+    sre.CATEGORY_SPACE: True,
+    sre.CATEGORY_NOT_SPACE: False,
+    sre.CATEGORY_WORD: False,
+    sre.CATEGORY_NOT_WORD: True,
+    sre.CATEGORY_LINEBREAK: True,
+    sre.CATEGORY_NOT_LINEBREAK: False,
+}
+
+
+def _in_newline(items):
+    """Return True if the character set items can match '\n'."""
+    negate = False
+    found = False
+    for op, av in items:
+        if op == sre.NEGATE:
+            negate = True
+        elif op == sre.LITERAL:
+            found = found or av == NEWLINE
+        elif op == sre.RANGE:
+            found = found or av[0] <= NEWLINE <= av[1]
+        elif op == sre.CATEGORY and av in _category_newline:
+            found = found or _category_newline[av]
+        else:
+            # don't know, assume the worst
+            return True
+    return found != negate
+
+
+def _analyze(subpattern, flags):
+    """Return (newline, anchored, unknown) for a parsed regular expression:
+    whether it can match '\n', whether it contains anchors depending on
+    the start of the buffer, and whether it contains constructs (eg.
+    lookaround or backreferences) that need unbounded context."""
+    newline = anchored = unknown = False
+    for op, av in subpattern:
+        if op == sre.LITERAL:
+            newline = newline or av == NEWLINE
+        elif op == sre.NOT_LITERAL:
+            newline = newline or av != NEWLINE
+        elif op == sre.ANY:
+            newline = newline or bool(flags & re.DOTALL)
+        elif op == sre.IN:
+            newline = newline or _in_newline(av)
+        elif op == sre.AT:
+            anchored = anchored or av in (sre.AT_BEGINNING,
+                                          sre.AT_BEGINNING_LINE,
+                                          sre.AT_BEGINNING_STRING)
+            continue
+        elif op in (sre.BRANCH, sre.SUBPATTERN,
+                    sre.MAX_REPEAT, sre.MIN_REPEAT):
+            if op == sre.BRANCH:
+                subpatterns = av[1]
+            elif op == sre.SUBPATTERN:
+                subpatterns = [av[-1]]
+                if len(av) == 4:
+                    # python3 scoped flags: (group, add, del, pattern)
+                    flags = (flags | av[1]) & ~av[2]
+            else:
+                subpatterns = [av[2]]
+            for p in subpatterns:
+                n, a, u = _analyze(p, flags)
+                newline = newline or n
+                anchored = anchored or a
+                unknown = unknown or u
+        else:
+            return True, True, True
+    return newline, anchored, unknown
+
+
+def literal_prefix(pattern):
+    """Return the literal text every match of compiled regular expression
+    pattern starts with ('' if none)."""
+    if pattern.flags & re.IGNORECASE:
+        return ''
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return ''
+    prefix = []
+    for op, av in parsed:
+        if op != sre.LITERAL or av >= 128:
+            break
+        prefix.append(chr(av))
+    return ''.join(prefix)
+
+
+def scan_scope(pattern):
+    """Return (width, newline, anchored, simple) for a compiled regular
+    expression.
+
+    width is the maximum length of a match, or None if unbounded or
+    unknown.  newline is False if a match can never contain '\n'.
+    anchored is True if the pattern must see the start of the buffer.
+    simple is False if the pattern contains constructs (lookaround,
+    backreferences, ...) needing unbounded context."""
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return None, True, True, False
+    newline, anchored, unknown = _analyze(parsed, pattern.flags)
+    if unknown:
+        return None, True, True, False
+    width = parsed.getwidth()[1]
+    if width >= MAXWIDTH:
+        width = None
+    return width, newline, anchored, True
+
+
+class PatternSet(object):
+    """A compiled list of patterns for expect (regular expressions, or
+    strings with exact=True, and EOF/TIMEOUT).
+
+    search() finds the pattern matching first, with the semantics of
+    pexpect.searcher_re (earliest match start, lowest index on ties).
+    When possible the alternatives with a bounded search window are
+    matched in a single pass of a combined regular expression; patterns
+    that cannot be combined (flags differ, inline flags, backreferences,
+    ...) are searched one by one, as are patterns that may have to be
+    searched from the start of the buffer, which would make the combined
+    expression do so too, without the literal prefix scan of the regular
+    expression engine.  Pattern sets keep no search state (search() is
+    given the state of the search), and can be shared between calls."""
+
+    def __init__(self, patterns, exact=False):
+        self.exact = exact
+        self.eof_index = -1
+        self.timeout_index = -1
+        self.patterns = []
+        self.lookback = 0
+        self.prefixes = {}
+        for n, s in enumerate(patterns):
+            if s is pexpect.EOF:
+                self.eof_index = n
+                continue
+            if s is pexpect.TIMEOUT:
+                self.timeout_index = n
+                continue
+            if exact:
+                pattern = re.compile(re.escape(s))
+            elif isinstance(s, basestring):
+                pattern = re.compile(s, re.DOTALL)
+            else:
+                pattern = s
+            width, newline, anchored, simple = scan_scope(pattern)
+            self.patterns.append((n, s, pattern, width, newline, simple))
+            if width is None and newline and simple and not anchored:
+                self.prefixes[n] = literal_prefix(pattern)
+            if self.lookback is not None:
+                if width is None or anchored:
+                    self.lookback = None
+                else:
+                    self.lookback = max(self.lookback, width)
+
+        # combine all the simple patterns with a bounded search window
+        # sharing the flags of the first one into one regular expression,
+        # with a group per alternative
+        combine = [p for p in self.patterns
+                   if p[5] and not _inline_flags.search(p[2].pattern) and
+                   (p[3] is not None or not p[4])]
+        if combine:
+            flags = combine[0][2].flags
+            combine = [p for p in combine if p[2].flags == flags]
+        self.combined = None
+        self.alternatives = []
+        if len(combine) > 1:
+            groups = 1
+            alternatives = []
+            for p in combine:
+                alternatives.append('(%s)'%(p[2].pattern))
+                self.alternatives.append((groups, p))
+                groups += 1 + p[2].groups
+            try:
+                self.combined = re.compile('|'.join(alternatives), flags)
+            except re.error:
+                self.combined = None
+                self.alternatives = []
+        combined = set(id(p) for groups, p in self.alternatives)
+        self.separate = [p for p in self.patterns if id(p) not in combined]
+
+        # where to start searching in old data, relative to fresh data
+        self.combined_scope = self._scope(
+            [p for groups, p in self.alternatives])
+
+    @staticmethod
+    def _scope(patterns):
+        """Return (width, newline) covering all patterns."""
+        width = 0
+        newline = False
+        for n, s, pattern, w, nl, simple in patterns:
+            if w is None:
+                width = None
+            elif width is not None:
+                width = max(width, w)
+            newline = newline or nl
+        return width, newline
+
+    def __str__(self):
+        if self.exact:
+            ss = [(n, '    %d: "%s"'%(n, s))
+                  for n, s, pattern, width, newline, simple in self.patterns]
+        else:
+            ss = [(n, '    %d: re.compile("%s")'%(n, pattern.pattern))
+                  for n, s, pattern, width, newline, simple in self.patterns]
+        if self.eof_index >= 0:
+            ss.append((self.eof_index, '    %d: EOF'%(self.eof_index)))
+        if self.timeout_index >= 0:
+            ss.append((self.timeout_index,
+                       '    %d: TIMEOUT'%(self.timeout_index)))
+        ss.sort()
+        return '\n'.join([s for n, s in ss])
+
+    @staticmethod
+    def _start(buffer, fresh, width, newline, searchwindowsize):
+        if width is not None:
+            start = max(0, fresh - max(width - 1, 0))
+        elif not newline:
+            start = buffer.rfind('\n', 0, fresh) + 1
+        else:
+            start = 0
+        if searchwindowsize:
+            start = max(start, len(buffer) - searchwindowsize)
+        return start
+
+    def _prefix_start(self, buffer, fresh, n, state):
+        """Return where to search for unbounded pattern n, the first
+        occurrence of its literal prefix, or None if there is none.  state
+        holds the position of that occurrence in the stream (None while
+        there is none), as pexpect may drop the start of the buffer."""
+        prefix = self.prefixes[n]
+        origin = state['seen'] - len(buffer)
+        if state.get(n) is not None:
+            return max(0, state[n] - origin)
+        if n in state:
+            # old data searched already, except where a prefix may span
+            # into the fresh data
+            pos = buffer.find(prefix, max(0, fresh - len(prefix) + 1))
+        else:
+            pos = buffer.find(prefix)
+        if pos < 0:
+            state[n] = None
+            return None
+        state[n] = origin + pos
+        return pos
+
+    def search(self, buffer, freshlen, searchwindowsize=None, state=None):
+        """Search buffer, of which the last freshlen characters have not
+        been searched before.  Returns (index, match) for the pattern
+        matching first, or None.  state is a dict kept by the caller for
+        the searches of one expect call, or None."""
+
+        fresh = len(buffer) - freshlen
+        first = None
+        if state is not None:
+            # characters searched by the expect call so far
+            state['seen'] = state.get('seen', 0) + freshlen
+
+        if self.combined is not None:
+            width, newline = self.combined_scope
+            start = self._start(buffer, fresh, width, newline,
+                                searchwindowsize)
+            match = self.combined.search(buffer, start)
+            if match is not None:
+                # first alternative matching at this position, and the
+                # match of that pattern alone (for its own groups)
+                for groups, p in self.alternatives:
+                    if match.start(groups) != -1:
+                        break
+                first = (p[0], p[2].match(buffer, match.start()))
+
+        for n, s, pattern, width, newline, simple in self.separate:
+            start = self._start(buffer, fresh, width, newline,
+                                searchwindowsize)
+            if state is not None and self.prefixes.get(n):
+                pos = self._prefix_start(buffer, fresh, n, state)
+                if pos is None:
+                    continue
+                start = max(start, pos)
+            match = pattern.search(buffer, start)
+            if match is None:
+                continue
+            if (first is None or match.start() < first[1].start() or
+                (match.start() == first[1].start() and n < first[0])):
+                first = (n, match)
+
+        return first
+
+
+_cache = {}
+
+def compile_pattern_set(patterns, exact=False):
+    """Return the (cached) PatternSet for a pattern, or list of patterns,
+    as given to expect (or expect_exact if exact)."""
+    if patterns is None:
+        patterns = []
+    elif not isinstance(patterns, (list, tuple)):
+        patterns = [patterns]
+    key = (exact,) + tuple(patterns)
+    try:
+        return _cache[key]
+    except KeyError:
+        pass
+    except TypeError:
+        # unhashable pattern
+        return PatternSet(patterns, exact)
+    if len(_cache) >= MAXCACHE:
+        _cache.clear()
+    pattern_set = _cache[key] = PatternSet(patterns, exact)
+    return pattern_set
+
+
+class searcher_stream(object):
+    """pexpect searcher for a PatternSet (or a list of patterns), with
+    the same match semantics as pexpect.searcher_re (or searcher_string),
+    but only rescanning the part of the old data a new match can start
+    in.
+
+    Patterns with bounded match length are searched from that length
+    before the fresh data, and patterns that cannot match '\n' from the
+    start of the line the fresh data begins in.  Other patterns are
+    searched from the first occurrence of their literal prefix, which is
+    kept track of between the searches of an expect call, so a searcher
+    must only be used for one call.  When all patterns have bounded
+    length, longest_string tells pexpect (4.x) that it only needs to keep
+    that much of the buffer around."""
+
+    def __init__(self, patterns):
+        if not isinstance(patterns, PatternSet):
+            patterns = compile_pattern_set(patterns)
+        self.patterns = patterns
+        self.eof_index = patterns.eof_index
+        self.timeout_index = patterns.timeout_index
+        self.state = {}
+        if patterns.lookback:
+            self.longest_string = patterns.lookback
+
+    def __str__(self):
+        return 'searcher_stream:\n' + str(self.patterns)
+
+    def search(self, buffer, freshlen, searchwindowsize=None):
+        """Search buffer, of which the last freshlen characters have not
+        been searched before, and return the index of the pattern matching
+        first (or -1).  Sets start, end and match."""
+
+        first = self.patterns.search(buffer, freshlen, searchwindowsize,
+                                     self.state)
+        if first is None:
+            return -1
+        n, match = first
+        self.start = match.start()
+        self.end = match.end()
+        if self.patterns.exact:
+            self.match = match.group(0)
+        else:
+            self.match = match
+        return n
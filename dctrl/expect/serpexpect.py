@@ -22,6 +22,8 @@
 
 import serial, pexpect
 import time
+import select
+import errno
 
 class serspawn(serial.Serial, pexpect.spawn):
 
@@ -110,14 +112,13 @@ class serspawn(serial.Serial, pexpect.spawn):
 
     def read_nonblocking (self, size=1, timeout=-1):
 
-        # FIXME: find out why timeout is broken in pyserial
-        #if timeout != -1:
-        #    self.timeout = 1
-        self.timeout = self.readTimeout
-        b = serial.Serial.read(self, size)
-        self.timeout = self.default_timeout
-        #if timeout != -1:
-        #    self.timeout = self.default_timeout
+        if timeout == -1:
+            timeout = self.default_timeout
+
+        # read everything the driver has buffered (up to size) in one go,
+        # only waiting for the port when nothing is pending
+        pending = self.wait_pending(timeout)
+        b = serial.Serial.read(self, min(pending, size))
 
         if self.logfile is not None:
             self.logfile.write(b)
@@ -127,3 +128,52 @@ class serspawn(serial.Serial, pexpect.spawn):
             self.logfile_read.flush()
 
         return str(b)
+
+    def wait_pending (self, timeout=None):
+        """Wait for input on the serial port and return the number of bytes
+        buffered by the driver.  Raises pexpect.TIMEOUT if nothing arrives
+        before timeout (None means wait forever) and pexpect.EOF if the port
+        went away."""
+
+        pending = self.inWaiting()
+        if pending:
+            return pending
+
+        if timeout is not None:
+            deadline = time.time() + timeout
+        try:
+            fd = serial.Serial.fileno(self)
+        except (AttributeError, NotImplementedError):
+            # no selectable file descriptor, poll every readTimeout seconds
+            fd = None
+
+        while True:
+            if timeout is None:
+                wait = None
+            else:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    break
+            if fd is None:
+                if wait is None or wait > self.readTimeout:
+                    wait = self.readTimeout
+                time.sleep(wait)
+                pending = self.inWaiting()
+                if pending:
+                    return pending
+                continue
+            try:
+                readable = select.select([fd], [], [], wait)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not readable:
+                break
+            pending = self.inWaiting()
+            if not pending:
+                # readable without data means the device is disconnected
+                raise pexpect.EOF("End of file in serpexpect.read_nonblocking")
+            return pending
+
+        raise pexpect.TIMEOUT("Timeout in serpexpect.read_nonblocking")
@@ -0,0 +1,168 @@
+#
+# Copyright (C) 2015 Prevas A/S
+#
+# This file is part of dctrl, an embedded device control framework
+#
+# dctrl is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# dctrl is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+
+"""CLI on an ssh connection, on an interactive shell (SshCLI) or on exec
+channels (SshExecCLI)."""
+
+import re
+import sshpexpect, sshexec
+from cliexpect import BaseCLI, CLILogFile
+
+
+class SshCLI(BaseCLI, sshpexpect.sshspawn):
+
+
+    def __init__ (self, host, username, password, port=23,
+                  prompt="# ", linesep="\r\n", sendlinesep="\r\n",
+                  verbose=False, verbose_prefix="SSH> ", logfile=None,
+                  logfile_options={}):
+
+        sshpexpect.sshspawn.__init__(self, host, username, password, port)
+        self.verbose_prefix = verbose_prefix
+        BaseCLI.__init__(self, prompt, linesep=linesep, sendlinesep=sendlinesep,
+                         verbose=verbose, logfile=logfile,
+                         port="%s@%s:%s"%(username, host, port),
+                         logfile_options=logfile_options)
+
+        class PromptError(Exception):
+            pass
+
+        # Expect the prompt => ignoring the initial text send by the ssh connection
+        if not BaseCLI.expectprompt(self, timeout=5):
+            raise PromptError ("Failed to get a prompt '%s' within 5 s."%(self.prompt))
+
+        return
+
+
+class SshExecCLI(BaseCLI, sshexec.sshexec):
+    """ssh connection running each command on its own exec channel (see
+    sshexec), with stdout, stderr and exit status straight from ssh.
+
+    Only runcommand, runcommands and runparallel are supported, there is
+    no shell to send to or expect a prompt from.  The output of a command
+    is its stdout followed by its stderr, which are also stored in
+    self.stdout and self.stderr."""
+
+    stdout = None
+    stderr = None
+
+    def __init__ (self, host, username, password, port=22,
+                  prompt="# ", linesep="\n", sendlinesep="\n",
+                  verbose=False, verbose_prefix="SSH> ", logfile=None,
+                  logfile_options={}, max_channels=8):
+
+        sshexec.sshexec.__init__(self, host, username, password, port,
+                                 max_channels=max_channels)
+        self.verbose_prefix = verbose_prefix
+        self.logfile = None
+        BaseCLI.__init__(self, prompt, linesep=linesep, sendlinesep=sendlinesep,
+                         verbose=verbose, logfile=logfile,
+                         port="%s@%s:%s"%(username, host, port),
+                         logfile_options=logfile_options)
+        return
+
+
+    def probe(self, timeout):
+        """Return True if a command can be run within timeout seconds."""
+
+        if not self.isalive():
+            return False
+        return self.execute(['true'], timeout)[0].completed
+
+
+    def runcommand(self, command, pattern=[], prompt=None, waitForPrompt=True,
+                   timeout=-1, returnbool=True, expectNoOutput=False,
+                   cmdOutputFile=None, checkExitcode=None, exactEcho=None):
+        """Like BaseCLI.runcommand, with the pattern searched for in the
+        output of the completed command.  The exit code is always
+        stored in self.exitcode.  prompt, waitForPrompt and exactEcho are
+        ignored."""
+
+        if(cmdOutputFile):
+            self.logfile = CLILogFile(cmdOutputFile,0)
+            self.info("opened cmd output file %s"%cmdOutputFile)
+
+        if not isinstance(pattern, list):
+            if pattern:
+                pattern = [pattern]
+            else:
+                pattern = []
+
+        self.pmatch = None
+        results = self.execute([command], timeout)
+        self.record(results)
+        if not results[0].completed:
+            self.log("cliexpect.py: Timeout running '%s'. Timeout is %s"%(
+                    command, timeout))
+            return None
+
+        for index, p in enumerate(pattern):
+            match = re.search(p, self.output, re.DOTALL)
+            if match:
+                self.pmatch = match.group(0)
+                return returnbool or index
+        if pattern:
+            self.log("cliexpect.py: Failed to match pattern '%s'"%(pattern))
+            return False
+
+        if expectNoOutput and self.output.strip():
+            self.log("cliexpect.py: Expected NoOutput but got '%s'"%(
+                    self.output.strip()))
+            return False
+        return True
+
+
+    def runcommands(self, commands, prompt=None, timeout=-1):
+        """Like BaseCLI.runcommands, running the commands one after the
+        other."""
+        return self.runmany(commands, timeout, 1)
+
+
+    def runparallel(self, commands, prompt=None, timeout=-1):
+        """Like runcommands, but running the commands at the same time."""
+        return self.runmany(commands, timeout, self.max_channels)
+
+
+    def runmany(self, commands, timeout, max_channels):
+        results = self.execute(commands, timeout, max_channels)
+        self.record(results)
+        if not all(result.completed for result in results):
+            return None
+        if None in self.exitcodes:
+            return False
+        return True
+
+
+    def record(self, results):
+        """Store the output and exit codes of results."""
+
+        for result in results:
+            if self.verbose > 1:
+                print self.verbose_prefix + result.command
+            self.log("$ %s\n%s%s"%(result.command, result.stdout,
+                                   result.stderr), append="")
+        self.outputs = [r.stdout + r.stderr for r in results]
+        self.exitcodes = [r.exitcode for r in results]
+        self.output = ''.join(self.outputs)
+        self.stdout = ''.join(r.stdout for r in results)
+        self.stderr = ''.join(r.stderr for r in results)
+        self.exitcode = self.exitcodes[-1]
+        self.exitcode_checked = True
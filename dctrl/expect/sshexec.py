@@ -0,0 +1,170 @@
+#
+# Copyright (C) 2015 Prevas A/S
+#
+# This file is part of dctrl, an embedded device control framework
+#
+# dctrl is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# dctrl is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+"""Non-interactive ssh connection, running commands on exec channels.
+
+Every command is run on its own exec channel, multiplexed over a single
+ssh transport, and its stdout, stderr and exit status are returned as
+delivered by ssh, so there is no prompt to match, and any number of
+commands can run at the same time."""
+
+import paramiko
+import time
+import select
+import errno
+
+# time.monotonic is not available in python2
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+class ExecResult(object):
+    """Result of a command: stdout, stderr, exitcode (None if not
+    reported) and whether it completed (or timed out)."""
+
+    def __init__(self, command):
+        self.command = command
+        self.stdout = ''
+        self.stderr = ''
+        self.exitcode = None
+        self.completed = False
+
+    def __repr__(self):
+        return '<ExecResult %r: %r>'%(self.command, self.exitcode)
+
+
+class sshexec(object):
+
+    closed = True
+    bufsize = 32768
+    exit_poll_interval = 0.01
+
+    def __init__ (self, host, username, password, port=22, timeout=30,
+                  connect_timeout=10, max_channels=8):
+
+        self.ssh = paramiko.SSHClient()
+        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.ssh.connect(host, port, username, password,
+                         timeout=connect_timeout, allow_agent=False,
+                         look_for_keys=False)
+        self.transport = self.ssh.get_transport()
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_channels = max_channels
+        self.closed = False
+        self.name = '<ssh exec connection %s@%s:%d>'%(username, host, port)
+
+        return
+
+
+    def close (self):
+
+        if self.closed:
+            return
+        self.ssh.close()
+        self.closed = True
+        return
+
+
+    def isalive (self):
+
+        return (not self.closed and self.transport is not None and
+                self.transport.is_active())
+
+
+    def execute (self, commands, timeout=-1, max_channels=None):
+        """Run commands, each on its own channel, at most max_channels
+        (default: self.max_channels) at a time.  Returns a list with an
+        ExecResult for each command.  Commands not completed within
+        timeout seconds (None means no limit) are abandoned."""
+
+        if timeout == -1:
+            timeout = self.timeout
+        if timeout is not None:
+            deadline = monotonic() + timeout
+        if max_channels is None:
+            max_channels = self.max_channels
+
+        results = [ExecResult(command) for command in commands]
+        pending = list(enumerate(commands))
+        running = {}
+        try:
+            while pending or running:
+                while pending and len(running) < max_channels:
+                    i, command = pending.pop(0)
+                    chan = self.transport.open_session(
+                        timeout=self.connect_timeout)
+                    chan.exec_command(command)
+                    running[chan] = i
+
+                # channels at end of file are done when the exit status
+                # arrives, which is not signalled by fileno(), so poll
+                for chan in [chan for chan in running if chan.eof_received]:
+                    if self.read(chan, results[running[chan]]):
+                        del running[chan]
+                        chan.close()
+                if not running:
+                    continue
+                reading = [chan for chan in running if not chan.eof_received]
+
+                if timeout is None:
+                    wait = None
+                else:
+                    wait = deadline - monotonic()
+                    if wait <= 0:
+                        break
+                if len(reading) < len(running) and (
+                    wait is None or wait > self.exit_poll_interval):
+                    wait = self.exit_poll_interval
+                try:
+                    readable = select.select(reading, [], [], wait)[0]
+                except select.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for chan in readable:
+                    if self.read(chan, results[running[chan]]):
+                        del running[chan]
+                        chan.close()
+        finally:
+            for chan in running:
+                chan.close()
+        return results
+
+
+    def read (self, chan, result):
+        """Read what is available on chan into result.  Returns True when
+        the command has completed."""
+
+        while chan.recv_ready():
+            result.stdout += chan.recv(self.bufsize)
+        while chan.recv_stderr_ready():
+            result.stderr += chan.recv_stderr(self.bufsize)
+        if not chan.eof_received:
+            return False
+        # the exit status may come after end of file, or not at all if
+        # the channel is closed without it
+        if chan.exit_status_ready():
+            result.exitcode = chan.recv_exit_status()
+            if result.exitcode == -1:
+                result.exitcode = None
+        elif not chan.closed:
+            return False
+        result.completed = True
+        return True
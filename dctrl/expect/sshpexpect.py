@@ -23,6 +23,8 @@
 import paramiko
 import pexpect
 import time
+import select
+import errno
 
 class sshspawn(pexpect.spawn):
 
@@ -107,7 +109,6 @@ class sshspawn(pexpect.spawn):
             self.logfile_send.write (s)
             self.logfile_send.flush()
 
-        self.sshch.setblocking(1)
         return self.sshch.send(s)
 
     def send(self, s, noSendLog=None):
@@ -116,24 +117,24 @@ class sshspawn(pexpect.spawn):
             return self.send(s)
         else:
             time.sleep(self.delaybeforesend)
-            self.sshch.setblocking(1)
             return self.sshch.send(s)
 
 
     def read_nonblocking (self, size=1, timeout=-1):
-        import socket
 
         if timeout == -1:
             timeout = self.timeout
 
-        if timeout:
-            self.sshch.setblocking(0)
-        self.sshch.settimeout(timeout)
+        # The channel is left in blocking mode, recv() is only called when
+        # data is ready (or the channel is closed) so it never blocks.
+        if not self.sshch.recv_ready():
+            self.wait_readable(timeout)
 
-        try:
-            buf = self.sshch.recv(size)
-        except socket.timeout, e:
-            raise pexpect.TIMEOUT("Timeout in sshpexpect.read_nonblocking")
+        buf = self.sshch.recv(size)
+        if not buf:
+            raise pexpect.EOF("End of file in sshpexpect.read_nonblocking")
+        while len(buf) < size and self.sshch.recv_ready():
+            buf += self.sshch.recv(size - len(buf))
 
         if self.logfile is not None:
             self.logfile.write(buf)
@@ -143,3 +144,33 @@ class sshspawn(pexpect.spawn):
             self.logfile_read.flush()
 
         return buf
+
+
+    def wait_readable (self, timeout=None):
+        """Wait for data (or end of file) on the ssh channel.  Raises
+        pexpect.TIMEOUT if nothing arrives before timeout (None means wait
+        forever)."""
+
+        if timeout is not None:
+            deadline = time.time() + timeout
+        fd = self.sshch.fileno()
+
+        while True:
+            if self.sshch.recv_ready() or self.sshch.closed:
+                return
+            if timeout is None:
+                wait = None
+            else:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    break
+            try:
+                readable = select.select([fd], [], [], wait)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if readable:
+                return
+
+        raise pexpect.TIMEOUT("Timeout in sshpexpect.read_nonblocking")
@@ -0,0 +1,49 @@
+#
+# Copyright (C) 2015 Prevas A/S
+#
+# This file is part of dctrl, an embedded device control framework
+#
+# dctrl is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# dctrl is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+
+"""CLI on a telnet connection."""
+
+import telnetpexpect
+from cliexpect import BaseCLI
+
+
+class TelnetCLI(BaseCLI, telnetpexpect.telnetspawn):
+
+
+    def __init__ (self, host, port=23,
+                  prompt="# ", linesep="\r\n", sendlinesep="\r\n",
+                  verbose=False, verbose_prefix="Telnet> ", logfile=None,
+                  logfile_options={}):
+
+        telnetpexpect.telnetspawn.__init__(self, host, port,
+                                           sendlinesep=sendlinesep)
+        self.verbose_prefix = verbose_prefix
+        BaseCLI.__init__(self, prompt, linesep=linesep, sendlinesep=sendlinesep,
+                         verbose=verbose, logfile=logfile,
+                         port="%s:%s"%(host, port),
+                         logfile_options=logfile_options)
+        return
+
+
+    def flushinput(self):
+
+        self.flush()
+        return
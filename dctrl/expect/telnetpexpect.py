@@ -24,6 +24,8 @@ from telnetlib import Telnet
 import pexpect
 import time
 import re
+import select
+import errno
 
 class telnetspawn(pexpect.spawn):
 
@@ -77,6 +79,12 @@ class telnetspawn(pexpect.spawn):
 
         return not self.closed
 
+    def fileno (self):
+
+        if self.closed:
+            return None
+        return self.telnet.fileno()
+
     def terminate (self, force=False):
 
         raise ExceptionPexpect ('This method is not valid for telnet connections.')
@@ -108,35 +116,18 @@ class telnetspawn(pexpect.spawn):
 
     def read_nonblocking (self, size=1, timeout=-1):
 
-        if timeout != -1:
-            self.timeout = timeout
+        if timeout == -1:
+            timeout = self.timeout
 
         buf = self.readahead_buf
         self.readahead_buf = ''
 
-        # FIXME: update timeout during this loop!!
-
-        more = self.telnet.read_eager()
-        while len(more) > 0:
-            buf += more
-            more = self.telnet.read_eager()
-
-        if len(buf) <= size:
+        if not buf:
+            buf = self.read_available(timeout)
 
-            if self.logfile is not None:
-                self.logfile.write(buf)
-                self.logfile.flush()
-            if self.logfile_read is not None:
-                self.logfile_read.write(buf)
-                self.logfile_read.flush()
-
-            return buf
-
-        self.readahead_buf = buf[size:]
-        buf = buf[:size]
-
-        if timeout != -1:
-            self.timeout = self.default_timeout
+        if len(buf) > size:
+            self.readahead_buf = buf[size:]
+            buf = buf[:size]
 
         if self.logfile is not None:
             self.logfile.write(buf)
@@ -146,3 +137,38 @@ class telnetspawn(pexpect.spawn):
             self.logfile_read.flush()
 
         return buf
+
+    def read_available (self, timeout=None):
+        """Wait for the telnet socket to become readable and return all
+        data available.  Raises pexpect.TIMEOUT if nothing arrives before
+        timeout (None means wait forever) and pexpect.EOF if the connection
+        is closed."""
+
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        while True:
+            try:
+                buf = self.telnet.read_very_eager()
+            except EOFError:
+                raise pexpect.EOF("End of file in telnetpexpect.read_nonblocking")
+            if buf:
+                return buf
+
+            # nothing (or only telnet option negotiation) received so far
+            if timeout is None:
+                wait = None
+            else:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    break
+            try:
+                readable = select.select([self.telnet], [], [], wait)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not readable:
+                break
+
+        raise pexpect.TIMEOUT("Timeout in telnetpexpect.read_nonblocking")
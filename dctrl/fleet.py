@@ -0,0 +1,311 @@
+#
+# Copyright (C) 2015  Prevas A/S
+#
+# This file is part of dctrl, an embedded device control framework
+#
+# dctrl is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# dctrl is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+"""Run one dctrl command on a fleet of devices.
+
+The devices are listed in an inventory file:
+
+    devices:
+      board1: conf/board1.cfg
+      board2:
+        config: conf/board.cfg
+        env:
+          BOARD_ADDRESS: 10.0.0.2
+
+config is the dctrl configuration file of the device (default: the -c
+configuration file), relative to the inventory file.  env is added to
+the environment of the command, for use with env-<name> entries in the
+configuration file.  devices may also be a list, of configuration file
+names or of entries with a name.
+
+The command is run by a dctrl process per device, at most jobs at a
+time.  The result of each device is printed as soon as it is done,
+followed by the number of PASS, FAIL and ERROR results and the
+percentiles of the time taken per device.
+"""
+
+import os
+import sys
+import time
+import subprocess
+import threading
+import Queue
+
+import dctrl
+from dctrl.config import ConfigError
+
+# time.monotonic is not available in python2
+monotonic = getattr(time, 'monotonic', time.time)
+
+RESULTS = ('PASS', 'FAIL', 'ERROR')
+
+
+class Device(object):
+
+    def __init__(self, name, config, env={}):
+        self.name = name
+        self.config = config
+        self.env = env
+
+
+def load_inventory(filename, default_config=None):
+    """Return the list of Devices in inventory filename."""
+
+    filename = os.path.normpath(filename)
+    if not os.path.exists(filename):
+        raise ConfigError("dctrl inventory file not found", str(filename))
+    import yaml
+    with open(filename, 'r') as inventory_file:
+        # the C loader of libyaml is much faster, when available
+        inventory = yaml.load(inventory_file,
+                              Loader=getattr(yaml, 'CSafeLoader',
+                                             yaml.SafeLoader))
+    if not isinstance(inventory, dict) or not 'devices' in inventory:
+        raise ConfigError("invalid dctrl inventory", "no devices defined")
+    basedir = os.path.dirname(filename)
+
+    entries = inventory['devices']
+    if isinstance(entries, dict):
+        entries = sorted(entries.items())
+    elif isinstance(entries, list):
+        entries = [(None, entry) for entry in entries]
+    else:
+        raise ConfigError("invalid dctrl inventory",
+                          "devices must be a list or a mapping")
+
+    devices = []
+    names = set()
+    for name, entry in entries:
+        if isinstance(entry, basestring):
+            entry = {'config': entry}
+        elif entry is None:
+            entry = {}
+        elif not isinstance(entry, dict):
+            raise ConfigError("invalid dctrl inventory",
+                              "invalid device: %s"%(entry,))
+        if name is None:
+            name = entry.get('name', entry.get('config'))
+        if name is None:
+            raise ConfigError("invalid dctrl inventory",
+                              "device without name or config")
+        name = str(name)
+        if name in names:
+            raise ConfigError("invalid dctrl inventory",
+                              "duplicate device: %s"%(name))
+        names.add(name)
+        if 'config' in entry:
+            config = os.path.join(basedir, entry['config'])
+        elif default_config is not None:
+            config = default_config
+        else:
+            raise ConfigError("invalid dctrl inventory",
+                              "%s config not defined"%(name))
+        env = dict((str(k), str(v))
+                   for k, v in (entry.get('env') or {}).items())
+        devices.append(Device(name, config, env))
+    return devices
+
+
+def strip_options(argv, options, valued=()):
+    """Return argv without options (and their values), which are only
+    looked for before the first positional argument.  valued are the
+    options taking a value."""
+
+    ret = []
+    argv = list(argv)
+    while argv:
+        arg = argv.pop(0)
+        if arg == '--' or not arg.startswith('-'):
+            ret.append(arg)
+            break
+        if arg.startswith('--'):
+            name = arg.split('=', 1)[0]
+            inline = '=' in arg
+        else:
+            name = arg[:2]
+            inline = len(arg) > 2
+        value = []
+        if name in valued and not inline and argv:
+            value = [argv.pop(0)]
+        if name not in options:
+            ret += [arg] + value
+    return ret + argv
+
+
+def percentile(values, p):
+    """Return the p'th percentile (nearest rank) of sorted values."""
+
+    if not values:
+        return None
+    rank = int(-(-len(values) * p // 100))
+    return values[max(rank, 1) - 1]
+
+
+class Fleet(object):
+    """Run dctrl with argv on devices, at most jobs at a time.
+
+    argv must not select a configuration file, as the configuration of
+    each device is passed with -c."""
+
+    def __init__(self, devices, argv, jobs=8, prog=None, out=sys.stdout):
+        self.devices = devices
+        self.argv = argv
+        self.jobs = max(int(jobs), 1)
+        if prog is None:
+            prog = [sys.executable, os.path.abspath(sys.argv[0])]
+        self.prog = prog
+        self.out = out
+        self.results = []
+
+
+    def run_device(self, device):
+        """Run the command on device, and return (device, result,
+        message, seconds, output)."""
+
+        env = os.environ.copy()
+        env.update(device.env)
+        env['DCTRL_DEVICE'] = device.name
+        argv = self.prog + ['-c', device.config] + self.argv
+        start = monotonic()
+        try:
+            proc = subprocess.Popen(argv, env=env, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            output = proc.communicate()[0]
+        except OSError, e:
+            return (device, 'ERROR', "failed to run dctrl: %s"%(e),
+                    monotonic() - start, '')
+        seconds = monotonic() - start
+        if proc.returncode in (0, 1, 2):
+            result = RESULTS[proc.returncode]
+        else:
+            result = 'ERROR'
+        lines = output.rstrip().splitlines()
+        message = ''
+        if lines:
+            last = lines[-1]
+            if last == result:
+                lines.pop()
+            elif last.startswith(result + ': '):
+                lines.pop()
+                message = last[len(result) + 2:]
+        if proc.returncode not in (0, 1, 2):
+            message = "dctrl exited with %s"%(proc.returncode)
+        elif not message and result == 'ERROR' and lines:
+            message = lines[-1]
+        return (device, result, message, seconds, '\n'.join(lines))
+
+
+    def worker(self, devices, results):
+        while True:
+            try:
+                device = devices.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results.put(self.run_device(device))
+            except Exception, e:
+                results.put((device, 'ERROR', str(e), 0.0, ''))
+
+
+    def run(self, verbose=False):
+        """Run the command on all devices, printing each result as soon
+        as it is available, and then the summary.  Returns the dctrl
+        exit code: 0 if all passed, 2 if any had an error, else 1."""
+
+        devices = Queue.Queue()
+        for device in self.devices:
+            devices.put(device)
+        results = Queue.Queue()
+        workers = []
+        for i in range(min(self.jobs, len(self.devices))):
+            worker = threading.Thread(target=self.worker,
+                                      args=(devices, results))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        self.results = []
+        for i in range(len(self.devices)):
+            # timeout, so that KeyboardInterrupt is delivered
+            while True:
+                try:
+                    ret = results.get(timeout=3600)
+                    break
+                except Queue.Empty:
+                    continue
+            device, result, message, seconds, output = ret
+            self.results.append((device, result, message, seconds))
+            if verbose and output:
+                for line in output.splitlines():
+                    print >>self.out, '%s| %s'%(device.name, line)
+            if message:
+                print >>self.out, '%s: %s: %s (%.2f s)'%(
+                    device.name, result, message, seconds)
+            else:
+                print >>self.out, '%s: %s (%.2f s)'%(
+                    device.name, result, seconds)
+            self.out.flush()
+
+        for worker in workers:
+            worker.join()
+        self.print_summary()
+        counts = self.counts()
+        if counts['ERROR']:
+            return 2
+        if counts['FAIL']:
+            return 1
+        return 0
+
+
+    def counts(self):
+        counts = dict((result, 0) for result in RESULTS)
+        for device, result, message, seconds in self.results:
+            counts[result] += 1
+        return counts
+
+
+    def latencies(self):
+        """Return the p50, p95 and p99 time taken per device."""
+
+        seconds = sorted(r[3] for r in self.results)
+        return [percentile(seconds, p) for p in (50, 95, 99)]
+
+
+    def print_summary(self):
+        counts = self.counts()
+        print >>self.out, ' '.join('%s: %d'%(result, counts[result])
+                                   for result in RESULTS)
+        if self.results:
+            print >>self.out, 'p50: %.2f s p95: %.2f s p99: %.2f s'%(
+                tuple(self.latencies()))
+        self.out.flush()
+
+
+def main(inventory, argv, jobs=8, default_config=None, verbose=False):
+    """Run dctrl argv on the devices in inventory.  Returns the exit
+    code."""
+
+    try:
+        devices = load_inventory(inventory, default_config)
+    except ConfigError as e:
+        print >>sys.stderr, '%s: %s'%(dctrl.prog, ': '.join(e.args))
+        return 2
+    fleet = Fleet(devices, argv, jobs)
+    return fleet.run(verbose)
@@ -23,11 +23,17 @@ import os
 import logging
 import imp
 import inspect
+import json
+import hashlib
 
 import dctrl.command
 import dctrl.config
 
 
+# bump when the manifest format changes
+MANIFEST_VERSION = 1
+
+
 def load_commands(path=os.environ.get('DCTRLPATH'), config_filename=None):
     if not hasattr(dctrl, '_commands'):
         dctrl._commands = {}
@@ -100,3 +106,204 @@ def import_commands(cmd_name, cmd_cls):
                     grp_cmds = dctrl._commands[grp_name] = {}
                 if cmd.name not in grp_cmds:
                     grp_cmds[cmd.name] = cmd
+
+
+def get_tops(path):
+    return [os.path.abspath(p) for p in path.split(':') if os.path.isdir(p)]
+
+
+def scan_commands(top, path=[]):
+    """Return the modification time of the directories and command
+    modules below top searched by find_commands, by file name."""
+
+    if path:
+        d = os.path.join(top, os.path.join(*path))
+    else:
+        d = top
+    ret = {d: os.stat(d).st_mtime}
+    for f in os.listdir(d):
+        p = os.path.join(d, f)
+        if os.path.isdir(p):
+            ret[p] = os.stat(p).st_mtime
+            init = os.path.join(p, '__init__.py')
+            if os.path.isfile(init):
+                ret[init] = os.stat(init).st_mtime
+                ret.update(scan_commands(top, path + [f]))
+        elif f.endswith('.py') and not f.startswith('__'):
+            ret[p] = os.stat(p).st_mtime
+    return ret
+
+
+def manifest_filename(tops):
+    """Return the name of the command manifest file for DCTRLPATH
+    directories tops."""
+
+    key = hashlib.md5(':'.join(tops)).hexdigest()[:16]
+    return os.path.join(dctrl.get_cache_dir(), 'commands-%s.json'%(key))
+
+
+def read_manifest(tops):
+    """Return the command manifest of tops, or None if it is missing or
+    out of date."""
+
+    filename = manifest_filename(tops)
+    try:
+        with open(filename, 'r') as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if (manifest.get('version') != MANIFEST_VERSION or
+        manifest.get('tops') != tops):
+        return None
+    files = {}
+    try:
+        for top in tops:
+            files.update(scan_commands(top))
+    except OSError:
+        return None
+    if manifest.get('files') != files:
+        logging.debug('command manifest out of date: %s'%filename)
+        return None
+    return manifest
+
+
+def write_manifest(tops):
+    """Write and return the command manifest of the commands loaded from
+    tops: the module, group and description of each command, and the
+    modification time of the files it was made from."""
+
+    files = {}
+    for top in tops:
+        files.update(scan_commands(top))
+    groups = {}
+    for grp_name, grp_cmds in dctrl._commands.items():
+        commands = {}
+        for name, cmd in grp_cmds.items():
+            module = sys.modules.get(cmd.__class__.__module__)
+            filename = os.path.abspath(getattr(module, '__file__', ''))
+            for top in tops:
+                if filename.startswith(top + os.sep):
+                    break
+            else:
+                # not loaded from DCTRLPATH, so it can not be loaded lazily
+                return None
+            commands[name] = {'module': cmd.__class__.__module__,
+                              'top': top,
+                              'help': cmd.__doc__}
+            group_help = cmd._group.cls.__doc__
+        groups[grp_name] = {'help': group_help, 'commands': commands}
+    manifest = {'version': MANIFEST_VERSION, 'tops': tops, 'files': files,
+                'groups': groups}
+
+    filename = manifest_filename(tops)
+    try:
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        tmp = '%s.%d'%(filename, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp, filename)
+    except (IOError, OSError), e:
+        logging.debug('failed to write command manifest: %s'%e)
+    return manifest
+
+
+def load_module(top, name):
+    """Import module name (possibly in a package) from directory top,
+    unless already imported."""
+
+    d = top
+    parts = name.split('.')
+    for i in range(len(parts)):
+        fullname = '.'.join(parts[:i+1])
+        if fullname in sys.modules:
+            module = sys.modules[fullname]
+        else:
+            f, pathname, description = imp.find_module(parts[i], [d])
+            try:
+                module = imp.load_module(fullname, f, pathname, description)
+            finally:
+                if f:
+                    f.close()
+        d = os.path.join(d, parts[i])
+    return module
+
+
+def load_command(group, name, path=os.environ.get('DCTRLPATH')):
+    """Load command name of group from DCTRLPATH path, importing only
+    the module defining it when the command manifest is up to date.
+    Otherwise all commands are loaded, and the manifest is rewritten.
+    Returns the manifest (or None if not available)."""
+
+    if not hasattr(dctrl, '_commands'):
+        dctrl._commands = {}
+    if not path:
+        raise Exception("please set DCTRLPATH")
+    tops = get_tops(path)
+
+    manifest = getattr(dctrl, '_manifest', None)
+    if manifest is None or manifest['tops'] != tops:
+        manifest = read_manifest(tops)
+        if manifest is None:
+            if dctrl._commands:
+                # partly loaded, a full load would load modules again
+                return None
+            load_commands(path)
+            manifest = dctrl._manifest = write_manifest(tops)
+            return manifest
+        dctrl._manifest = manifest
+
+    if name in dctrl._commands.get(group, {}):
+        return manifest
+    try:
+        entry = manifest['groups'][group]['commands'][name]
+    except (KeyError, TypeError):
+        return manifest
+    # commands import each other as top level modules
+    for top in reversed(tops):
+        if not top in sys.path:
+            sys.path.insert(0, top)
+    module = load_module(str(entry['top']), str(entry['module']))
+    for cmd_name, cmd_cls in inspect.getmembers(module):
+        import_commands(cmd_name, cmd_cls)
+    return manifest
+
+
+def load_invoked_command(argv, path=os.environ.get('DCTRLPATH'),
+                         config_filename=None):
+    """Load the command invoked by argv (the command line following the
+    global options), and add parsers for the rest of the commands in the
+    manifest, without loading them."""
+
+    if not path:
+        return load_commands(path, config_filename)
+    words = [arg for arg in argv if not arg.startswith('-')]
+    if len(words) >= 2:
+        manifest = load_command(words[0], words[1], path)
+    else:
+        manifest = load_command(None, None, path)
+    if manifest is not None:
+        add_command_stubs(manifest)
+
+
+def add_command_stubs(manifest):
+    """Add parsers for the groups and commands in manifest that are not
+    loaded, for usage and help output."""
+
+    if not hasattr(dctrl, 'subparsers'):
+        return
+    for grp_name in sorted(manifest['groups']):
+        group = manifest['groups'][grp_name]
+        grp_cmds = dctrl._commands.get(grp_name)
+        if grp_cmds:
+            subparsers = grp_cmds.values()[0]._group.subparsers
+        else:
+            parser = dctrl.subparsers.add_parser(str(grp_name),
+                                                 help=group['help'])
+            subparsers = parser.add_subparsers()
+            grp_cmds = {}
+        for name in sorted(group['commands']):
+            if name in grp_cmds:
+                continue
+            subparsers.add_parser(str(name),
+                                  description=group['commands'][name]['help'])
@@ -0,0 +1,324 @@
+#
+# Copyright (C) 2015 Prevas A/S
+#
+# This file is part of dctrl, an embedded device control framework
+#
+# dctrl is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# dctrl is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+"""Device locks, keeping dctrl processes from using a device at once.
+
+A device (identified by dctrl.connection.connection_key) is leased
+shared or exclusive.  Any number of shared leases may be held at the
+same time, but an exclusive lease only alone.  Leases are granted in
+the order they are asked for: a lease is granted when all leases asked
+for before it are compatible, so a waiting exclusive lease is not
+starved by a stream of shared leases.
+
+The locks are files in a lock directory (DCTRL_LOCK_DIR, default
+dctrl-locks in the temporary directory), shared by all processes on the
+host.  Each device has a directory with a ticket file per lease (held
+or waited for), named by its number in the queue and its mode.  The
+ticket is flock'ed by the process owning it for as long as the lease is
+held, and removed when the lease is released (at the latest when the
+process exits).  A ticket that can be flock'ed by another process
+belongs to a process that died without removing it, and is removed.
+The time waited for each lease is appended to waits.log in the lock
+directory, a line per lease:
+
+    <time> <device directory> <mode> granted|timeout <seconds> <pid> <key>
+"""
+
+import os
+import sys
+import time
+import errno
+import fcntl
+import socket
+import hashlib
+import atexit
+import tempfile
+import contextlib
+
+import dctrl
+from dctrl.connection import ConnectionError
+
+# time.monotonic is not available in python2
+monotonic = getattr(time, 'monotonic', time.time)
+
+MODES = ('shared', 'exclusive')
+
+
+class LockTimeout(ConnectionError):
+    pass
+
+
+def default_directory():
+    return os.environ.get('DCTRL_LOCK_DIR',
+                          os.path.join(tempfile.gettempdir(), 'dctrl-locks'))
+
+
+def makedirs(path, mode):
+    """Create directory path, usable by all users with mode."""
+
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+        return
+    try:
+        os.chmod(path, mode)
+    except OSError:
+        pass
+
+
+def open_shared(path, flags):
+    """Open file path, creating it writable by all users."""
+
+    fd = os.open(path, flags | os.O_CREAT, 0666)
+    try:
+        os.fchmod(fd, 0666)
+    except OSError:
+        # created by another user
+        pass
+    return fd
+
+
+class Lease(object):
+    """A lease of a device, held until released (or the process dies)."""
+
+    def __init__(self, key, mode, ticket, f, waited):
+        _leases.add(self)
+        self.key = key
+        self.mode = mode
+        self.ticket = ticket
+        self.f = f
+        self.waited = waited
+
+    def __repr__(self):
+        return '<Lease %s %r>'%(self.mode, self.key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def release(self):
+        if self.f is None:
+            return
+        _leases.discard(self)
+        try:
+            os.unlink(self.ticket)
+        except OSError:
+            pass
+        self.f.close()
+        self.f = None
+
+
+class LockManager(object):
+    """Device locks in directory (default: default_directory())."""
+
+    # seconds between checks of the queue, doubled up to max_poll_interval
+    poll_interval = 0.05
+    max_poll_interval = 1
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = default_directory()
+        self.directory = directory
+
+
+    def device_directory(self, key):
+        name = hashlib.sha1(repr(key)).hexdigest()[:16]
+        path = os.path.join(self.directory, name)
+        if not os.path.isdir(path):
+            makedirs(self.directory, 01777)
+            makedirs(path, 0777)
+            with open(os.path.join(path, 'device'), 'w') as f:
+                f.write('%r\n'%(key,))
+        return path
+
+
+    @contextlib.contextmanager
+    def mutex(self, path):
+        """Hold the lock of the queue of device directory path."""
+
+        fd = open_shared(os.path.join(path, 'mutex'), os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+
+    def next_number(self, path):
+        fd = open_shared(os.path.join(path, 'next'), os.O_RDWR)
+        with os.fdopen(fd, 'r+') as f:
+            number = int(f.read() or 0)
+            f.seek(0)
+            f.truncate()
+            f.write('%d\n'%(number + 1))
+        return number
+
+
+    def queue(self, path):
+        """Return the tickets (number, mode, filename) of device directory
+        path, in order."""
+
+        tickets = []
+        for name in os.listdir(path):
+            number, dot, mode = name.partition('.')
+            if mode in MODES and number.isdigit():
+                tickets.append((int(number), mode, os.path.join(path, name)))
+        return sorted(tickets)
+
+
+    def owner(self, ticket):
+        """Return the owner of ticket, or None if the owner is dead."""
+
+        try:
+            f = open(ticket, 'r')
+        except IOError:
+            return None
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return f.read().strip() or '?'
+                raise
+        return None
+
+
+    def blockers(self, path, number, mode, logger):
+        """Return the owners of the leases that lease number (in mode)
+        waits for.  Tickets of dead owners are removed."""
+
+        blockers = []
+        for n, m, ticket in self.queue(path):
+            if n >= number:
+                break
+            owner = self.owner(ticket)
+            if owner is None:
+                logger.info("removing stale device lock %s", ticket)
+                try:
+                    os.unlink(ticket)
+                except OSError:
+                    pass
+                continue
+            if mode == 'exclusive' or m == 'exclusive':
+                blockers.append('%s (%s)'%(owner, m))
+        return blockers
+
+
+    def acquire(self, key, mode='exclusive', timeout=None, logger=None):
+        """Return a Lease of device key in mode, waiting at most timeout
+        seconds (None means no limit) for it.  Raises LockTimeout."""
+
+        if mode not in MODES:
+            raise ValueError("invalid lock mode: %s"%(mode))
+        if logger is None:
+            logger = dctrl.logger
+        start = monotonic()
+        path = self.device_directory(key)
+        with self.mutex(path):
+            number = self.next_number(path)
+            ticket = os.path.join(path, '%012d.%s'%(number, mode))
+            f = os.fdopen(open_shared(ticket, os.O_WRONLY), 'w')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write('pid %d on %s: %s\n'%(os.getpid(), socket.gethostname(),
+                                          ' '.join(sys.argv)))
+            f.flush()
+
+        lease = Lease(key, mode, ticket, f, 0.0)
+        interval = self.poll_interval
+        waiting = False
+        try:
+            while True:
+                with self.mutex(path):
+                    blockers = self.blockers(path, number, mode, logger)
+                if not blockers:
+                    break
+                if not waiting:
+                    logger.info("waiting for %s lock of device %s, held by %s",
+                                mode, key, ', '.join(blockers))
+                    waiting = True
+                wait = interval
+                if timeout is not None:
+                    remaining = start + timeout - monotonic()
+                    if remaining <= 0:
+                        raise LockTimeout(
+                            "device lock timeout (%s s): %s held by %s"%(
+                                timeout, key, ', '.join(blockers)))
+                    wait = min(wait, remaining)
+                time.sleep(wait)
+                interval = min(interval * 2, self.max_poll_interval)
+        except LockTimeout:
+            lease.release()
+            lease.waited = monotonic() - start
+            self.log_wait(lease, 'timeout')
+            raise
+        except BaseException:
+            lease.release()
+            raise
+
+        lease.waited = monotonic() - start
+        if waiting:
+            logger.info("waited %.2f s for %s lock of device %s",
+                        lease.waited, mode, key)
+        else:
+            logger.debug("got %s lock of device %s", mode, key)
+        self.log_wait(lease, 'granted')
+        return lease
+
+
+    def log_wait(self, lease, outcome):
+        """Append the time waited for lease, and the outcome (granted or
+        timeout), to waits.log."""
+
+        line = '%s %s %s %s %.3f %d %r\n'%(
+            time.strftime('%Y-%m-%dT%H:%M:%S'),
+            os.path.basename(os.path.dirname(lease.ticket)), lease.mode,
+            outcome, lease.waited, os.getpid(), lease.key)
+        try:
+            fd = open_shared(os.path.join(self.directory, 'waits.log'),
+                             os.O_WRONLY | os.O_APPEND)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        except OSError:
+            dctrl.logger.debug("failed to log device lock wait",
+                               exc_info=True)
+
+
+# leases held by the process, released when it exits
+_leases = set()
+
+@atexit.register
+def release_all():
+    for lease in list(_leases):
+        lease.release()
+
+
+_manager = None
+
+def get_manager():
+    global _manager
+    if _manager is None:
+        _manager = LockManager()
+    return _manager
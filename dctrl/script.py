@@ -0,0 +1,234 @@
+#
+# Copyright (C) 2015  Prevas A/S
+#
+# This file is part of dctrl, an embedded device control framework
+#
+# dctrl is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# dctrl is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+"""Run a script of dctrl commands on shared connections.
+
+A script (dctrl --script FILE) is a YAML or JSON list of steps, each
+step a dctrl command line, as a string or a list of arguments:
+
+    steps:
+      - uboot prompt
+      - uboot boot
+      - linux su-prompt
+      - [linux, cmd, 'uname -a']
+      - command: linux gpio-read 17 1
+        name: check gpio
+        ignore-failure: true
+
+The global options given with --script (eg. -c) apply to all steps.
+The steps are run one after the other, in one process, and all steps
+using the same connection (see dctrl.connection.connection_key) share
+it, so the connection is only opened, and the device logged in to,
+once.  A step with an error (or a command timeout) closes its
+connection, and the next step using it opens a new one.  Before a
+connection is reused, it must answer an empty line with one of the
+prompts configured for the command group of the step, or it is
+replaced by a new one.
+
+The script stops at the first step not passing (unless the step has
+ignore-failure set, or keep-going is set for the script or with
+--keep-going).  The result and time taken of each step is printed as
+soon as it is done, followed by the number of PASS, FAIL and ERROR
+results and the total time.
+"""
+
+import os
+import sys
+import time
+import shlex
+import json
+
+import dctrl
+import dctrl.config
+import dctrl.command
+import dctrl.connection
+import dctrl.context
+from dctrl.config import ConfigError
+
+# time.monotonic is not available in python2
+monotonic = getattr(time, 'monotonic', time.time)
+
+RESULTS = ('PASS', 'FAIL', 'ERROR')
+
+
+class Step(object):
+
+    def __init__(self, argv, name=None, ignore_failure=False):
+        self.argv = argv
+        if name is None:
+            name = ' '.join(argv)
+        self.name = name
+        self.ignore_failure = ignore_failure
+
+
+def load_script(filename):
+    """Return the list of Steps and the keep-going setting of script
+    filename."""
+
+    if not os.path.exists(filename):
+        raise ConfigError("dctrl script file not found", str(filename))
+    with open(filename, 'r') as script_file:
+        if filename.endswith('.json'):
+            try:
+                script = json.load(script_file)
+            except ValueError, e:
+                raise ConfigError("invalid dctrl script", str(e))
+        else:
+            import yaml
+            script = yaml.load(script_file,
+                               Loader=getattr(yaml, 'CLoader', yaml.Loader))
+    keep_going = False
+    if isinstance(script, dict):
+        keep_going = bool(script.get('keep-going', False))
+        script = script.get('steps')
+    if not isinstance(script, list):
+        raise ConfigError("invalid dctrl script", "no steps defined")
+
+    steps = []
+    for entry in script:
+        name = None
+        ignore_failure = False
+        if isinstance(entry, dict):
+            name = entry.get('name')
+            ignore_failure = bool(entry.get('ignore-failure', False))
+            entry = entry.get('command')
+        if isinstance(entry, basestring):
+            argv = shlex.split(entry.encode('utf-8'))
+        elif isinstance(entry, list):
+            argv = [unicode(arg).encode('utf-8') for arg in entry]
+        else:
+            raise ConfigError("invalid dctrl script",
+                              "invalid step: %s"%(entry,))
+        if not argv:
+            raise ConfigError("invalid dctrl script", "empty step")
+        steps.append(Step(argv, name, ignore_failure))
+    return steps, keep_going
+
+
+class Script(object):
+    """Run steps with parser (the dctrl command line parser, with all
+    commands loaded), each with the global options argv added.
+    global_options are the names of the options of parser that are not
+    command parameters (see dctrl.command.parse_args)."""
+
+    def __init__(self, parser, steps, argv=[], keep_going=False,
+                 out=sys.stdout, global_options=()):
+        self.parser = parser
+        self.global_options = global_options
+        self.steps = steps
+        self.argv = argv
+        self.keep_going = keep_going
+        self.out = out
+        # the shell is kept as left by the previous step, possibly at
+        # another prompt
+        self.pool = dctrl.connection.ConnectionPool(max_idle=None,
+                                                    probe_all_prompts=True)
+        self.results = []
+
+
+    def run_step(self, step):
+        """Run step, and return (result, message)."""
+
+        logger = dctrl.logger
+        try:
+            cmd, config = dctrl.command.parse_args(self.parser,
+                                                   self.argv + step.argv,
+                                                   self.global_options)
+        except ConfigError as e:
+            return 'ERROR', ': '.join(e.args)
+        except SystemExit, e:
+            # argparse error, already reported
+            return 'ERROR', "invalid command line"
+        context = dctrl.context.Context(config, logger)
+        try:
+            ret = dctrl.command.run(cmd, pool=self.pool, context=context)
+        except Exception as e:
+            logger.debug("Exception in %s"%(cmd.get_name()), exc_info=True)
+            ret = (2, "%s: Exception: %s"%(cmd.get_name(), e))
+        return RESULTS[ret[0]], ret[1]
+
+
+    def run(self):
+        """Run the steps, printing the result of each, and then the
+        summary.  Returns the dctrl exit code: 0 if all passed, 2 if a
+        step had an error, else 1 (not counting steps with
+        ignore-failure set)."""
+
+        self.results = []
+        start = monotonic()
+        try:
+            for i, step in enumerate(self.steps):
+                step_start = monotonic()
+                result, message = self.run_step(step)
+                seconds = monotonic() - step_start
+                self.results.append((step, result, message, seconds))
+                message = message.rstrip() if message else message
+                if message:
+                    print >>self.out, '%d: %s: %s: %s (%.2f s)'%(
+                        i + 1, step.name, result, message, seconds)
+                else:
+                    print >>self.out, '%d: %s: %s (%.2f s)'%(
+                        i + 1, step.name, result, seconds)
+                self.out.flush()
+                if (result != 'PASS' and not step.ignore_failure and
+                    not self.keep_going):
+                    break
+        finally:
+            dctrl.logger.debug("connection pool: %s", self.pool.stats())
+            self.pool.close()
+        self.print_summary(monotonic() - start)
+
+        results = [r[1] for r in self.results if not r[0].ignore_failure]
+        if 'ERROR' in results:
+            return 2
+        if 'FAIL' in results:
+            return 1
+        return 0
+
+
+    def counts(self):
+        counts = dict((result, 0) for result in RESULTS)
+        for step, result, message, seconds in self.results:
+            counts[result] += 1
+        return counts
+
+
+    def print_summary(self, seconds):
+        counts = self.counts()
+        summary = ' '.join('%s: %d'%(result, counts[result])
+                           for result in RESULTS)
+        skipped = len(self.steps) - len(self.results)
+        if skipped:
+            summary += ' skipped: %d'%(skipped)
+        print >>self.out, '%s (%.2f s)'%(summary, seconds)
+        self.out.flush()
+
+
+def main(parser, filename, argv=[], keep_going=False, global_options=()):
+    """Run script filename with parser.  Returns the exit code."""
+
+    try:
+        steps, script_keep_going = load_script(filename)
+    except ConfigError as e:
+        print >>sys.stderr, '%s: %s'%(dctrl.prog, ': '.join(e.args))
+        return 2
+    script = Script(parser, steps, argv, keep_going or script_keep_going,
+                    global_options=global_options)
+    return script.run()
@@ -25,8 +25,11 @@ import logging
 import copy
 
 import os
+import atexit
 import dctrl
 import dctrl.command
+import dctrl.connection
+import dctrl.context
 from dtest.dtestcase import DtestTestCase
 import dtest.testsetup
 
@@ -36,8 +39,30 @@ class DctrlError(Exception):
     pass
 
 
+# connections kept open across the tests of a dtest run
+_pool = None
+
+def get_pool():
+    """Return the connection pool shared by the tests of the dtest run.
+
+    A connection is opened by the first test using the device and
+    connection group (see dctrl.connection.connection_key), and reused by
+    the following tests, after probing that it still answers with a
+    prompt.  A connection left by a test with an error is closed, and a
+    new one is opened by the next test.  The connections are closed when
+    the run exits."""
+    global _pool
+    if _pool is None:
+        _pool = dctrl.connection.ConnectionPool()
+        atexit.register(_pool.close)
+    return _pool
+
+
 class DctrlWrapper(DtestTestCase):
 
+    # index in DctrlConfigs of the device to run on, overriding cfg_idx
+    device = None
+
     def __init__(self, group, command, parent, params, testargs={}):
         self.testsetup = dtest.testsetup.testsetup()
         if hasattr(self.testsetup, 'DctrlConfigs'):
@@ -105,15 +130,18 @@ class DctrlWrapper(DtestTestCase):
     def setUp(self):
         import dctrl.config
         cfg_idx = 0
-        if 'cfg_idx' in self.testargs:
+        if self.device is not None:
+            # assigned by dctrl.devicepool.DevicePoolSuite
+            cfg_idx = self.device
+        elif 'cfg_idx' in self.testargs:
             cfg_idx = self.testargs['cfg_idx']
         if hasattr(self,'dctrlconfigs'):
             dctrlconfig = self.dctrlconfigs[cfg_idx]
         else:
             dctrlconfig = 'conf/dctrl.cfg'
-        dctrl.config.load(dctrlconfig, self.cmd)
+        self.config = dctrl.config.load(dctrlconfig, self.cmd)
         self.parseParams()
-        dctrl.config.config['params'] = self.params
+        self.config['params'] = self.params
         self.params['run'] = self.cmd
         #always log to file for dtest
         self.params['logfile'] = os.path.join(self.tmpDir, "output.log")
@@ -122,7 +150,14 @@ class DctrlWrapper(DtestTestCase):
 
     def _runTest(self):
         logger.debug("DctrlWrapper: runTest(): running cmd: %s",self.cmd)
-        ret = dctrl.command.run(self.cmd)
+        context = dctrl.context.Context(self.config,
+                                        logging.getLogger('dtest'))
+        pool = None
+        if self.reuse_connection():
+            pool = get_pool()
+        ret = dctrl.command.run(self.cmd, pool=pool, context=context)
+        if pool is not None:
+            logger.debug("DctrlWrapper: connection pool: %s", pool.stats())
 	data = ret[1]
         if type(data) == dict:
             data = json.dumps(data)
@@ -134,6 +169,15 @@ class DctrlWrapper(DtestTestCase):
             raise DctrlError(data)
         self.assertEqual(ret[0], 0, msg= 'dctrl command failed: ' + str(data))
 
+    def reuse_connection(self):
+        """Return True if the test runs on the connection shared by the
+        tests (see get_pool), which is turned off by the test argument
+        reuse_connection: false, or for all tests by DctrlReuseConnections
+        = False in the test setup."""
+        if 'reuse_connection' in self.testargs:
+            return bool(self.testargs['reuse_connection'])
+        return getattr(self.testsetup, 'DctrlReuseConnections', True)
+
     def fullDescription(self):
         if hasattr(self.cmd,"fullDescription"):
             # Use the fullDescription if possible
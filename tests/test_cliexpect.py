@@ -0,0 +1,239 @@
+#
+# Copyright (C) 2015 Prevas A/S
+#
+# This file is part of dctrl, an embedded device control framework
+#
+# dctrl is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# dctrl is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+import os
+import re
+import errno
+import time
+import tempfile
+import unittest
+import pexpect
+
+from dctrl.expect.cliexpect import BaseCLI, Sanitizer, strip_shell_command
+from dctrl.expect.cliexpect import CLILogFile
+
+
+class BashCLI(BaseCLI, pexpect.spawn):
+    """Interactive bash on a pty of 80 columns, like a device console."""
+
+    def __init__(self, logfile):
+        env = dict(os.environ, TERM='dumb', PS1='# ', COLUMNS='80')
+        pexpect.spawn.__init__(self, 'bash', ['--norc', '--noprofile', '-i'],
+                               env=env, dimensions=(24, 80), timeout=10)
+        BaseCLI.__init__(self, '# ', linesep='\r\n', sendlinesep='\n',
+                         logfile=logfile)
+        self.expect_exact('# ')
+
+    def send(self, s, noSendLog=None):
+        return pexpect.spawn.send(self, s)
+
+
+class BashTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.logfile = tempfile.mkstemp()
+        os.close(fd)
+        self.con = BashCLI(self.logfile)
+        self.con.set_consume_command_echo(5)
+
+    def tearDown(self):
+        self.con.close()
+        os.unlink(self.logfile)
+
+    def test_runcommands_wider_than_tty(self):
+        commands = ['echo %s'%(c * 30) for c in 'abcdefgh']
+        self.assertTrue(self.con.runcommands(commands))
+        self.assertEqual(self.con.exitcodes, [0] * len(commands))
+        self.assertEqual([output.strip() for output in self.con.outputs],
+                         [c * 30 for c in 'abcdefgh'])
+
+    def test_runcommands_exitcodes(self):
+        self.assertTrue(self.con.runcommands(['true', 'false', 'echo x']))
+        self.assertEqual(self.con.exitcodes, [0, 1, 0])
+        self.assertEqual(self.con.outputs[2].strip(), 'x')
+
+    def test_runcommand_wider_than_tty(self):
+        self.assertTrue(self.con.runcommand('echo %s'%('x' * 70),
+                                            checkExitcode=True))
+        self.assertEqual(self.con.exitcode, 0)
+        self.assertEqual(self.con.output.strip(), 'x' * 70)
+
+    def test_runcommand_after_pending_output(self):
+        # eg. a login banner and prompt not read by the connection
+        self.con.sendline('echo banner')
+        time.sleep(0.2)
+        self.assertTrue(self.con.runcommand('echo %s'%('x' * 70),
+                                            checkExitcode=True))
+        self.assertEqual(self.con.exitcode, 0)
+        self.assertEqual(self.con.output.strip(), 'x' * 70)
+
+    def runcommand_exitcode(self, command):
+        self.assertTrue(self.con.runcommand(command, checkExitcode=True))
+        return self.con.exitcode
+
+    def test_exitcode_trailing_semicolon(self):
+        self.assertEqual(self.runcommand_exitcode('false;'), 1)
+
+    def test_exitcode_comment(self):
+        self.assertEqual(self.runcommand_exitcode('false # note'), 1)
+        self.assertEqual(self.runcommand_exitcode('echo "a;#b" #x'), 0)
+        self.assertEqual(self.con.output.strip(), 'a;#b')
+
+    def test_exitcode_empty(self):
+        self.assertEqual(self.runcommand_exitcode(''), 0)
+        self.assertEqual(self.runcommand_exitcode('# note'), 0)
+
+    def test_exitcode_escaped_semicolon(self):
+        self.assertEqual(self.runcommand_exitcode(
+                'find /dev/null -exec true {} \\;'), 0)
+
+
+class EchoTailPatternTest(unittest.TestCase):
+
+    def test_wrapped(self):
+        command = 'echo foo; echo "DCTRL""0123abcd:$?"'
+        pattern = BaseCLI().echo_tail_pattern(command)
+        for echo in ['# ' + command + '\r\n',
+                     '\r<o; echo "DCTRL""0123abcd:$?"\r\n',
+                     '# echo foo; echo "DCTRL""0123 \r\nabcd:$?"\r\n',
+                     '# echo foo; echo "DCTRL""0123abc\x1b[1Ed:$?"\r\n']:
+            self.assertTrue(re.search(pattern, echo), echo)
+        self.assertFalse(re.search(pattern, 'DCTRL0123abcd:0\r\n'))
+
+    def test_short(self):
+        self.assertTrue(re.search(BaseCLI().echo_tail_pattern('ls'),
+                                  '# ls\r\n'))
+
+
+class SanitizerTest(unittest.TestCase):
+
+    samples = [
+        'root@dev:~# \x1b[0;32mok\x1b[0m\r\r\nnext\r\n',
+        '\x1b[1\x1b[;_ A[@1',
+        '\x1b\x1b\x1b[A@_[_',
+        '\x1b[12\r\n34m\x1bM\x07bell\x7f\r',
+        'a\x1b[?25l\x1b[2J\x1b[H\x1b',
+        ]
+
+    def test_sanitize(self):
+        self.assertEqual(Sanitizer().sanitize(self.samples[0]),
+                         'root@dev:~# ok\nnext\n')
+        self.assertEqual(Sanitizer().sanitize(self.samples[3]),
+                         '12\n34m^Gbell^?\n')
+
+    def test_split(self):
+        # the same output, wherever the stream is split into chunks
+        for sample in self.samples:
+            whole = Sanitizer().sanitize(sample)
+            for i in range(len(sample) + 1):
+                for j in range(i, len(sample) + 1):
+                    sanitizer = Sanitizer()
+                    output = (sanitizer.feed(sample[:i]) +
+                              sanitizer.feed(sample[i:j]) +
+                              sanitizer.feed(sample[j:]) + sanitizer.finish())
+                    self.assertEqual(output, whole, (sample, i, j))
+
+
+class StripShellCommandTest(unittest.TestCase):
+
+    def test_strip(self):
+        for command, stripped in [
+            ('true', 'true'),
+            ('true; ', 'true'),
+            ('true # note', 'true'),
+            ('true; # note', 'true'),
+            ('# note', ''),
+            ('echo a#b', 'echo a#b'),
+            ('echo "a # b"', 'echo "a # b"'),
+            ("echo 'a # b' # c", "echo 'a # b'"),
+            ('echo \\# a', 'echo \\# a'),
+            ("echo '\\' # a", "echo '\\'"),
+            ('find . -exec rm {} \\;', 'find . -exec rm {} \\;'),
+            ('case x in x) true;;', 'case x in x) true;;'),
+            ('sleep 1 &', 'sleep 1 &'),
+            ]:
+            self.assertEqual(strip_shell_command(command), stripped)
+
+
+
+class FullFile(object):
+    """File on a full disk."""
+
+    def write(self, s):
+        raise IOError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class CLILogFileTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.logfile = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.logfile)
+
+    def test_thread(self):
+        log = CLILogFile(self.logfile, 'test', thread=True)
+        log.buffer_size = 16
+        for i in range(100):
+            log.write('line %d\r\n'%(i))
+        log.close()
+        with open(self.logfile) as f:
+            self.assertEqual(f.read().split('\n')[:100],
+                             ['line %d'%(i) for i in range(100)])
+
+    def test_thread_error(self):
+        log = CLILogFile(self.logfile, 'test', thread=True)
+        log.buffer_size = 16
+        log.file.close()
+        log.file = FullFile()
+        try:
+            # more than the queue holds
+            for i in range(log.queue_size * 10):
+                log.write('line %d\r\n'%(i))
+        except IOError, e:
+            self.assertEqual(e.errno, errno.ENOSPC)
+        else:
+            self.fail("write error not raised")
+        self.assertRaises(IOError, log.close)
+        self.assertTrue(log.closed)
+
+
+class MovedNamesTest(unittest.TestCase):
+
+    def test_transports(self):
+        from dctrl.expect.cliexpect import TelnetCLI
+        from dctrl.expect import telnetcli
+        self.assertTrue(TelnetCLI is telnetcli.TelnetCLI)
+
+    def test_unknown(self):
+        import dctrl.expect.cliexpect
+        self.assertRaises(AttributeError, getattr, dctrl.expect.cliexpect,
+                          'NoCLI')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+#
+# Copyright (C) 2015 Prevas A/S
+#
+# This file is part of dctrl, an embedded device control framework
+#
+# dctrl is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# dctrl is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import dctrl
+import dctrl.config
+
+
+class Group(object):
+
+    def get_group_name(self):
+        return 'linux'
+
+
+CONFIG = """commands:
+  linux:
+    connection:
+      type: telnet
+      address: 127.0.0.1
+    prompt: '# '
+connections: {}
+"""
+
+
+class ConfigCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_home = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = self.directory
+        self.filename = os.path.join(self.directory, 'dctrl.cfg')
+        with open(self.filename, 'w') as f:
+            f.write(CONFIG)
+        dctrl.config._cache.clear()
+
+    def tearDown(self):
+        dctrl.config._cache.clear()
+        if self.cache_home is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = self.cache_home
+        shutil.rmtree(self.directory)
+
+    def test_cached(self):
+        config = dctrl.config.load(self.filename, Group())
+        dctrl.config._cache.clear()
+        self.assertNotEqual(dctrl.config.get_cached(self.filename), None)
+        self.assertEqual(dctrl.config.load(self.filename, Group()), config)
+
+    def test_other_version(self):
+        dctrl.config.load(self.filename, Group())
+        entry = dctrl.config._cache[self.filename]
+        entry['version'] = (dctrl.config.CACHE_VERSION, 'other')
+        dctrl.config.write_cache(self.filename, entry)
+        dctrl.config._cache.clear()
+        self.assertEqual(dctrl.config.get_cached(self.filename), None)
+
+    def test_unsupported_type(self):
+        dctrl.config.load(self.filename, Group())
+        entry = dctrl.config._cache[self.filename]
+        config = dctrl.config.cPickle.loads(entry['groups']['linux'])
+        config['command']['connection']['type'] = 'removed'
+        entry['groups']['linux'] = dctrl.config.cPickle.dumps(config, 2)
+        self.assertRaises(dctrl.config.ConfigError,
+                          dctrl.config.load, self.filename, Group())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+#
+# Copyright (C) 2015 Prevas A/S
+#
+# This file is part of dctrl, an embedded device control framework
+#
+# dctrl is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# dctrl is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+import os
+import time
+import socket
+import logging
+import tempfile
+import unittest
+import pexpect
+
+from dctrl.connection import RetryPolicy, ConnectionError, connection_error
+from dctrl.connection import ConnectionPool
+from test_cliexpect import BashCLI
+
+logger = logging.getLogger('test')
+
+
+def closed_port():
+    """Return a local port nobody listens on."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.port = closed_port()
+        self.attempts = 0
+
+    def connect(self):
+        self.attempts += 1
+        try:
+            socket.create_connection(('127.0.0.1', self.port), 1)
+        except socket.error, e:
+            raise connection_error("connection refused", e)
+
+    def test_refused_without_retries(self):
+        policy = RetryPolicy(retries=0)
+        self.assertRaises(ConnectionError, policy.run, self.connect, logger)
+        self.assertEqual(self.attempts, 1)
+
+    def test_refused_after_retries(self):
+        policy = RetryPolicy(retries=1, delay=0.01)
+        self.assertRaises(ConnectionError, policy.run, self.connect, logger)
+        self.assertEqual(self.attempts, 2)
+
+    def test_refused_at_deadline(self):
+        policy = RetryPolicy(retries=None, delay=0.05, deadline=0.01)
+        self.assertRaises(ConnectionError, policy.run, self.connect, logger)
+        self.assertEqual(self.attempts, 1)
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.logfile = tempfile.mkstemp()
+        os.close(fd)
+        self.con = BashCLI(self.logfile)
+        self.pool = ConnectionPool()
+
+    def tearDown(self):
+        self.con.close()
+        os.unlink(self.logfile)
+
+    def test_probe(self):
+        self.assertTrue(self.pool.probe(self.con))
+
+    def test_probe_busy(self):
+        self.con.sendline('sleep 5')
+        self.assertFalse(self.pool.probe(self.con))
+
+    def test_probe_pending_output(self):
+        self.con.sendline('echo foo')
+        time.sleep(0.2)
+        self.assertTrue(self.pool.probe(self.con))
+        self.assertTrue(self.con.runcommand('echo bar'))
+        self.assertEqual(self.con.output.strip(), 'echo bar\r\nbar')
+
+    def test_probe_prompt_line(self):
+        # the prompt pattern only matches the end of the prompt line
+        self.con.sendline("PS1='root@dev:~# '")
+        time.sleep(0.2)
+        self.assertTrue(self.pool.probe(self.con))
+
+    def test_probe_stale_prompt(self):
+        self.con.sendline("printf 'root@dev#\\040'; sleep 5")
+        self.con.expect_exact('sleep 5\r\n')
+        # reads the stale prompt into the buffer
+        self.con.expect([pexpect.TIMEOUT, 'nothing'], timeout=0.3)
+        self.assertEqual(self.con.before, 'root@dev# ')
+        self.assertFalse(self.pool.probe(self.con))
+
+    def test_probe_endless_output(self):
+        self.con.sendline('yes')
+        start = time.time()
+        self.assertFalse(self.pool.probe(self.con))
+        self.assertTrue(time.time() - start < 3)
+
+    def test_probe_other_prompt(self):
+        self.con.sendline("PS1='$ '")
+        time.sleep(0.2)
+        self.assertFalse(self.pool.probe(self.con))
+        self.assertTrue(self.pool.probe(self.con, ['# ', '\\$ ']))
+
+    def test_release_timedout(self):
+        self.assertEqual(self.con.runcommand('sleep 5', timeout=0.2), None)
+        self.pool.leased[id(self.con)] = 'bash'
+        self.pool.release(self.con)
+        self.assertEqual(self.pool.stats()['idle'], 0)
+        self.assertFalse(self.con.isalive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#
+# Copyright (C) 2015 Prevas A/S
+#
+# This file is part of dctrl, an embedded device control framework
+#
+# dctrl is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# dctrl is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+
+import os
+import logging
+import tempfile
+import unittest
+
+import dctrl
+from dctrl.daemon import Daemon
+
+
+class EnvDaemon(Daemon):
+    """Daemon running commands that print an environment variable."""
+
+    def run_command(self, argv):
+        print os.environ.get(argv[0])
+        return 0, None
+
+
+class DaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        # set up by bin/dctrl
+        dctrl.logger = logging.getLogger('test')
+        dctrl.logger_console = logging.StreamHandler()
+        self.daemon = EnvDaemon(None, 'daemon.sock')
+        self.cwd = os.getcwd()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+
+    def test_client_environment(self):
+        os.environ.pop('DCTRL_TEST_ENV', None)
+        reply = self.daemon.run(['DCTRL_TEST_ENV'], self.cwd,
+                                {'DCTRL_TEST_ENV': 'client'})
+        self.assertEqual(reply['output'], 'client\n')
+        self.assertFalse('DCTRL_TEST_ENV' in os.environ)
+
+    def test_daemon_environment(self):
+        os.environ['DCTRL_TEST_ENV'] = 'daemon'
+        try:
+            reply = self.daemon.run(['DCTRL_TEST_ENV'], self.cwd)
+        finally:
+            del os.environ['DCTRL_TEST_ENV']
+        self.assertEqual(reply['output'], 'daemon\n')
+
+    def test_client_directory(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.daemon.run(['DCTRL_TEST_ENV'], directory)
+            self.assertEqual(os.getcwd(), self.cwd)
+        finally:
+            os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
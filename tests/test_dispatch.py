@@ -0,0 +1,119 @@
+#
+# Copyright (C) 2015 Prevas A/S
+#
+# This file is part of dctrl, an embedded device control framework
+#
+# dctrl is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# dctrl is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+import os
+import tempfile
+import unittest
+import pexpect
+
+from dctrl.expect import dispatch
+from dctrl.expect.dispatch import Task, Expect, Return
+from test_cliexpect import BashCLI
+
+
+def inner():
+    try:
+        yield Expect('# ')
+    except pexpect.TIMEOUT:
+        raise Return(False)
+    raise Return(True)
+
+
+def outer():
+    ret = yield inner()
+    raise Return(('inner', ret))
+
+
+class TaskTest(unittest.TestCase):
+
+    def test_nested_coroutine_handles_error(self):
+        task = Task(outer())
+        request = task.step()
+        self.assertTrue(isinstance(request, Expect))
+        self.assertEqual(task.step(error=pexpect.TIMEOUT('timeout')), None)
+        self.assertTrue(task.done)
+        self.assertEqual(task.value, ('inner', False))
+        self.assertEqual(task.error, None)
+
+    def test_nested_coroutine_passes_error_on(self):
+        def unhandled():
+            yield Expect('# ')
+        def parent():
+            try:
+                yield unhandled()
+            except pexpect.EOF:
+                raise Return('eof')
+        task = Task(parent())
+        task.step()
+        self.assertEqual(task.step(error=pexpect.EOF('eof')), None)
+        self.assertEqual(task.value, 'eof')
+
+    def test_value(self):
+        task = Task(outer())
+        task.step()
+        self.assertEqual(task.step(0), None)
+        self.assertEqual(task.value, ('inner', True))
+
+
+class DispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.expecter = dispatch.Expecter
+        self.logfiles = []
+        self.cons = []
+        for i in range(2):
+            fd, logfile = tempfile.mkstemp()
+            os.close(fd)
+            self.logfiles.append(logfile)
+            self.cons.append(BashCLI(logfile))
+
+    def tearDown(self):
+        dispatch.Expecter = self.expecter
+        for con in self.cons:
+            con.close()
+        for logfile in self.logfiles:
+            os.unlink(logfile)
+
+    def check_dispatcher(self, expecter):
+        dispatch.Expecter = expecter
+        dispatcher = dispatch.Dispatcher()
+        tasks = [dispatcher.add(con, con.runcommand_steps('echo %d'%(i)))
+                 for i, con in enumerate(self.cons)]
+        dispatcher.run()
+        self.assertEqual([task.value for task in tasks], [True, True])
+        self.assertEqual([con.output.split()[-1] for con in self.cons],
+                         ['0', '1'])
+        con = self.cons[0]
+        task = dispatcher.add(con, con.runcommand_steps('sleep 1',
+                                                        timeout=0.1))
+        dispatcher.run()
+        self.assertEqual(task.value, None)
+        self.assertTrue(con.timedout)
+
+    def test_pexpect_expecter(self):
+        self.check_dispatcher(dispatch.Expecter)
+
+    def test_spawn_expecter(self):
+        # used with pexpect 3.x
+        self.check_dispatcher(dispatch.SpawnExpecter)
+
+
+if __name__ == '__main__':
+    unittest.main()
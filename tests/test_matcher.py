@@ -0,0 +1,93 @@
+#
+# Copyright (C) 2015 Prevas A/S
+#
+# This file is part of dctrl, an embedded device control framework
+#
+# dctrl is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# dctrl is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+import re
+import random
+import unittest
+import pexpect
+
+from dctrl.expect import matcher
+
+PIECES = ['root@', 'device:~', '# ', 'error 12', 'link is up', '\n', '\r\n',
+          'x', ' ', '@', '#', 'r', 'oot@']
+
+PATTERN_LISTS = [
+    ['# '],
+    ['root@.*# '],
+    ['link is up', pexpect.TIMEOUT, 'root@.*# '],
+    [r'error \d+', pexpect.TIMEOUT, 'root@.*# '],
+    ['root@[^\n]*# ', 'up$', r'\n.*x'],
+]
+
+
+class SearcherStreamTest(unittest.TestCase):
+
+    def check(self, patterns, chunks, lookback=None):
+        """Feed chunks to a searcher_stream and a pexpect searcher_re, the
+        way pexpect (4.x) does, and check that they match the same."""
+
+        stream = matcher.searcher_stream(patterns)
+        reference = pexpect.searcher_re(
+            [p if p is pexpect.TIMEOUT else re.compile(p, re.DOTALL)
+             for p in patterns])
+        buffer = ''
+        for chunk in chunks:
+            # the search window is the fresh data and lookback characters
+            # before it
+            if lookback:
+                buffer = buffer[max(0, len(buffer) - lookback):]
+            buffer += chunk
+            index = stream.search(buffer, len(chunk), lookback)
+            expected = reference.search(buffer, len(chunk), lookback)
+            self.assertEqual(index, expected,
+                             '%r %r'%(patterns, chunks))
+            if index >= 0:
+                self.assertEqual((stream.start, stream.end),
+                                 (reference.start, reference.end))
+                return
+
+    def test_random(self):
+        rand = random.Random(7)
+        for i in range(2000):
+            data = ''.join(rand.choice(PIECES)
+                           for j in range(rand.randint(0, 30)))
+            chunks = []
+            while data:
+                n = rand.randint(1, 8)
+                chunks.append(data[:n])
+                data = data[n:]
+            self.check(rand.choice(PATTERN_LISTS), chunks,
+                       rand.choice([None, None, 4, 12]))
+
+    def test_prefix_split(self):
+        self.check(['root@.*# '], ['xx ro', 'ot', '@dev\n', 'ice# '])
+        self.check(['root@.*# '], ['root@', 'x\n' * 10, '# '])
+
+    def test_literal_prefix(self):
+        self.assertEqual(matcher.literal_prefix(
+                re.compile('root@.*# ')), 'root@')
+        self.assertEqual(matcher.literal_prefix(
+                re.compile('.*# ')), '')
+        self.assertEqual(matcher.literal_prefix(
+                re.compile('root@', re.I)), '')
+
+
+if __name__ == '__main__':
+    unittest.main()